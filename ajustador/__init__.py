@@ -1,8 +1,10 @@
+from . import cache
 from . import compat
 from . import detect
 from . import features
 from . import fitnesses
 from . import loader
 from . import optimize
+from . import store
 from . import utilities
 from . import vartype
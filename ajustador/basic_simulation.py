@@ -18,6 +18,28 @@ in parallel, where each one should be run out-of-process::
       -i=-5.0000000000000034e-11 \\
       --save-vm=ivdata--5.0000000000000034e-11.npy
 
+When more than one current is given, the model is set up once and
+simulated for each of the currents in turn. All traces are then saved
+together in a single file: either an .npz file, with the currents as
+`injection` and the membrane potential as rows of `vm`, or an .npy file
+with just the membrane potential rows::
+
+  $ python3 -m ajustador.basic_simulation ... \\
+      -i=-5e-11 -i=1e-10 -i=3e-10 \\
+      --save-vm=ivdata.npz
+
+Starting many interpreters is expensive, so the module can also be run
+as a persistent worker, which reads (directory, arguments) requests
+pickled on stdin and pickles a reply for each to the given file descriptor::
+
+  $ python3 -m ajustador.basic_simulation --serve 3
+
+With --abort-targets (a pickled (measurement, fitness function), see
+ajustador.optimize.save_targets) and --abort-threshold, the simulation is
+run in steps of --abort-interval, and stopped as soon as the lower bound
+of its fitness exceeds the threshold. The bound is then written to
+the --save-vm file name with .aborted appended, instead of the traces.
+
 This module is not automatically imported as a child of ajustador.
 An explicit import is needed:
 >>> import ajustador.basic_simulation
@@ -50,6 +72,8 @@ print(os.getcwd())
 import tempfile
 import re
 import importlib
+import pickle
+import traceback
 import numpy as np
 import moose
 from moose_nerp.prototypes import (create_model_sim,
@@ -67,6 +91,7 @@ from ajustador.regulate_chan_kinetics import chan_setting
 from ajustador.regulate_chan_kinetics import scale_voltage_dependents_tau_muliplier
 from ajustador.regulate_chan_kinetics import offset_voltage_dependents_vshift
 from ajustador.helpers.loggingsystem import getlogger
+from ajustador.utilities import chdir
 
 import logging
 logger = getlogger(__name__)
@@ -121,6 +146,11 @@ def option_parser():
     p.add_argument('--CaPoolBDend', type=real)
     p.add_argument('--CaPoolBSoma', type=real)
 
+    p.add_argument('--abort-targets')
+    p.add_argument('--abort-threshold', type=real)
+    p.add_argument('--abort-interval', type=real, default=0.05)
+    p.add_argument('--junction-potential', type=real, default=0)
+
     return p
 
 @util.listize
@@ -313,7 +343,46 @@ def reset_baseline(neuron, baseline, Cond_Kir):
                 print("%s Em %f -> %f" % (w.path, w.Em, Em))
             w.Em = Em
 
-def run_simulation(injection_current, simtime, param_sim, model):
+class AbortMonitor(object):
+    ''' Checks the traces of a running simulation against the measurement.
+    '''
+    def __init__(self, targets, threshold, interval, junction_potential):
+        with open(targets, 'rb') as f:
+            self.measurement, self.fitness = pickle.load(f)
+        self.threshold = threshold
+        self.interval = interval
+        self.junction_potential = junction_potential
+        self.waves = []
+        self.bound = 0
+
+    def _wave(self, injection_current, vm, time):
+        from ajustador import loader
+        return loader.IVCurve(None, None,
+                              injection=injection_current,
+                              x=loader.timebase(0, time, len(vm), True),
+                              y=vm - self.junction_potential,
+                              features=self.measurement.features)
+
+    def add(self, injection_current, vm, time):
+        ''' Remember a finished trace
+        '''
+        self.waves.append(self._wave(injection_current, vm, time))
+
+    def hopeless(self, injection_current, vm, time):
+        ''' Check if the simulation cannot do better than the threshold
+        '''
+        if len(vm) < 2:
+            return False
+        partial = self._wave(injection_current, vm, time)
+        try:
+            self.bound = self.fitness.lower_bound(self.waves, self.measurement, partial)
+        except Exception:
+            # features of truncated traces are not always defined
+            logger.debug('cannot bound fitness at t={}'.format(time), exc_info=True)
+            return False
+        return self.bound > self.threshold
+
+def run_simulation(injection_current, simtime, param_sim, model, monitor=None, elemname=None):
     global pulse_gen
     if logger.level == logging.DEBUG:
         print("################## moose versions: ", moose.__version__)
@@ -330,7 +399,20 @@ def run_simulation(injection_current, simtime, param_sim, model):
             keys = sorted(attr.keys())  #Check is this effecting cond Kir when 'axon' in dist, med param_cond?
             Cond_Kir = attr[keys[0]]
             reset_baseline(param_sim.neuron_type, param_sim.baseline, Cond_Kir)
-    moose.start(simtime)
+    if monitor is None:
+        moose.start(simtime)
+        return True
+    # run in steps, so that hopeless simulations can be stopped early
+    time = 0
+    while time < simtime - 1e-9:
+        step = min(monitor.interval, simtime - time)
+        moose.start(step)
+        time += step
+        if monitor.hopeless(injection_current, moose.element(elemname).vector, time):
+            print('aborting at t={}, fitness bound {} > {}'.format(
+                time, monitor.bound, monitor.threshold))
+            return False
+    return True
 
 def main(args):
     global param_sim, pulse_gen
@@ -339,15 +421,90 @@ def main(args):
     model.param_cond.neurontypes=util.neurontypes(model.param_cond,[param_sim.neuron_type])
     logger.debug("param_sim::::::::: {}".format(param_sim))
     pulse_gen, hdf5writer = setup(param_sim, model)
-    run_simulation(param_sim.injection_current[0], param_sim.simtime, param_sim, model)
-    #hdf5writer.close()
+    elemname = '/data/Vm{}_c0'.format(param_sim.neuron_type)
+    monitor = None
+    if param_sim.abort_targets is not None and param_sim.abort_threshold is not None:
+        try:
+            monitor = AbortMonitor(param_sim.abort_targets, param_sim.abort_threshold,
+                                   param_sim.abort_interval, param_sim.junction_potential)
+        except Exception as e:
+            # stopping early is just an optimization, run the whole simulation
+            logger.warning('cannot load {}: {}'.format(param_sim.abort_targets, e))
+    traces = []
+    for injection_current in param_sim.injection_current:
+        if not run_simulation(injection_current, param_sim.simtime, param_sim, model,
+                              monitor=monitor, elemname=elemname):
+            if param_sim.save_vm:
+                with open(param_sim.save_vm + '.aborted', 'w') as f:
+                    f.write(str(monitor.bound))
+            return
+        #hdf5writer.close()
+
+        if param_sim.plot_vm:
+            neuron_graph.graphs(model,model.vmtab, param_sim.plot_current, param_sim.simtime, compartments=[0])
+            util.block_if_noninteractive()
+        if param_sim.save_vm:
+            # the table is overwritten by the next moose.reinit()
+            traces.append(np.array(moose.element(elemname).vector))
+        if monitor is not None:
+            monitor.add(injection_current, moose.element(elemname).vector, param_sim.simtime)
 
-    if param_sim.plot_vm:
-        neuron_graph.graphs(model,model.vmtab, param_sim.plot_current, param_sim.simtime, compartments=[0])
-        util.block_if_noninteractive()
     if param_sim.save_vm:
-        elemname = '/data/Vm{}_c0'.format(param_sim.neuron_type)
-        np.save(param_sim.save_vm, moose.element(elemname).vector)
+        if param_sim.save_vm.endswith('.npz'):
+            np.savez(param_sim.save_vm,
+                     injection=np.array(param_sim.injection_current),
+                     vm=np.array(traces))
+        elif len(traces) == 1:
+            np.save(param_sim.save_vm, traces[0])
+        else:
+            # rows in the order of the currents
+            np.save(param_sim.save_vm, np.array(traces))
+
+# Those elements are created by MOOSE itself and must survive reset()
+_moose_builtins = ('Msgs', 'clock', 'classes', 'postmaster')
+
+def reset():
+    ''' Removes everything created by setup(), so that another simulation
+        can be set up in the same process.
+    '''
+    for elem in moose.element('/').children:
+        if elem.name not in _moose_builtins:
+            moose.delete(elem.path)
+    # setup() modifies the model modules in-place, make sure they are
+    # imported afresh by the next main().
+    for name in list(sys.modules):
+        parts = name.split('.')
+        if (parts[0] == 'moose_nerp' and len(parts) > 1
+            and parts[1] not in ('prototypes', 'graph')):
+            del sys.modules[name]
+
+def serve(fd):
+    ''' Runs main() for each (dirname, args) request pickled on stdin,
+        and pickles ('ok', None) or ('error', traceback) for each to fd.
+    '''
+    requests = sys.stdin.buffer
+    replies = os.fdopen(fd, 'wb')
+
+    while True:
+        try:
+            dirname, args = pickle.load(requests)
+        except EOFError:
+            break
+        try:
+            with chdir(dirname):
+                main(args)
+        except (Exception, SystemExit):
+            reply = 'error', traceback.format_exc()
+        else:
+            reply = 'ok', None
+        finally:
+            sys.stdout.flush()
+            reset()
+        pickle.dump(reply, replies)
+        replies.flush()
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    if sys.argv[1:2] == ['--serve']:
+        serve(int(sys.argv[2]))
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,191 @@
+"""An on-disk cache of simulation results
+
+Results are stored under a hash of everything which determines them, so
+they can be shared between fits, and reused when a fit is restarted:
+
+>>> cache = SimulationCache('/tmp/ajustador-cache')
+>>> fit = optimize.Fit(..., cache=cache)
+
+The cache is limited in size, the least recently used results are removed
+first. The size is checked every `evict_every` writes in each process, so
+it can go over the limit by that many results. It is safe to use from many
+processes at the same time.
+
+Reused results are counted in `hits`, and only printed with `verbose`.
+"""
+
+import os
+import pickle
+import hashlib
+import importlib.util
+import tempfile
+
+import numpy as np
+
+from ajustador.helpers.loggingsystem import getlogger
+logger = getlogger(__name__)
+
+evict_every = 20
+_writes = {}
+
+class SimulationCache(object):
+    def __init__(self, dirname, max_size=2**30, verbose=False):
+        "Store at most `max_size` bytes of results in `dirname`"
+        self.dirname = os.path.abspath(dirname)
+        self.max_size = max_size
+        # print each reused result, see reused()
+        self.verbose = verbose
+        # the lookups of this object, in this process: the copies used by
+        # worker processes count their own
+        self.hits = self.misses = 0
+        os.makedirs(self.dirname, exist_ok=True)
+
+    def __repr__(self):
+        return '{}({!r}, max_size={})'.format(self.__class__.__name__,
+                                              self.dirname, self.max_size)
+
+    @staticmethod
+    def key(*parts):
+        "Hash the parts (strings, bytes, or anything with a stable repr)"
+        h = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode()
+            elif not isinstance(part, bytes):
+                part = repr(part).encode()
+            h.update(part)
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def path(self, key, suffix='.npy'):
+        return os.path.join(self.dirname, key[:2], key + suffix)
+
+    def lookup(self, key, suffix='.npy'):
+        "Return the file name of the result stored under key, or None"
+        path = self.path(key, suffix)
+        try:
+            # the modification time is the last use for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def _damaged(self):
+        "A result which was found by lookup() could not be read"
+        self.hits -= 1
+        self.misses += 1
+
+    def reused(self, what):
+        "Report that results were reused for `what`, if verbose"
+        if self.verbose:
+            print('+ [cached]', what, flush=True)
+
+    def load(self, key):
+        "Return the array stored under key, or None"
+        path = self.lookup(key)
+        if path is None:
+            return None
+        try:
+            return np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            # evicted or damaged in the meantime
+            self._damaged()
+            return None
+
+    def load_pickle(self, key):
+        "Return the object pickled under key, or None"
+        path = self.lookup(key, '.pickle')
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self._damaged()
+            return None
+
+    def _write(self, key, suffix, write):
+        path = self.path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write under a temporary name and rename, so that other processes
+        # never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        n = _writes[self.dirname] = _writes.get(self.dirname, 0) + 1
+        if n % evict_every == 1:
+            self.evict()
+
+    def save(self, key, array):
+        "Store an array under key"
+        self._write(key, '.npy', lambda f: np.save(f, array))
+
+    def save_pickle(self, key, obj):
+        "Store a pickled object under key"
+        self._write(key, '.pickle', lambda f: pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL))
+
+    def store(self, key, filename, suffix):
+        "Store a copy of a file under key"
+        def write(f):
+            with open(filename, 'rb') as source:
+                while True:
+                    block = source.read(2**20)
+                    if not block:
+                        break
+                    f.write(block)
+        self._write(key, suffix, write)
+
+    def _entries(self):
+        for sub in os.scandir(self.dirname):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, entry.path
+
+    def evict(self):
+        "Remove the least recently used results until below max_size"
+        entries = sorted(self._entries())
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+_model_digests = {}
+def model_digest(model):
+    """Hash the files of the moose_nerp model package
+
+    This covers the morphology files and the model parameters.
+    """
+    try:
+        return _model_digests[model]
+    except KeyError:
+        pass
+    spec = importlib.util.find_spec('moose_nerp.' + model)
+    dirname = os.path.dirname(spec.origin)
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(dirname)):
+        path = os.path.join(dirname, name)
+        if os.path.isfile(path) and not name.endswith('.pyc'):
+            h.update(name.encode())
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    ans = _model_digests[model] = h.hexdigest()
+    return ans
@@ -8,38 +8,84 @@ def arrayize(type):
         return functools.update_wrapper(wrapper, func)
     return decorator
 
-@arrayize(int)
+def _update(seg, start, value, index, extremum, better):
+    """The extremum of seg and value, and where it is
+
+    Like a loop which only replaces value by a strictly better sample, the
+    index is the first position of the new extremum, and NaNs are skipped.
+    """
+    if better(extremum, value):
+        return extremum, start + (seg == extremum).argmax()
+    return value, index
+
+def _search(y, values, i, low, low_i, high, high_i, found, scalar=32, block=256):
+    """Find the first index >= i where found(y, low, high) is true
+
+    low and high are the minimum and the maximum of the samples before i.
+    The first `scalar` samples are checked one by one, because in noisy
+    traces the next index is often very close. After that, the search
+    looks at growing blocks of y. Returns None if there is no such index,
+    or the index and the extrema there.
+    """
+    stop = min(i + scalar, len(values))
+    for i in range(i, stop):
+        value = values[i]
+        if value < low:
+            low_i, low = i, value
+        if value > high:
+            high_i, high = i, value
+        if found(value, low, high):
+            return i, low, low_i, high, high_i
+    i = stop
+    while i < len(y):
+        seg = y[i:i + block]
+        lows = np.fmin(np.fmin.accumulate(seg), low)
+        highs = np.fmax(np.fmax.accumulate(seg), high)
+        hits = found(seg, lows, highs)
+        k = hits.argmax() if hits.any() else seg.size - 1
+        low, low_i = _update(seg[:k + 1], i, low, low_i, lows[k], np.less)
+        high, high_i = _update(seg[:k + 1], i, high, high_i, highs[k], np.greater)
+        if hits[k]:
+            return i + k, low, low_i, high, high_i
+        i += seg.size
+        block *= 4
+    return None
+
 def detect_peaks(y, min_high_ratio=0.25, P_low=0.5, P_high=0.5, both=False):
-    low_i, low = 0, y[0]
-    high_i, high = 0, y[0]
+    """Return the indices of the peaks of y
+
+    Starting at the first point above `min_high_ratio` of the maximum, a
+    peak is the highest point before y falls back by `P_high` of the
+    distance between the running maximum and minimum, and the next peak is
+    only looked for after y rises again by `P_low` of that distance. With
+    `both`, the indices of the troughs in between are returned too.
+    """
+    y = np.asarray(y)
+    # python floats are faster to compare one by one, other types are kept
+    # as numpy scalars, so that the arithmetic is the same as for arrays
+    values = y.tolist() if y.dtype == np.float64 else list(y)
+    low_i, low = 0, values[0]
+    high_i, high = 0, values[0]
 
+    ans = []
     i = (y > y.max() * min_high_ratio).argmax() # find True
     while True:
-        for i in range(i, len(y)):
-            if y[i] < low:
-                low_i, low = i, y[i]
-            if y[i] > high:
-                high_i, high = i, y[i]
-
-            if y[i] - low < (high - low) * P_high:
-                break
-        else:
+        found = _search(y, values, i, low, low_i, high, high_i,
+                        lambda seg, lows, highs: seg - lows < (highs - lows) * P_high)
+        if found is None:
             break
+        i, low, low_i, high, high_i = found
 
-        yield high_i
-        low_i, low = i, y[i]
-
-        for i in range(i, len(y)):
-            if y[i] < low:
-                low_i, low = i, y[i]
-            if y[i] > high:
-                high_i, high = i, y[i]
+        ans.append(high_i)
+        low_i, low = i, values[i]
 
-            if y[i] - low > (high - low) * P_low:
-                break
-        else:
+        found = _search(y, values, i, low, low_i, high, high_i,
+                        lambda seg, lows, highs: seg - lows > (highs - lows) * P_low)
+        if found is None:
             break
+        i, low, low_i, high, high_i = found
 
         if both:
-            yield low_i
-        high_i, high = i, y[i]
+            ans.append(low_i)
+        high_i, high = i, values[i]
+    return np.array(ans, dtype=int)
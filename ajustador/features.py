@@ -5,7 +5,7 @@ import numpy as np
 from scipy import optimize
 
 from . import utilities, detect, vartype
-from .signal_smooth import smooth
+from .signal_smooth import smooth, smooth_rows
 from ajustador.helpers.loggingsystem import getlogger
 import logging
 logger = getlogger(__name__)
@@ -43,6 +43,23 @@ class Feature:
     def __init__(self, obj):
         self._obj = obj
 
+    @classmethod
+    def _batch(cls, features, x, ys):
+        """Calculate the feature for many traces at once
+
+        `features` are instances of this class for traces which share the
+        time base `x`, and `ys` is the 2-D array of their voltages. The
+        results are stored where the properties would cache them. See
+        :func:`compute_batch`.
+        """
+        pass
+
+    def _preset(self, name, value):
+        "Store value as the result of the once property name, unless known"
+        attr = '_{}_value'.format(name)
+        if not hasattr(self, attr):
+            setattr(self, attr, value)
+
     def plot(self, figure=None):
         if figure is None:
             from matplotlib import pyplot
@@ -208,6 +225,38 @@ class SteadyState(Feature):
     def response(self):
         return self.steady - self.baseline
 
+    @classmethod
+    def _batch(cls, features, x, ys):
+        key = lambda f: (f._obj.baseline_before, f._obj.baseline_after,
+                         f._obj.steady_after, f._obj.steady_before,
+                         f._obj.steady_cutoff)
+        for (before, after, steady_after, steady_before, cutoff), rows in _groupby(features, key):
+            group = [features[i] for i in rows]
+            data = ys[rows]
+            regions = []
+            if before is not None or after is not None:
+                regions.append(('baseline',
+                                (x < before if before is not None else False) |
+                                (x > after if after is not None else False)))
+            if before is not None:
+                regions.append(('baseline_pre', x < before))
+            if after is not None:
+                regions.append(('baseline_post', x > after))
+            for name, region in regions:
+                if region.any():
+                    what = data[:, region]
+                    cutoffa, cutoffb = np.percentile(what, (40, 60), axis=1)
+                    mask = (what >= cutoffa[:, None]) & (what <= cutoffb[:, None])
+                    for feature, value in zip(group, _masked_means(what, mask)):
+                        feature._preset(name, value)
+            region = (x > steady_after) & (x < steady_before)
+            if region.any():
+                what = data[:, region]
+                limit = np.percentile(what, cutoff, axis=1)
+                mask = what <= limit[:, None]
+                for feature, value in zip(group, _masked_means(what, mask)):
+                    feature._preset('steady', value)
+
     def plot(self, figure=None, pre_post=False):
         wave = self._obj.wave
         before = self._obj.baseline_before
@@ -251,25 +300,60 @@ class SteadyState(Feature):
 
 peak_and_threshold = namedtuple('peak_and_threshold', 'peaks thresholds')
 
-def _find_spikes(wave, min_height=0.0, max_charge_time=0.004, charge_threshold=0.02):
-    peaks = detect.detect_peaks(wave.y, P_low=0.75, P_high=0.50)
+spike_detection = dict(P_low=0.75, P_high=0.50)
+
+def _find_spikes(wave, min_height=0.0, max_charge_time=0.004, charge_threshold=0.02,
+                 peaks=None):
+    if peaks is None:
+        peaks = detect.detect_peaks(wave.y, **spike_detection)
     peaks = peaks[wave.y[peaks] > min_height]
 
-    thresholds = np.empty(peaks.size)
-    for i in range(len(peaks)):
-        start = (wave.x >= wave.x[peaks[i]] - max_charge_time).argmax()
-        x = wave.x[start:peaks[i] + 1]
-        y = wave.y[start:peaks[i] + 1]
-        yderiv = np.diff(y)
-        #spike threshold is point where derivative is 2% of steepest
-        try:
-            ythresh = charge_threshold * yderiv.max()
-            thresh = y[1:][yderiv > ythresh].min()
-            thresholds[i] = thresh
-        except Exception:
-            thresholds[i] = np.nan
+    # the charging window of each spike, from max_charge_time before the
+    # peak, as rows of indices into the derivative
+    starts = np.searchsorted(wave.x, wave.x[peaks] - max_charge_time)
+    width = (peaks - starts).max() if peaks.size else 0
+    index = starts[:, None] + np.arange(width)
+    valid = index < peaks[:, None]
+    index = np.minimum(index, max(wave.y.size - 2, 0))
+    yderiv = np.diff(wave.y)[index]
+    y = wave.y[1:][index]
+
+    #spike threshold is point where derivative is 2% of steepest
+    with np.errstate(invalid='ignore'):
+        steepest = np.where(valid, yderiv, -np.inf).max(axis=1, initial=-np.inf)
+        # multiplied as python floats and compared in the type of y, as
+        # for a single spike
+        ythresh = (charge_threshold * steepest.astype(float)).astype(yderiv.dtype)
+        charging = valid & (yderiv > ythresh[:, None])
+    thresholds = np.where(charging, y, np.inf).min(axis=1, initial=np.inf).astype(float)
+    # no charging points, or nan in the window
+    thresholds[~charging.any(axis=1)] = np.nan
     return peak_and_threshold(peaks, thresholds)
 
+def _scan(starts, keep_going, direction=1, step=16):
+    """Walk from each of starts while keep_going is true
+
+    Like a while loop for each start, returns the first position where
+    keep_going(rows, positions) is false. It is called with the indices of
+    the starts which are still walking, and a 2-D array of the next
+    positions for each of them, and must return False for positions at the
+    edge of the data. All walks advance together, by growing blocks.
+    """
+    starts = np.asarray(starts, dtype=int)
+    ans = starts.copy()
+    todo = np.arange(starts.size)
+    offset = 0
+    while todo.size:
+        positions = starts[todo, None] + direction * (offset + np.arange(step))
+        going = keep_going(todo, positions)
+        stopped = ~going.all(axis=1)
+        first = (~going).argmax(axis=1)
+        ans[todo[stopped]] = positions[stopped, first[stopped]]
+        todo = todo[~stopped]
+        offset += step
+        step *= 2
+    return ans
+
 class WaveRegion:
     def __init__(self, wave, left_i, right_i):
         self._wave = wave
@@ -347,6 +431,16 @@ class Spikes(Feature):
         "Indices of spike maximums in the wave.x, wave.y arrays"
         return _find_spikes(self._obj.wave)
 
+    @classmethod
+    def _batch(cls, features, x, ys):
+        # The peak search depends on the peaks found before it, so it is
+        # still a loop over the traces. Only the overhead of the properties
+        # is saved.
+        for feature, y in zip(features, ys):
+            peaks = detect.detect_peaks(y, **spike_detection)
+            feature._preset('spike_i_and_threshold',
+                            _find_spikes(feature._obj.wave, peaks=peaks))
+
     @property
     def spike_i(self):
         "Indices of spike maximums in the wave.x, wave.y arrays"
@@ -420,18 +514,19 @@ class Spikes(Feature):
         "The FWHM box and other measurements for each spike"
         spikes, thresholds = self.spike_i_and_threshold
 
-        ans = []
         y = self._obj.wave.y
         halfheight = (self.spikes.y - thresholds) / 2 + thresholds
-
-        for i, k in enumerate(self.spike_i):
-            beg = end = k
-            while beg > 1 and y[beg - 1] > halfheight[i]:
-                beg -= 1
-            while end + 2 < y.size and y[end + 1] > halfheight[i]:
-                end += 1
-            ans.append(WaveRegion(self._obj.wave, beg, end))
-        return ans
+        last = max(y.size - 1, 0)
+
+        # walk out from the peak while above the halfheight
+        beg = _scan(self.spike_i,
+                    lambda rows, b: (b > 1) &
+                                    (y[np.clip(b - 1, 0, last)] > halfheight[rows, None]),
+                    direction=-1)
+        end = _scan(self.spike_i,
+                    lambda rows, e: (e + 2 < y.size) &
+                                    (y[np.clip(e + 1, 0, last)] > halfheight[rows, None]))
+        return [WaveRegion(self._obj.wave, b, e) for b, e in zip(beg, end)]
 
     @property
     @utilities.once
@@ -525,49 +620,57 @@ class AHP(Feature):
     array_attributes = ('spike_ahp_window', 'spike_ahp', 'spike_ahp_position')
     mean_attributes = ('spike_ahp',)
 
-    @property
-    @utilities.once
-    def spike_ahp_window(self):
-        spikes = self._obj.spikes
+    def _window_starts(self):
+        """Where the AHP of each spike is looked for
+
+        Returns the indices where the windows can start, the thresholds,
+        the x where they must end, and the width of the rolling window,
+        for each spike.
+        """
         spike_bounds = self._obj.spike_bounds
         thresholds = self._obj.spike_threshold
         injection_start = self._obj.injection_start
         injection_end = self._obj.injection_end
 
         x = self._obj.wave.x
-        y = self._obj.wave.y
-        ans = []
-        for i in range(len(spikes)):
-            beg = spike_bounds[i].right_i
-
-            # Don't allow the ahp to straddle an injection start/stop edge.
-            # The ahp will be invalid anyway.
-            rlimit = min(spike_bounds[i+1].left if i < len(spikes)-1 else x[-1],
-                         injection_start if injection_start > x[beg] else np.infty,
-                         injection_end if injection_end > x[beg] else np.infty)
+        thresholds = np.asarray(thresholds, dtype=float)
+        start = np.array([bounds.right_i for bounds in spike_bounds], dtype=int)
+
+        # Don't allow the ahp to straddle an injection start/stop edge.
+        # The ahp will be invalid anyway.
+        lefts = [bounds.left for bounds in spike_bounds[1:]]
+        rlimit = np.array([min(left,
+                               injection_start if injection_start > x[beg] else np.inf,
+                               injection_end if injection_end > x[beg] else np.inf)
+                           for left, beg in zip(lefts + [x[-1]], start)], dtype=float)
+
+        widths = np.array([bounds.width for bounds in spike_bounds])
+        # FIXME: consider rejecting those with nan width outright
+        n_rolling_window = np.array([int(w // (x[1] - x[0])) + 1 if not np.isnan(w) else 5
+                                     for w in widths], dtype=int)
+        return start, thresholds, rlimit, n_rolling_window
 
-            w = spike_bounds[i].width
-            if not np.isnan(w):
-                n_rolling_window = int(w // (x[1] - x[0])) + 1
-            else:
-                # FIXME: consider rejecting those outright
-                n_rolling_window = 5
-
-            # if we are before the AHP, or mostly going down, advance
-            while (beg < y.size - n_rolling_window and
-                   y[beg] >= thresholds[i] and x[beg + 1] < rlimit and
-                   y[beg] > y[beg + n_rolling_window]):
-                beg += 1
-
-            end = beg + n_rolling_window
-            while (end < x.size and
-                   (y[end] < thresholds[i] or end - beg < 5) and
-                   x[end] < rlimit):
-                end += 1
-
-            ans.append(WaveRegion(self._obj.wave, beg, end))
-
-        return ans
+    @property
+    @utilities.once
+    def spike_ahp_window(self):
+        start = self._window_starts()
+        beg, end = _ahp_windows(self._obj.wave.x, self._obj.wave.y[None],
+                                np.zeros(len(start[0]), dtype=int), *start)
+        return [WaveRegion(self._obj.wave, b, e) for b, e in zip(beg, end)]
+
+    @classmethod
+    def _batch(cls, features, x, ys):
+        # the windows of all spikes of all traces are scanned together
+        starts = [feature._window_starts() for feature in features]
+        counts = [len(start[0]) for start in starts]
+        trace = np.repeat(np.arange(len(features)), counts)
+        windows = _ahp_windows(x, ys, trace,
+                               *(np.concatenate(parts) for parts in zip(*starts)))
+        offsets = np.cumsum([0] + counts)
+        for i, feature in enumerate(features):
+            beg, end = (w[offsets[i]:offsets[i + 1]] for w in windows)
+            feature._preset('spike_ahp_window',
+                            [WaveRegion(feature._obj.wave, b, e) for b, e in zip(beg, end)])
 
     @property
     @utilities.once
@@ -695,16 +798,51 @@ class AHP(Feature):
             diff = r - l
             axes[i].set_xlim(l - diff*0.15, r + diff*0.15)
 
-def _find_falling_curve(wave, window=20, after=0.2, before=0.6):
+def _ahp_windows(x, ys, trace, start, thresholds, rlimit, n_rolling_window):
+    """The beginning and end of the AHP window of each spike
+
+    The spikes are in the rows `trace` of ys, and start, thresholds,
+    rlimit and n_rolling_window are given for each of them, see
+    :meth:`AHP._window_starts`.
+    """
+    last = ys.shape[1] - 1
+
+    # if we are before the AHP, or mostly going down, advance
+    def before_ahp(rows, b):
+        n = n_rolling_window[rows, None]
+        row = trace[rows, None]
+        i = np.clip(b, 0, last)
+        return ((b < ys.shape[1] - n) &
+                (ys[row, i] >= thresholds[rows, None]) &
+                (x[np.clip(b + 1, 0, last)] < rlimit[rows, None]) &
+                (ys[row, i] > ys[row, np.clip(b + n, 0, last)]))
+    beg = _scan(start, before_ahp)
+
+    def in_ahp(rows, e):
+        i = np.clip(e, 0, last)
+        return ((e < x.size) &
+                ((ys[trace[rows, None], i] < thresholds[rows, None]) | (e - beg[rows, None] < 5)) &
+                (x[i] < rlimit[rows, None]))
+    end = _scan(beg + n_rolling_window, in_ahp)
+    return beg, end
+
+def _find_falling_curve(wave, window=20, after=0.2, before=0.6, smoothed=None):
+    """Find the part of the wave where it falls after the injection start
+
+    `smoothed` is (smoothed derivative, smoothed wave.y), if already
+    calculated.
+    """
     d = vartype.array_diff(wave)
-    dd = smooth(d.y, window='hanning', window_len=window)[(d.x > after) & (d.x < before)]
-    start = end = dd.argmin() + (d.x <= after).sum()
-    while start > 0 and wave[start - 1].y > wave[start].y and wave[start].x > after:
-        start -= 1
-    sm = smooth(wave.y, window='hanning', window_len=window)
+    if smoothed is None:
+        smoothed = (smooth(d.y, window='hanning', window_len=window),
+                    smooth(wave.y, window='hanning', window_len=window))
+    dsm, sm = smoothed
+    dd = dsm[(d.x > after) & (d.x < before)]
+    end = dd.argmin() + (d.x <= after).sum()
     smallest = sm[end]
+    x = wave.x
     # find minimum
-    while (end+window < wave.size and wave[end+window].x < before
+    while (end+window < x.size and x[end+window] < before
            and sm[end:end + window].min() < smallest):
         smallest = sm[end]
         end += window // 2
@@ -761,6 +899,27 @@ class FallingCurve(Feature):
                                    after=self._obj.injection_start,
                                    before=self._obj.steady_before)
 
+    @classmethod
+    def _batch(cls, features, x, ys):
+        key = lambda f: (f._obj.falling_curve_window,
+                         f._obj.injection_start,
+                         f._obj.steady_before)
+        for (window, after, before), rows in _groupby(features, key):
+            # the smoothing is done for all rows at once, but the search
+            # for the minimum is a loop over the traces
+            dsm = smooth_rows(np.diff(ys[rows], axis=1), window_len=window)
+            sm = smooth_rows(ys[rows], window_len=window)
+            for i, row in enumerate(rows):
+                feature = features[row]
+                try:
+                    ccut = _find_falling_curve(feature._obj.wave,
+                                               window=window, after=after, before=before,
+                                               smoothed=(dsm[i], sm[i]))
+                except Exception:
+                    # left for the property to report
+                    continue
+                feature._preset('falling_curve', ccut)
+
     @property
     @utilities.once
     def falling_curve_fit(self):
@@ -1062,3 +1221,79 @@ standard_features = (
     ChargingCurve,
     PostInjectionCurve,
     )
+
+
+def _groupby(features, key):
+    "Return (key, indices) of groups of features with the same key"
+    groups = {}
+    for i, feature in enumerate(features):
+        groups.setdefault(key(feature), []).append(i)
+    return groups.items()
+
+def _masked_means(data, mask):
+    "Like vartype.array_mean(row[mask]) for each row of data"
+    if data.dtype != np.float64:
+        # the rounding of the sums in lower precision depends on their
+        # order, so do them the same way as for single traces
+        return [vartype.array_mean(row[m]) for row, m in zip(data, mask)]
+    n = mask.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(mask, data, 0).sum(axis=1) / n
+        var = (np.where(mask, data - mean[:, None], 0)**2).sum(axis=1) / (n - 1)
+    return [vartype.vartype(m, v**0.5) for m, v in zip(mean, var)]
+
+def _time_bases(items):
+    "Return groups of (x, [(trace, ...)]) which share the time base x"
+    groups = []
+    for item in items:
+        x = item[0].wave.x
+        for base, group in groups:
+            if x is base or (x.shape == base.shape and np.array_equal(x, base)):
+                group.append(item)
+                break
+        else:
+            groups.append((x, [item]))
+    return groups
+
+def compute_batch(traces, *names):
+    """Calculate features of many traces at once
+
+    Traces which share a time base (as do all traces of a simulation, and
+    usually of a measurement) are stacked into a 2-D array, and the
+    features which support it are calculated for all rows of the array
+    at once. The results are stored in the features of each trace, so
+    they are returned by the usual attributes:
+
+    >>> features.compute_batch(measurement.waves)
+    >>> measurement.waves[0].baseline
+
+    `names` limits the calculation to the features which provide those
+    attributes. Features which were already calculated are skipped.
+
+    SteadyState and the AHP windows are calculated for all rows at
+    once. Spikes and FallingCurve loop over the rows for the searches
+    which depend on earlier positions in each trace, and the other
+    features are left to the properties.
+    """
+    pending = {}
+    for trace in traces:
+        if names:
+            objs = {trace._attributes.get(name) for name in names}
+        else:
+            objs = set(trace._attributes.values())
+        for obj in objs:
+            if (isinstance(obj, Feature)
+                and type(obj)._batch.__func__ is not Feature._batch.__func__
+                and not getattr(obj, '_batched', False)):
+                pending.setdefault(type(obj), []).append((trace, obj))
+
+    for cls, group in pending.items():
+        for x, shared in _time_bases(group):
+            objs = [obj for trace, obj in shared]
+            try:
+                cls._batch(objs, x, np.array([trace.wave.y for trace, obj in shared]))
+            except Exception as e:
+                # the properties calculate whatever is missing one by one
+                logger.debug('{} batch failed: {}'.format(cls.__name__, e))
+            for obj in objs:
+                obj._batched = True
@@ -1,7 +1,9 @@
 from __future__ import print_function, division
 
 import collections
+import contextlib
 import enum
+import heapq
 import numpy as np
 import pandas as pd
 
@@ -42,19 +44,82 @@ def sub_mes_dev(reca, recb):
     else:
         return reca - recb
 
+"Currents which differ by less than this are the same"
+INJECTION_TOLERANCE = 1e-12
+
+def match_currents(a, b, tolerance=INJECTION_TOLERANCE):
+    """Return the indices (ind1, ind2) of the pairs of currents in a and b
+    which differ by less than tolerance
+
+    The pairs are ordered by ind1, then ind2, like np.where of the full
+    comparison of a with b.
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    order = b.argsort(kind='stable')
+    sorted_b = b[order]
+    lo = sorted_b.searchsorted(a - tolerance, side='right')
+    hi = sorted_b.searchsorted(a + tolerance, side='left')
+    counts = np.maximum(hi - lo, 0)
+    ind1 = np.repeat(np.arange(a.size), counts)
+    ranks = np.arange(counts.sum()) - np.repeat(counts.cumsum() - counts, counts)
+    ind2 = order[np.repeat(lo, counts) + ranks]
+    # the edges of the window may be off by rounding
+    close = np.abs(a[ind1] - b[ind2]) < tolerance
+    ind1, ind2 = ind1[close], ind2[close]
+    keep = np.lexsort((ind2, ind1))
+    return ind1[keep], ind2[keep]
+
+# the pairings of one evaluation, see shared_selections
+_pairings = None
+
+@contextlib.contextmanager
+def shared_selections():
+    """Share the selections made by :func:`_select` in the block
+
+    The currents of each pair of simulation and measurement are matched
+    once, and the parts selected with the same filter are reused by all
+    the fitness functions called in the block. The simulations and
+    measurements must not be changed in the block.
+    """
+    global _pairings
+    old = _pairings
+    if _pairings is None:
+        _pairings = {}
+    try:
+        yield
+    finally:
+        _pairings = old
+
+def _cached(key, a, b, func):
+    "Return func(), remembered under key while the pairings are shared"
+    if _pairings is None:
+        return func()
+    try:
+        return _pairings[key][2]
+    except KeyError:
+        pass
+    # a and b are kept, so that their ids are not reused
+    ans = func()
+    _pairings[key] = a, b, ans
+    return ans
+
 def _select(a, b, which=None):
     ''' a -> sim, b -> measurments and which -> filter condition
         Note:- If filter condtion is not satisfied by any of the value, when indexed
                will return a nan.'''
     if which is not None:
-        bsel = b[which]
-    else:
-        bsel = b
-    fitting = np.abs(a.injection[:,None] - bsel.injection) < 1e-12
-    logger.debug("{}".format(fitting))
-    ind1, ind2 = np.where(fitting)
-    logger.debug("{} {}".format(ind1, ind2))
-    return a[ind1], bsel[ind2]
+        which = np.asarray(which, dtype=bool)
+    def select():
+        ind1, ind2 = _cached((id(a), id(b)), a, b,
+                             lambda: match_currents(a.injection, b.injection))
+        if which is not None:
+            keep = which[ind2]
+            ind1, ind2 = ind1[keep], ind2[keep]
+        logger.debug("{} {}".format(ind1, ind2))
+        return a[ind1], b[ind2]
+    return _cached((id(a), id(b), None if which is None else which.tobytes()),
+                   a, b, select)
 
 def relative_diff_single(a, b, extra=0):
     x = getattr(a, 'x', a)
@@ -70,6 +135,10 @@ def relative_diff_single(a, b, extra=0):
     return (np.where( (base>0), abs(x-y)/base, base)
             + RELATIVE_MAX_RATIO * extra)
 
+def _scalar(value):
+    "A numpy float, so that relative_diff_single does not divide by zero"
+    return np.float64(getattr(value, 'x', value))
+
 def relative_diff(a, b):
     """A difference between a and b using b as the yardstick
 
@@ -86,6 +155,14 @@ def relative_diff(a, b):
         b = b[:n1]
     return relative_diff_single(a, b, extra=abs(n1 - n2))
 
+def _rms(diff):
+    "The rms of the differences, like _evaluate"
+    ans = (diff ** 2).mean()**0.5 if diff.size else np.nan
+    if np.isnan(ans):
+        return NAN_REPLACEMENT
+    else:
+        return ans
+
 def _evaluate(a, b, error=ErrorCalc.relative):
     ''' Calcuate RMS using anyone of the two types of difference selected by error flag.
         Difference are calculated in between sim and measurements.
@@ -205,13 +282,44 @@ def isi_spread_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
         return vartype.vartype.nan
     return _evaluate(m1.isi_spread, m2.isi_spread, error=error)
 
-def _measurement_to_spikes(meas):
-    frames = [pd.DataFrame(wave.spikes) for wave in meas]
-    for frame, wave in zip(frames, meas):
-        frame['injection'] = wave.injection
-        frame.reset_index(inplace=True)
-        frame.set_index(['index', 'injection'], inplace=True)
-    return pd.concat(frames)
+def _padded_spike_times(waves):
+    times = [wave.spikes.x for wave in waves]
+    ans = np.full((len(times), max((len(x) for x in times), default=0)), np.nan)
+    for i, x in enumerate(times):
+        ans[i, :len(x)] = x
+    return ans
+
+def _spike_times(meas):
+    """The times of the spikes of each trace of meas
+
+    Returns an array with a row for each trace, padded with NaN. It is
+    calculated for all traces of the measurement meas was selected from,
+    see :meth:`loader.Attributable.per_wave`.
+    """
+    return meas.per_wave('_spike_times', _padded_spike_times)
+
+def _align_spikes(times1, times2, injection, fill):
+    """Pair the spikes of times1 and times2 by trace and spike number
+
+    times1 and times2 are from :func:`_spike_times` for the same currents.
+    Spikes missing on one side are replaced by fill. The pairs are in the
+    order pandas would align the spikes indexed by spike number and
+    current: trace by trace if each trace has the same number of spikes
+    on both sides, otherwise by spike number and then current.
+    """
+    n1 = (~np.isnan(times1)).sum(axis=1)
+    n2 = (~np.isnan(times2)).sum(axis=1)
+    width = max(times1.shape[1], times2.shape[1])
+    x1 = np.full((len(n1), width), float(fill))
+    x2 = np.full((len(n2), width), float(fill))
+    x1[:, :times1.shape[1]] = np.where(np.isnan(times1), fill, times1)
+    x2[:, :times2.shape[1]] = np.where(np.isnan(times2), fill, times2)
+    present = np.arange(width) < np.maximum(n1, n2)[:, None]
+    if (n1 == n2).all():
+        return x1[present], x2[present]
+    order = np.argsort(injection, kind='stable')
+    present = present[order].T
+    return x1[order].T[present], x2[order].T[present]
 
 def spike_time_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     m1, m2 = _select(sim, measurement, measurement.spike_count >= 2)
@@ -221,15 +329,13 @@ def spike_time_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
             # neither is spiking, cannot determine spike timing (Good thing)
             print('************')
             return 0 # If both are not spiking (rare but possible), cannot imporve spike_time_fitness
-    spikes1 = _measurement_to_spikes(m1)
-    spikes2 = _measurement_to_spikes(m2)
-    # spikes1, spikes2 are pandas DataFrames indexed by injection level and spike number
-    # The align method below will insert nans for missing spikes (only in the data frame missing a spike; the other dataframe will preserve its times)
-    spikes1, spikes2 = spikes1.align(spikes2,axis=0)
-    # Missing spikes contribute error scaled by injection_interval (could be left simply as NaNs and handled by NAN_REPLACEMENT)
-    spikes1.fillna(sim[0].injection_interval, inplace=True)
-    spikes2.fillna(sim[0].injection_interval, inplace=True) 
-    return _evaluate(spikes1['x'], spikes2['x'], error=error)
+    # The spikes are paired by injection level and spike number. Missing
+    # spikes (only on the side missing a spike; the other side preserves
+    # its times) contribute error scaled by injection_interval (could be
+    # left simply as NaNs and handled by NAN_REPLACEMENT)
+    spikes1, spikes2 = _align_spikes(_spike_times(m1), _spike_times(m2), m1.injection,
+                                     sim[0].injection_interval)
+    return _evaluate(spikes1, spikes2, error=error)
 
 def spike_count_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     m1, m2 = _select(sim, measurement)
@@ -537,26 +643,161 @@ class combined_fitness:
             if w or full:
                 yield (w, func(sim, measurement, error=self.error), func.__name__)
 
+    @staticmethod
+    def _weighted(w, r, feature_name):
+        value = w*NAN_REPLACEMENT if r == vartype.vartype.nan else w*r
+        logger.debug("{} {}".format(feature_name, value))
+        if str(value) == str(np.nan):
+            logger.warning("Feature: {}  fitness: {} Check Feature declaration in 'combined_fitness'!!!".format(feature_name, value))
+        return value
+
     def __call__(self, sim, measurement, full=False):
         # Computes feature fitnesses using _parts for one trace.
-        parts = [(feature_name, w*NAN_REPLACEMENT if r == vartype.vartype.nan else w*r) for w, r, feature_name in self._parts(sim, measurement)]
-        for feature_name, value in parts:
-            logger.debug("{} {}".format(feature_name, value))
-            if str(value) == str(np.nan):
-                logger.warning("Feature: {}  fitness: {} Check Feature declaration in 'combined_fitness'!!!".format(feature_name, value))
-        arr = np.array([p[1] for p in parts])
+        with shared_selections():
+            parts = [self._weighted(w, r, feature_name) for w, r, feature_name in self._parts(sim, measurement)]
+        arr = np.array(parts)
         if full:
             return arr
         else:
             # Calculates RMS across feature. (fitness metrics.)
             return vartype.array_rms(arr, nan_replacement=NAN_REPLACEMENT)
 
+    def evaluate_population(self, sims, measurement):
+        """The fitness parts of many simulations against one measurement
+
+        Returns an array with a row for each simulation, the same as
+        ``self(sim, measurement, full=True)``. The parts listed in
+        `per_trace` are calculated for all simulations at once: the
+        selections of the measurement are made once, and the values of the
+        simulations are put in a matrix with a column for each trace of
+        the measurement. Other parts, and simulations with a current
+        which matches more than one trace, are calculated one by one.
+        """
+        parts = [(w, func) for w, func in self.pairs if w]
+        ans = np.empty((len(sims), len(parts)))
+        if not len(sims):
+            return ans
+
+        # the traces of the measurement matched by each simulation, in
+        # the order of _select
+        pairings = [match_currents(sim.injection, measurement.injection)
+                    for sim in sims]
+        vectorized = np.array([len(np.unique(ind2)) == len(ind2)
+                               for ind1, ind2 in pairings])
+        rows = vectorized.nonzero()[0]
+        present = np.zeros((len(rows), len(measurement.injection)), dtype=bool)
+        for k, i in enumerate(rows):
+            present[k, pairings[i][1]] = True
+
+        with shared_selections():
+            for j, (w, func) in enumerate(parts):
+                spec = self.per_trace.get(func.__name__)
+                if spec is None or self.error != ErrorCalc.relative:
+                    for i, sim in enumerate(sims):
+                        r = func(sim, measurement, error=self.error)
+                        ans[i, j] = self._weighted(w, r, func.__name__)
+                    continue
+
+                attr, which = spec
+                selected = np.ones(len(measurement.injection), dtype=bool) if which is None \
+                           else np.asarray(which(measurement), dtype=bool)
+                theirs = getattr(measurement, attr)
+                theirs = np.asarray(getattr(theirs, 'x', theirs), dtype=float)
+                ours = np.full(present.shape, np.nan)
+                for k, i in enumerate(rows):
+                    ind1, ind2 = pairings[i]
+                    values = getattr(sims[i], attr)
+                    ours[k, ind2] = np.asarray(getattr(values, 'x', values), dtype=float)[ind1]
+                diff = relative_diff_single(ours, theirs)
+                diff[np.isnan(diff)] = NAN_REPLACEMENT
+                for k, i in enumerate(rows):
+                    ind2 = pairings[i][1]
+                    r = _rms(diff[k, ind2[selected[ind2]]])
+                    ans[i, j] = self._weighted(w, r, func.__name__)
+                for i in (~vectorized).nonzero()[0]:
+                    r = func(sims[i], measurement, error=self.error)
+                    ans[i, j] = self._weighted(w, r, func.__name__)
+        return ans
+
     @property
     def __name__(self):
         return self.__class__.__name__
 
+    "Parts which are the rms over traces of a feature, and the measurement traces used"
+    per_trace = {
+        'response_fitness': ('response', lambda m: m.spike_count < 1),
+        'baseline_fitness': ('baseline', None),
+        'baseline_pre_fitness': ('baseline_pre', None),
+        'baseline_post_fitness': ('baseline_post', None),
+        'rectification_fitness': ('rectification', lambda m: m.injection <= -10e-12),
+        'falling_curve_time_fitness': ('falling_curve_tau', lambda m: m.injection <= -10e-12),
+        'spike_count_fitness': ('spike_count', None),
+        'spike_latency_fitness': ('spike_latency', lambda m: m.spike_count >= 1),
+    }
+
+    def lower_bound(self, waves, measurement, partial=None):
+        """A lower bound on the fitness of a simulation which is still running
+
+        `waves` are the traces simulated so far. For those, all the parts
+        listed in `per_trace` are known exactly, but the traces still
+        missing could only add to them. `partial` is a trace which is still
+        being simulated. From it, only the parts which cannot improve as
+        the simulation goes on are used: baseline_pre, once the trace is
+        past the baseline, and spike_count, if the simulation already has
+        more spikes than the measurement. The fitness of the complete
+        simulation is not smaller than this.
+        """
+        if self.error != ErrorCalc.relative:
+            return 0.0
+        n = sum(1 for w, func in self.pairs if w)
+        if n == 0:
+            return 0.0
+
+        def matching(wave):
+            for i, other in enumerate(measurement.waves):
+                if abs(other.injection - wave.injection) < 1e-12:
+                    return i, other
+            return None, None
+
+        squares = collections.Counter()
+        for wave in waves:
+            i, other = matching(wave)
+            if other is None:
+                continue
+            for name, (attr, which) in self.per_trace.items():
+                if which is not None and not which(measurement)[i]:
+                    continue
+                diff = relative_diff_single(_scalar(getattr(wave, attr)),
+                                            _scalar(getattr(other, attr)))
+                squares[name] += NAN_REPLACEMENT**2 if np.isnan(diff) else diff**2
+
+        if partial is not None:
+            i, other = matching(partial)
+            if other is not None and not any(abs(wave.injection - partial.injection) < 1e-12
+                                             for wave in waves):
+                if partial.wave.x[-1] >= partial.baseline_before:
+                    diff = relative_diff_single(_scalar(partial.baseline_pre),
+                                                _scalar(other.baseline_pre))
+                    if not np.isnan(diff):
+                        squares['baseline_pre_fitness'] += diff**2
+                if partial.spike_count > other.spike_count:
+                    diff = relative_diff_single(_scalar(partial.spike_count),
+                                                _scalar(other.spike_count))
+                    squares['spike_count_fitness'] += diff**2
+
+        total = 0
+        for w, func in self.pairs:
+            if w and squares[func.__name__]:
+                attr, which = self.per_trace[func.__name__]
+                count = (np.count_nonzero(which(measurement)) if which is not None
+                         else len(measurement.waves))
+                # each part is the rms over all the selected measurement traces
+                total += w**2 * squares[func.__name__] / count
+        return float(total / n)**0.5
+
     def report(self, sim, measurement, *, full=False):
-        parts = [(w, NAN_REPLACEMENT if r is vartype.vartype.nan else r, name) for w, r, name in self._parts(sim, measurement, full=full)]
+        with shared_selections():
+            parts = [(w, NAN_REPLACEMENT if r is vartype.vartype.nan else r, name) for w, r, name in self._parts(sim, measurement, full=full)]
         desc = '\n'.join('{}={}*{:.2g}={:.2g}'.format(name, w, r, w*r)
                          for w, r, name in parts)
         total = desc + '\n' + 'total: {:.02g}'.format(self.__call__(sim, measurement))
@@ -568,67 +809,237 @@ def fit_sort(group, measurement, fitness):
     return np.array(group)[w.argsort()]
 
 def fit_finished(fitness, cutoff=0.01, window=10):
+    """Which fitness values end a window where the fitness hardly changes
+
+    The standard deviation over the last `window` values, relative to the
+    largest such deviation, must be below `cutoff`. fitness is a sequence
+    of values or of fitness vectors, or a DataFrame. See
+    :class:`ajustador.helpers.converge.ConvergenceMonitor` to check this
+    as the fit goes on.
+    """
     isdf = isinstance(fitness, pd.DataFrame)
-    if not isdf:
-        fitness = pd.DataFrame(fitness)
-    dev = pd.rolling_var(fitness, window) ** 0.5
-    quit = dev / dev.max() < cutoff
+    values = np.array(fitness, dtype=float)
+    values = values.reshape(len(values), -1)
+    quit = np.zeros(values.shape, dtype=bool)
+    if len(values) >= window:
+        windows = np.lib.stride_tricks.sliding_window_view(values, window, axis=0)
+        dev = windows.std(axis=-1, ddof=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            quit[window-1:] = dev / np.fmax.reduce(dev, axis=0) < cutoff
     if isdf:
-        return quit
+        return pd.DataFrame(quit, index=fitness.index, columns=fitness.columns)
     else:
-        return quit.values.flatten()
+        return quit.flatten()
 
 def find_best(group, measurement, fitness):
     w = np.array([fitness(sim, measurement) for sim in group])
     w[np.isnan(w)] = np.inf
     return group[w.argmin()]
 
-def find_multi_best(group, measurement, fitness,
-                    similarity=.10,
-                    debug=False, full=False):
-    best = np.empty(0, dtype=object)
-    scores = np.empty(0)
+def _dominated(scores, score):
+    "Which of scores are dominated by score: all of score is smaller"
+    return (score < scores).all(axis=1)
+
+def _dominates(scores, score):
+    "Which of scores dominate score"
+    return (scores < score).all(axis=1)
+
+class ParetoFront:
+    """The items whose scores are not dominated by the scores of another
 
-    for sim in group:
-        score = fitness(sim, measurement, full=1)
+    A score dominates another when all of its components are smaller.
+    Items are added one at a time, and the front is kept up to date:
 
-        # ignore misfits
+    >>> front = ParetoFront()
+    >>> for sim in fit:
+    ...     front.add(sim, fitness(sim, measurement, full=True))
+    >>> front.items, front.scores
+
+    Items with NaN scores are ignored. The items stay in the order in
+    which they were added. `seen` counts all items added.
+    """
+    def __init__(self):
+        self._items = np.empty(16, dtype=object)
+        self._scores = None
+        self.size = 0
+        self.seen = 0
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return '{}({} of {} items)'.format(self.__class__.__name__, self.size, self.seen)
+
+    @property
+    def items(self):
+        return self._items[:self.size]
+
+    @property
+    def scores(self):
+        if self._scores is None:
+            return np.empty((0, 0))
+        return self._scores[:self.size]
+
+    def add(self, item, score):
+        "Add item, return whether it is on the front"
+        self.seen += 1
+        score = np.asarray(score, dtype=float)
         if np.isnan(score).any():
-            if debug:
-                print('dropping for nans:', sim)
-            continue
-
-        for i, key in enumerate(best):
-            if (scores[i] < score).all():
-                if debug:
-                    print('dropping worse:', sim)
-                break
-
-        if scores.size:
-            dominates = (score < scores).all(axis=1)
-            if debug:
-                print('dropping', dominates.sum(), 'dominated')
-            best = np.hstack((best[-dominates], [sim]))
-            scores = np.vstack((scores[-dominates], score))
+            return False
+        if self._scores is None:
+            self._scores = np.empty((len(self._items), score.size))
+        scores = self.scores
+        if _dominates(scores, score).any():
+            return False
+        dominated = _dominated(scores, score)
+        if dominated.any():
+            keep = ~dominated
+            n = np.count_nonzero(keep)
+            self._items[:n] = self._items[:self.size][keep]
+            self._scores[:n] = scores[keep]
+            self._items[n:self.size] = None
+            self.size = n
+        if self.size == len(self._items):
+            # grow by doubling, so adding is amortized constant time
+            self._items = np.hstack((self._items, np.empty(self.size, dtype=object)))
+            self._scores = np.vstack((self._scores, np.empty_like(self._scores)))
+        self._items[self.size] = item
+        self._scores[self.size] = score
+        self.size += 1
+        return True
+
+    def update(self, items, scores):
+        for item, score in zip(items, scores):
+            self.add(item, score)
+
+    def crowding(self):
+        "The crowding distance of the items on the front"
+        return crowding_distance(self.scores)
+
+def pareto_ranks(scores):
+    """The non-domination rank of each of scores
+
+    Scores which are not dominated by any other have rank 0, those only
+    dominated by scores of rank 0 rank 1, and so on. Scores with NaNs
+    get the rank -1.
+    """
+    scores = np.asarray(scores, dtype=float)
+    ranks = np.full(len(scores), -1)
+    valid = ~np.isnan(scores).any(axis=1)
+    # a dominating score has a smaller sum, so going in the order of the
+    # sums, a score can only be dominated by the ones before it
+    remaining = valid.nonzero()[0]
+    remaining = remaining[scores[remaining].sum(axis=1).argsort(kind='stable')]
+    rank = 0
+    while remaining.size:
+        front = np.empty(remaining.size, dtype=int)
+        n = 0
+        later = np.zeros(remaining.size, dtype=bool)
+        for k, i in enumerate(remaining):
+            if _dominates(scores[front[:n]], scores[i]).any():
+                later[k] = True
+            else:
+                front[n] = i
+                n += 1
+        ranks[front[:n]] = rank
+        remaining = remaining[later]
+        rank += 1
+    return ranks
+
+def crowding_distance(scores):
+    """The crowding distance of each of scores, from one front
+
+    The sum over the components of the distance between the neighbours on
+    either side, relative to the range of the component. The extremes of
+    each component get an infinite distance.
+    """
+    scores = np.asarray(scores, dtype=float)
+    n = len(scores)
+    distance = np.zeros(n)
+    if n < 3:
+        distance[:] = np.inf
+        return distance
+    for column in scores.T:
+        order = column.argsort(kind='stable')
+        values = column[order]
+        span = values[-1] - values[0]
+        distance[order[[0, -1]]] = np.inf
+        if span > 0:
+            distance[order[1:-1]] += (values[2:] - values[:-2]) / span
+    return distance
+
+def _prune_similar(scores, similarity):
+    """Which of scores are close to a score with a smaller total
+
+    A score is dropped when the squared distance to one with a smaller
+    sum of squares is below that sum of squares times similarity. The
+    candidates are found with a KD-tree. scores must be sorted by the
+    sum of squares.
+    """
+    from scipy import spatial
 
-        else:
-            best = np.hstack([sim])
-            scores = score[None, :]
+    total = (scores ** 2).sum(axis=1)
+    worse = np.zeros(len(scores), dtype=bool)
+    if len(scores) < 2:
+        return worse
+    tree = spatial.cKDTree(scores)
+    # a little more, the distances are checked again below
+    radius = np.sqrt(total * similarity) * (1 + 1e-9)
+    for i, near in enumerate(tree.query_ball_point(scores, radius, return_sorted=False)):
+        near = np.array(near, dtype=int)
+        near = near[near < i]
+        if near.size:
+            worse[i] = (((scores[i] - scores[near]) ** 2).sum(axis=1) < total[i] * similarity).any()
+    return worse
+
+def _score_all(group, measurement, fitness, chunk=256):
+    "The full fitness of each of group, by generations if possible"
+    evaluate = getattr(fitness, 'evaluate_population', None)
+    if evaluate is None:
+        for sim in group:
+            yield sim, fitness(sim, measurement, full=1)
+        return
+    group = list(group)
+    for start in range(0, len(group), chunk):
+        sims = group[start:start + chunk]
+        yield from zip(sims, evaluate(sims, measurement))
+
+def find_multi_best(group, measurement, fitness,
+                    similarity=.10,
+                    debug=False, full=False, front=None):
+    """The simulations of group on the Pareto front of the fitness parts
+
+    Simulations are dropped when another one is better in all parts of
+    the fitness, and with `similarity`, when their parts are close to
+    those of one with a smaller total fitness (see :func:`_prune_similar`).
 
-    if similarity:
+    `front` is a :class:`ParetoFront` which is kept between calls for a
+    growing group, e.g. a fit: only the simulations added to the group
+    since the last call are evaluated.
+    """
+    if front is None:
+        front = ParetoFront()
+    new = group[front.seen:]
+    for sim, score in _score_all(new, measurement, fitness):
+        if not front.add(sim, score) and debug:
+            # misfits are ignored too
+            print('dropping for nans:' if np.isnan(score).any() else 'dropping worse:', sim)
+
+    best = front.items.copy()
+    scores = front.scores.copy()
+
+    if similarity and best.size:
         # sort by rms
         total = (scores ** 2).sum(axis=1)
         order = total.argsort()
         best = best[order]
         scores = scores[order]
-        worse = np.empty_like(best, dtype=bool)
-
-        for i in reversed(range(best.size)):
-            similar = scores[i] - scores[:i]
-            worse[i] = ((similar ** 2).sum(axis=1) < total[i] * similarity).any()
+        worse = _prune_similar(scores, similarity)
+        if debug:
+            print('dropping', worse.sum(), 'similar')
 
-        scores = scores[-worse]
-        best = best[-worse]
+        scores = scores[~worse]
+        best = best[~worse]
 
     if full:
         return best, scores
@@ -639,12 +1050,29 @@ def normalize_dimensions(vect):
     mean = np.mean(vect, axis=0)
     radius = np.ptp(vect, axis=0) / 2
     trivial = radius == 0 # ignore non-variable parameters
-    return ((vect - mean) / radius).T[-trivial].T
+    return ((vect[:, ~trivial] - mean[~trivial]) / radius[~trivial])
+
+def _near(tree, points, i, similarity):
+    "The indices of points after i which are closer than similarity to point i"
+    # a little more, the distances are checked again below
+    near = np.array(tree.query_ball_point(points[i], similarity * (1 + 1e-9),
+                                          return_sorted=False), dtype=int)
+    near = near[near > i]
+    diff = ((points[near] - points[i])**2).sum(axis=1)**0.5
+    return near[diff < similarity]
 
 find_nonsimilar_result = collections.namedtuple('find_nonsimilar_result', 'group scores params')
 
 def find_nonsimilar(group, measurement, fitness,
                     similarity=.10):
+    """The simulations of group whose parameters are not similar to those of
+    a simulation with a better fitness
+
+    The parameters are normalized to [-1, 1], and the simulations within
+    `similarity` of one which is kept are dropped. See
+    :class:`NonSimilarSet` to keep such a set during a fit.
+    """
+    from scipy import spatial
     from . import analysis
 
     what = group[0].params.keys()
@@ -653,20 +1081,164 @@ def find_nonsimilar(group, measurement, fitness,
     scores = np.array(scores)
     scores[np.isnan(scores)] = np.inf
 
+    # sort by rms
     total = (scores ** 2).sum(axis=1)
-    order = total.argsort()
+    order = total.argsort(kind='stable')
     group = group[order]
     scores = scores[order]
     params = params[order]
 
     normalized = normalize_dimensions(params)
+    tree = spatial.cKDTree(normalized)
 
-    # sort by rms
     duplicate = np.zeros_like(group, dtype=bool)
 
     for i in range(group.size - 1):
         if not duplicate[i]: # ignore the ones already ignored
-            diff = ((normalized[i + 1:] - normalized[i])**2).sum(axis=1)**0.5
-            duplicate[i + 1:] |= diff < similarity
+            duplicate[_near(tree, normalized, i, similarity)] = True
+
+    return find_nonsimilar_result(group[~duplicate], scores[~duplicate], params[~duplicate])
+
+class _PointIndex:
+    """A growing set of points, with radius queries
 
-    return find_nonsimilar_result(group[-duplicate], scores[-duplicate], params[-duplicate])
+    The points are kept in KD-trees of doubling sizes, and the newest
+    points in a buffer which is searched directly. Adding a point is
+    amortized O(log² n), and a query searches O(log n) trees.
+    """
+    def __init__(self, dimensions, buffer=64):
+        self.points = np.empty((16, dimensions))
+        self.size = 0
+        self.buffer = buffer
+        # (start, stop, tree) for consecutive ranges of points
+        self._trees = []
+
+    def add(self, point):
+        "Add a point, return its index"
+        from scipy import spatial
+
+        if self.size == len(self.points):
+            self.points = np.vstack((self.points, np.empty_like(self.points)))
+        self.points[self.size] = point
+        self.size += 1
+        start = self._trees[-1][1] if self._trees else 0
+        if self.size - start >= self.buffer:
+            # merge the trees of the same size, like a binary counter
+            while self._trees and self._trees[-1][1] - self._trees[-1][0] <= self.size - start:
+                start = self._trees.pop()[0]
+            self._trees.append((start, self.size,
+                                spatial.cKDTree(self.points[start:self.size])))
+        return self.size - 1
+
+    def near(self, point, radius):
+        "The indices of the points closer than radius to point"
+        found = [start + np.array(tree.query_ball_point(point, radius * (1 + 1e-9),
+                                                        return_sorted=False), dtype=int)
+                 for start, stop, tree in self._trees]
+        start = self._trees[-1][1] if self._trees else 0
+        found.append(np.arange(start, self.size))
+        near = np.concatenate(found)
+        diff = ((self.points[near] - point)**2).sum(axis=1)**0.5
+        return near[diff < radius]
+
+class NonSimilarSet:
+    """The items whose parameters are not similar to those of a better item
+
+    Like :func:`find_nonsimilar`, but kept up to date as items are added
+    one by one, e.g. during a fit:
+
+    >>> nonsimilar = NonSimilarSet(fit.params.scaled_bounds)
+    >>> fit = optimize.Fit(..., nonsimilar=nonsimilar)
+    >>> fit.do_fit(...)
+    >>> nonsimilar.items
+
+    Items are ordered by their fitness, lower is better. An item is kept
+    when no kept item with a better fitness is closer than `similarity`
+    to it. The parameters are normalized to [-1, 1] using `bounds`, a pair
+    of lower and upper bounds, since the range of the values changes as
+    they are added. Parameters with equal bounds are ignored.
+
+    When an item is kept, items which it is close to might be dropped,
+    and in turn items close to those might be kept again. Only the items
+    near the changed ones are checked, using a spatial index of all items.
+
+    With `lookup`, the items which are added are keys, and :attr:`items`
+    returns `lookup(key)` for each. :class:`optimize.Fit` adds the keys
+    of its history, so that the simulations are not kept in memory here.
+    """
+    def __init__(self, bounds, similarity=.10, lookup=None):
+        lower, upper = bounds
+        if any(value is None for value in (*lower, *upper)):
+            raise ValueError('bounds are needed for all parameters')
+        lower = np.asarray(lower, dtype=float)
+        upper = np.asarray(upper, dtype=float)
+        self._used = upper != lower
+        self._center = ((upper + lower) / 2)[self._used]
+        self._radius = ((upper - lower) / 2)[self._used]
+        self.similarity = similarity
+        self.lookup = lookup
+        self._index = _PointIndex(np.count_nonzero(self._used))
+        self._items = []
+        self._params = []
+        self._fitness = []
+        self._kept = []
+
+    def __len__(self):
+        return sum(self._kept)
+
+    def __repr__(self):
+        return '{}({} of {} items)'.format(self.__class__.__name__, len(self), len(self._items))
+
+    def add(self, item, params, fitness):
+        "Add an item with its parameter values and fitness"
+        params = np.asarray(params, dtype=float)
+        fitness = float(fitness)
+        if np.isnan(fitness):
+            fitness = np.inf
+        i = self._index.add((params[self._used] - self._center) / self._radius)
+        self._items.append(item)
+        self._params.append(params)
+        self._fitness.append(fitness)
+        self._kept.append(False)
+        self._settle(i)
+
+    def _better(self, j, i):
+        return (self._fitness[j], j) < (self._fitness[i], i)
+
+    def _settle(self, i):
+        # the items are checked in the order of their fitness, so the
+        # better items are settled first, like in find_nonsimilar
+        queue = [((self._fitness[i], i), i)]
+        queued = {i}
+        while queue:
+            key, i = heapq.heappop(queue)
+            queued.discard(i)
+            near = self._index.near(self._index.points[i], self.similarity)
+            kept = not any(self._kept[j] and self._better(j, i) for j in near)
+            if kept == self._kept[i]:
+                continue
+            self._kept[i] = kept
+            for j in near:
+                if self._better(i, j) and j not in queued:
+                    heapq.heappush(queue, ((self._fitness[j], j), j))
+                    queued.add(j)
+
+    def _order(self):
+        kept = [i for i, kept in enumerate(self._kept) if kept]
+        return sorted(kept, key=lambda i: (self._fitness[i], i))
+
+    @property
+    def items(self):
+        "The items which are kept, best first"
+        items = [self._items[i] for i in self._order()]
+        if self.lookup is not None:
+            return [self.lookup(key) for key in items]
+        return items
+
+    @property
+    def params(self):
+        return np.array([self._params[i] for i in self._order()])
+
+    @property
+    def fitness(self):
+        return np.array([self._fitness[i] for i in self._order()])
@@ -37,37 +37,178 @@ def converge_dict(fit_values,test_size,popsiz):
             std_dict={'mean':stdev,'std':np.zeros(len(stdev)),'slope':np.zeros(len(stdev))}
     return mean_dict,std_dict,CV
 
+class _LineStats:
+    """The running mean, standard deviation and least-squares slope of
+    values added one at a time, at x = 0, 1, 2, ...
+
+    The same as np.mean, np.std and the slope of a line fitted with
+    curve_fit, but updated in constant time for each value.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0          # the sum of squared deviations of the values
+        self._cxy = 0.0         # the sum of the products of deviations
+
+    def add(self, y):
+        x = self.n
+        self.n += 1
+        # the deviation of x from the mean of the earlier x, (x - 1) / 2
+        dx = x - (x - 1) / 2
+        dy = y - self.mean
+        self.mean += dy / self.n
+        self._m2 += dy * (y - self.mean)
+        self._cxy += dx * (y - self.mean)
+
+    @property
+    def std(self):
+        return (self._m2 / self.n)**0.5 if self.n else np.nan
+
+    @property
+    def slope(self):
+        # the sum of squared deviations of 0, 1, ..., n-1
+        m2x = (self.n**3 - self.n) / 12
+        return self._cxy / m2x if m2x else 0.0
+
+class ConvergenceMonitor:
+    """Decide whether a fit has converged, from the fitness values as they come
+
+    The values are grouped in generations of `popsize`, and the means and
+    standard deviations of the generations in windows of `test_size`
+    generations. For each window, the mean, standard deviation and slope
+    of the generation means and of the generation standard deviations are
+    calculated. The fit is converged when the generation means in the
+    last window have a slope below `slope_crit` and a standard deviation
+    below `std_crit`. With `filename`, a line is written for each window.
+
+    All statistics are updated for each value, without going over the
+    earlier values:
+
+    >>> monitor = ConvergenceMonitor(popsize=8, test_size=25)
+    >>> fit = optimize.Fit(..., convergence=monitor)
+    >>> fit.do_fit(1000, popsize=8)   # stops when converged
+    """
+    keys = ('mean', 'std', 'slope')
+
+    def __init__(self, popsize, test_size, slope_crit=2e-3, std_crit=0.06,
+                 filename=None, name=None):
+        self.popsize = popsize
+        self.test_size = max(test_size, 1)
+        self.slope_crit = slope_crit
+        self.std_crit = std_crit
+        self.filename = filename
+        self.evaluations = 0
+        # the mean and standard deviation of each generation
+        self.generation_means = []
+        self.generation_stds = []
+        # the statistics of each window, of the generation means and of
+        # the generation standard deviations
+        self.windows = {'mean': [], 'std': []}
+        self.converged = False
+        # the number of generations at the end of the last window
+        self.checked = 0
+        self._generation = _LineStats()
+        self._means = _LineStats()
+        self._stds = _LineStats()
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write("data name: "+str(name)+"  test_size: "+str(test_size)+"\n")
+                f.write("iter mean_mean std_mean slope_mean mean_std std_std slope_std \n")
+
+    def __repr__(self):
+        return '{}(popsize={}, test_size={}, {} generations, converged={})'.format(
+            self.__class__.__name__, self.popsize, self.test_size,
+            self.generations, self.converged)
+
+    @property
+    def generations(self):
+        "The number of complete generations"
+        return len(self.generation_means)
+
+    def add(self, fitness):
+        "Add the fitness of one simulation"
+        self.evaluations += 1
+        self._generation.add(float(fitness))
+        if self._generation.n == self.popsize:
+            self._add_generation(self._generation.mean, self._generation.std)
+            self._generation = _LineStats()
+
+    def extend(self, fitnesses):
+        for fitness in fitnesses:
+            self.add(fitness)
+
+    def _add_generation(self, mean, std):
+        self.generation_means.append(mean)
+        self.generation_stds.append(std)
+        self._means.add(mean)
+        self._stds.add(std)
+        if self._means.n == self.test_size:
+            for key, stats in (('mean', self._means), ('std', self._stds)):
+                self.windows[key].append((stats.mean, stats.std, stats.slope))
+            self.converged = bool(abs(self._means.slope) < self.slope_crit
+                                  and self._means.std < self.std_crit)
+            self.checked = self.generations
+            self._means, self._stds = _LineStats(), _LineStats()
+            if self.filename is not None:
+                self._write(len(self.windows['mean']) - 1)
+
+    def _write(self, j):
+        line = str(j)+'  '
+        for key in ('mean', 'std'):
+            for value in self.windows[key][j]:
+                line = line+'   '+str(np.round(value, 5))
+        with open(self.filename, 'a') as f:
+            f.write(line+'\n')
+
+    def converged_since(self, generations):
+        "Whether the fit converged in a window which ended after `generations`"
+        return self.converged and self.checked > generations
+
+    def window_dict(self, which='mean'):
+        """The statistics of the windows, like :func:`calc_mean_slopes`
+
+        Returns a dictionary of arrays with the mean, std and slope in each
+        window of the generation means, or with `which='std'`, of the
+        generation standard deviations.
+        """
+        values = np.array(self.windows[which]).reshape(-1, len(self.keys))
+        return {key:values[:, i] for i, key in enumerate(self.keys)}
+
+    @property
+    def CV(self):
+        "The coefficient of variation of each generation"
+        return np.array(self.generation_stds) / np.array(self.generation_means)
+
 def iterate_fit(fitX,test_size,popsiz,slope_crit=2e-3, std_crit=0.06,max_evals=5000):
     # 0.04 criteria looked better for GPE, even .02; Might need as many as 10000 evals
     #
-    converge=False
-    last_j=0
     print('iterate_fit.py: len of fitness',len(fitX))
-    with open("convergence.dat","w") as fitfile:
-        fitfile.write("data name: "+str(fitX.name)+"  test_size: "+str(test_size)+"\n")
-        fitfile.write("iter mean_mean std_mean slope_mean mean_std std_std slope_std \n")
-        #calculation mean_dict, print to file, e.g. call print_dict(fitfile,conv_dict,last_j,slope_crit,std_crit,test_size,popsiz)
-        while not converge and len(fitX) < max_evals:
-            #print('in while loop', converge,len(fitX),test_size,'optimizer.stop',fitX.optimizer.stop())
-            fitX.do_fit(test_size, popsize=popsiz,seed=last_j*last_j)  #OPTIMIZE FOR ANOTHER TEST_SIZE GENERATIONS
-            # calculate mean and std of the fitness values
-            mean_dict, std_dict, CV = converge_dict(fitX._history, test_size, popsiz)
-            for j in range(last_j,len(mean_dict['mean'])):
-                #print('in j loop',j,mean_dict['mean'])
-                line=str(j)+'  '   #write the latest fitness values to the file
-                for key in mean_dict.keys():
-                        line=line+'   '+str(np.round(mean_dict[key][j],5))
-                for key in std_dict.keys():
-                        line=line+'   '+str(np.round(std_dict[key][j],5))
-                fitfile.write(line+'\n')
-                #possibly divide both by mean_dict['mean'] (may need to 2x or 3x the criteria) so that convergence scales with fit?
-                if np.abs(mean_dict['slope'][j])<slope_crit and mean_dict['std'][j]<std_crit:
-                        converge=True                    #above tests the latest fitness value for convergence
-                        print('*************** optimization converged at', j*test_size*popsiz, 'with m=',mean_dict['mean'][j] )
-                else:
-                        converge=False
-                        print('**************  optimization NOT converged', j*test_size*popsiz,'m=',mean_dict['mean'][j])
-            last_j=j+1
-            #print('last_j',j,'new range', list(range(last_j,last_j+1)))
+    monitor = getattr(fitX, 'convergence', None)
+    if (monitor is None or (monitor.popsize, monitor.test_size) != (popsiz, max(test_size, 1))
+        or (monitor.slope_crit, monitor.std_crit) != (slope_crit, std_crit)):
+        # the history of earlier calls is added once, after that the
+        # monitor is fed by fitX as the simulations are evaluated
+        monitor = ConvergenceMonitor(popsiz, test_size, slope_crit=slope_crit, std_crit=std_crit,
+                                     filename="convergence.dat", name=fitX.name)
+        monitor.extend(fitness for fitness in fitX._history if np.ndim(fitness) == 0)
+        fitX.convergence = monitor
+    converge=False
+    last_j=len(monitor.windows['mean'])
+    while not converge and len(fitX) < max_evals:
+        fitX.do_fit(test_size, popsize=popsiz,seed=last_j*last_j)  #OPTIMIZE FOR ANOTHER TEST_SIZE GENERATIONS
+        mean_dict = monitor.window_dict('mean')
+        for j in range(last_j,len(mean_dict['mean'])):
+            #possibly divide both by mean_dict['mean'] (may need to 2x or 3x the criteria) so that convergence scales with fit?
+            if np.abs(mean_dict['slope'][j])<slope_crit and mean_dict['std'][j]<std_crit:
+                print('*************** optimization converged at', j*test_size*popsiz, 'with m=',mean_dict['mean'][j] )
+            else:
+                print('**************  optimization NOT converged', j*test_size*popsiz,'m=',mean_dict['mean'][j])
+        last_j=len(mean_dict['mean'])
+        converge=monitor.converged
+        if fitX.optimizer.stop():
+            # no more generations would be run
+            print('**************  optimizer stopped', fitX.optimizer.stop())
+            break
+    mean_dict, std_dict = monitor.window_dict('mean'), monitor.window_dict('std')
     print('end of iterate_fit.py', fitX.name, 'len of fitness',len(fitX), 'last_j', last_j,'len(mean_dict)',len(mean_dict['mean']))
-    return mean_dict,std_dict,CV
+    return mean_dict,std_dict,monitor.CV
@@ -17,7 +17,7 @@ import numpy as np
 from numpy.lib import recfunctions
 from igor import binarywave
 
-from . import utilities
+from . import utilities, cache as _cache
 from .vartype import vartype
 
 Fileinfo = namedtuple('fileinfo', 'group ident experiment protocol number extra')
@@ -41,11 +41,71 @@ def _calculate_current(fileinfo, IV, IF):
         assert tulength==2 or tulength==3
         #tulength == 3 refers to NEW data files with 3 variables including trace number (usually 3 or 4) in tuple IV
 
+timebase = namedtuple('timebase', 'start stop num endpoint')
+timebase.__doc__ = """A uniform time axis, the same as np.linspace(start, stop, num, endpoint=endpoint)"""
+
+@functools.lru_cache(maxsize=64)
+def _time_axis(base):
+    x = np.linspace(base.start, base.stop, base.num, endpoint=base.endpoint)
+    # shared between all waves with this time base
+    x.flags.writeable = False
+    return x
+
+class UniformWave(object):
+    """A uniformly sampled wave
+
+    Only the y values and the time base are stored. The x values are
+    calculated on first use, and the array is shared by all waves with
+    the same time base. Otherwise this behaves like the record array with
+    x and y fields used for other traces: indexing returns records.
+    """
+    def __init__(self, base, y):
+        self.base = timebase(*base)
+        self.y = np.ascontiguousarray(y)
+        if self.y.shape != (self.base.num,):
+            raise ValueError('y has {} values, the time base {}'.format(
+                self.y.size, self.base.num))
+
+    def __repr__(self):
+        return '{}({}, dtype={})'.format(self.__class__.__name__, self.base, self.y.dtype)
+
+    @property
+    def x(self):
+        return _time_axis(self.base)
+
+    @property
+    def dt(self):
+        return ((self.base.stop - self.base.start) /
+                (self.base.num - (1 if self.base.endpoint else 0)))
+
+    @property
+    def size(self):
+        return self.y.size
+
+    @property
+    def shape(self):
+        return self.y.shape
+
+    def __len__(self):
+        return self.y.size
+
+    def __getitem__(self, index):
+        x, y = self.x[index], self.y[index]
+        if np.ndim(y) == 0:
+            return np.rec.fromarrays(([x], [y]), names='x,y')[0]
+        return np.rec.fromarrays((x, y), names='x,y')
+
+    def __iter__(self):
+        return iter(self[:])
+
 class Trace(object):
     def __init__(self, injection, x, y, features):
         self.injection = injection
 
-        self.wave = np.rec.fromarrays((x, y), names='x,y')
+        if isinstance(x, timebase):
+            self.wave = UniformWave(x, y)
+        else:
+            self.wave = np.rec.fromarrays((x, y), names='x,y')
 
         self._attributes = {'wave':self,
                             'injection':self}
@@ -76,6 +136,19 @@ class Trace(object):
     def time(self):
         return self.wave.x[-1]
 
+    def precompute(self):
+        """Calculate all features now
+
+        Features are normally calculated lazily on first access. This is
+        useful before pickling, so the receiver does not need to redo it.
+        Features which cannot be calculated for this trace are skipped.
+        """
+        for name in self._attributes:
+            try:
+                getattr(self, name)
+            except Exception:
+                pass
+
 
 class IVCurve(Trace):
     """
@@ -90,7 +163,7 @@ class IVCurve(Trace):
     >>> wave.time
     0.89990000000000003
     >>> type(wave.wave)
-    <class 'numpy.recarray'>
+    <class 'ajustador.loader.UniformWave'>
     >>> wave.wave.x
     array([  0.00000000e+00,   1.00000000e-04,   2.00000000e-04, ...,
              8.99700000e-01,   8.99800000e-01,   8.99900000e-01])
@@ -117,7 +190,7 @@ class IVCurve(Trace):
         numpts=binarywave.load(path)['wave']['wave_header']['npnts']
         tot_time=dt*numpts
         #time = np.linspace(0, endtime, num=data.size, endpoint=False)
-        time = np.linspace(0, tot_time, num=numpts, endpoint=False)
+        time = timebase(0, tot_time, numpts, False)
         #optionally shorten the data
         #if endtime<tot_time:
         #    end_index=np.abs(time-endtime).argmin()
@@ -152,38 +225,247 @@ class Attributable(object):
             raise AttributeError(attr)
 
         if not attr.startswith('_') and attr in getattr(self, '_array_attributes', {}):
-            arr = [getattr(wave, attr) for wave in self.waves]
-            if not arr:
-                return np.empty(0)
-            if isinstance(arr[0], vartype):
-                return vartype.array(arr)
-            if isinstance(arr[0], np.recarray):
-                return recfunctions.stack_arrays(arr, asrecarray=True, usemask=False)
-            if isinstance(arr[0], np.ndarray):
-                return np.hstack(arr)
-            return np.array(arr)
+            try:
+                return self.__dict__['_aggregates'][attr][0]
+            except KeyError:
+                pass
+            summary = self._summary()
+            source = self.__dict__.get('_source')
+            if summary and attr in summary:
+                # saved values, the traces are not needed
+                values = summary[attr]
+            elif source is not None:
+                # a part, see _part_aggregate
+                return self._remember(attr, *self._part_aggregate(source, attr))
+            else:
+                waves = self.waves
+                if len(waves) > 1:
+                    from . import features
+                    features.compute_batch(waves, attr)
+                values = [getattr(wave, attr) for wave in waves]
+            # arrays are stacked, other values give one element per wave
+            per_wave = not (values and isinstance(values[0], np.ndarray))
+            return self._remember(attr, self._aggregate(values), per_wave)
 
         if attr.startswith('mean_') and attr[5:] in getattr(self, '_mean_attributes', {}):
+            try:
+                return self.__dict__['_aggregates'][attr][0]
+            except KeyError:
+                pass
             values = self.__getattr__(attr[5:])
-            return vartype.average(values)
+            return self._remember(attr, vartype.average(values), False)
 
         raise AttributeError('{} object does not have {} attribute'.format(
             self.__class__.__name__, attr))
 
+    def __setattr__(self, name, value):
+        if name in self._aggregated_from:
+            self.__dict__.pop('_aggregates', None)
+        super().__setattr__(name, value)
+
+    def __delattr__(self, name):
+        if name in self._aggregated_from:
+            self.__dict__.pop('_aggregates', None)
+        super().__delattr__(name)
+
+    # the attributes which the aggregated values depend on
+    _aggregated_from = frozenset(('waves', '_waves_value', '_selections', 'summary'))
+
+    def _part_aggregate(self, source, attr):
+        """The value of attr for this part of source, and whether it is per wave
+
+        It is taken from the value for all waves of source, if that is
+        known, otherwise it is calculated for the waves of this part and
+        kept by source, for the other parts with the same waves.
+        """
+        aggregates = source.__dict__.get('_aggregates', {})
+        rows = self._rows()
+        try:
+            value, per_wave = aggregates[attr]
+        except KeyError:
+            pass
+        else:
+            if per_wave:
+                return value[rows], True
+        key = attr, rows.tobytes()
+        try:
+            return aggregates[key]
+        except KeyError:
+            pass
+        waves = self.waves
+        if len(waves) > 1:
+            from . import features
+            features.compute_batch(waves, attr)
+        values = [getattr(wave, attr) for wave in waves]
+        per_wave = not (values and isinstance(values[0], np.ndarray))
+        source._remember(key, self._aggregate(values), per_wave)
+        return source.__dict__['_aggregates'][key]
+
+    def per_wave(self, name, calculate):
+        """The value `calculate(waves)` with an element or row for each wave
+
+        It is calculated once for all waves of the measurement this part
+        was selected from, and remembered under `name` like the aggregated
+        attributes, so that all parts share it.
+        """
+        try:
+            return self.__dict__['_aggregates'][name][0]
+        except KeyError:
+            pass
+        source = self.__dict__.get('_source')
+        if source is not None:
+            value = source.per_wave(name, calculate)[self._rows()]
+        else:
+            value = calculate(self.waves)
+        return self._remember(name, value, True)
+
+    def _rows(self):
+        "The indices of the waves of this part in the waves of its source"
+        rows = np.arange(len(self.__dict__['_source']))
+        for index in self._selections:
+            rows = rows[index]
+        return rows
+
+    def _remember(self, attr, value, per_wave):
+        """Keep the aggregated value of attr until the waves are changed
+
+        Arrays are made read-only, since they are shared by all users.
+        """
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+        self.__dict__.setdefault('_aggregates', {})[attr] = value, per_wave
+        return value
+
+    @staticmethod
+    def _aggregate(arr):
+        "Combine the values of an array attribute for all waves"
+        if not arr:
+            return np.empty(0)
+        if isinstance(arr[0], vartype):
+            return vartype.array(arr)
+        if isinstance(arr[0], np.recarray):
+            return recfunctions.stack_arrays(arr, asrecarray=True, usemask=False)
+        if isinstance(arr[0], np.ndarray):
+            return np.hstack(arr)
+        return np.array(arr)
+
+    def precompute(self):
+        "Calculate all features of all waves, see :meth:`Trace.precompute`"
+        from . import features
+        features.compute_batch(self.waves)
+        for wave in self.waves:
+            wave.precompute()
+
     def __getitem__(self, index):
         if isinstance(index, (slice, np.ndarray, list)):
             c = copy.copy(self)
-            c.waves = self.waves[index]
+            summary = self._summary()
+            if summary:
+                which = np.arange(len(next(iter(summary.values()))))[index]
+                c.summary = {name: [values[i] for i in which]
+                             for name, values in summary.items()}
+            c._select_waves(index, self)
+            # values with one element per wave are selected the same way
+            c.__dict__.pop('_aggregates', None)
+            for attr, (value, per_wave) in self.__dict__.get('_aggregates', {}).items():
+                # values of parts (see _part_aggregate) have a tuple key
+                if per_wave and isinstance(attr, str):
+                    c._remember(attr, value[np.arange(len(value))[index]], True)
             return c
         else:
             return self.waves[index]
 
+    def _select_waves(self, index, parent):
+        # the waves and the aggregated values of a part are taken from the
+        # measurement all parts were taken from, so they are only loaded
+        # and calculated once
+        self.__dict__.setdefault('_source', parent)
+        self._selections = getattr(self, '_selections', ()) + (index,)
+        if '_waves_value' in self.__dict__ or not hasattr(self, '_waves'):
+            self.waves = self.waves[index]
+        # otherwise applied by _selected when the waves are loaded
+
+    def _selected(self, load):
+        "The waves returned by load(), or those of the source, selected"
+        source = self.__dict__.get('_source')
+        waves = source.waves if source is not None else load()
+        for index in getattr(self, '_selections', ()):
+            waves = waves[index]
+        return waves
+
+    def _summary(self):
+        "The values of array attributes to use instead of the waves, or None"
+        return self.__dict__.get('summary')
+
     def __len__(self):
+        summary = self._summary()
+        if summary:
+            return len(next(iter(summary.values())))
         return len(self.waves)
 
 
+def _compact(value, max_size=1024):
+    "Whether value is small and does not refer to a trace"
+    if value is None or isinstance(value, (int, float, str, np.number, vartype)):
+        return True
+    return (isinstance(value, np.ndarray) and not value.dtype.hasobject
+            and value.size <= max_size)
+
+def feature_summary(waves, names, calculate=False):
+    """The values of the array attributes `names` for each of the waves
+
+    Returns a dictionary of lists, one value for each wave, which can be
+    set as the `summary` of an :class:`Attributable` to be used instead of
+    the waves. Only values which are small and do not refer to the traces
+    are included. With `calculate`, missing values are calculated,
+    otherwise only those which were already calculated are included.
+    Attributes which cannot be calculated for all waves are left out.
+    """
+    if calculate and len(waves) > 1:
+        from . import features
+        features.compute_batch(waves)
+    summary = {}
+    for name in names:
+        values = []
+        for wave in waves:
+            obj = wave._attributes.get(name)
+            attr = '_{}_value'.format(name)
+            if obj is wave or (calculate and obj is not None):
+                try:
+                    value = getattr(wave, name)
+                except Exception:
+                    break
+            elif obj is not None and attr in obj.__dict__:
+                value = obj.__dict__[attr]
+            else:
+                break
+            if not _compact(value):
+                break
+            values.append(value)
+        else:
+            summary[name] = values
+    return summary
+
+
+def _feature_settings(features):
+    "The names and the simple class attributes of the features"
+    simple = (int, float, str, bool, tuple, list, dict, type(None), np.number)
+    return [(feature.__module__, feature.__qualname__,
+             sorted((name, repr(getattr(feature, name)))
+                    for name in dir(feature)
+                    if not name.startswith('_') and isinstance(getattr(feature, name), simple)))
+            for feature in features]
+
 class Measurement(Attributable):
-    def __init__(self, dirname, params, *, features=None):
+    def __init__(self, dirname, params, *, features=None, cache=None):
+        """Load the recordings in `dirname`
+
+        With a `cache` (an :class:`ajustador.cache.SimulationCache`, or
+        the name of a directory for one), the values of all features are
+        calculated once and stored there, under a hash of the recordings
+        and of the settings of the features. Later they are taken from the
+        cache, and the recordings are only loaded if the traces are used.
+        """
         if features is None:
             from . import features as _features
             features = _features.standard_features
@@ -193,10 +475,16 @@ class Measurement(Attributable):
         self.dirname = dirname
         self.name = os.path.basename(dirname).split('.', 1)[0]
         self.features = (params, *features)
+        if isinstance(cache, str):
+            cache = _cache.SimulationCache(cache)
+        self.cache = cache
 
     @property
     @utilities.once
     def waves(self):
+        return self._selected(self._sorted_waves)
+
+    def _sorted_waves(self):
         waves = np.array(self._waves())
         order = np.argsort([wave.injection for wave in waves])
         return waves[order]
@@ -205,6 +493,39 @@ class Measurement(Attributable):
     def waves(self, value):
         self._waves_value = value
 
+    def _summary(self):
+        if 'summary' not in self.__dict__ and getattr(self, 'cache', None) is not None:
+            self.summary = self._cached_summary()
+        return self.__dict__.get('summary')
+
+    def _recordings(self):
+        "The files the waves are loaded from"
+        if os.path.isdir(self.dirname):
+            return sorted(os.path.join(self.dirname, name)
+                          for name in os.listdir(self.dirname))
+        return [self.dirname]
+
+    def _load_settings(self):
+        "What determines the waves, apart from the recordings"
+        return ()
+
+    def _cache_key(self):
+        parts = [self.__class__.__name__,
+                 _feature_settings(self.features),
+                 self._load_settings()]
+        for path in self._recordings():
+            with open(path, 'rb') as f:
+                parts.extend((os.path.basename(path), f.read()))
+        return self.cache.key('measurement', *parts)
+
+    def _cached_summary(self):
+        key = self._cache_key()
+        summary = self.cache.load_pickle(key)
+        if summary is None:
+            summary = feature_summary(self.waves, self._array_attributes, calculate=True)
+            self.cache.save_pickle(key, summary)
+        return summary
+
     def __lt__(self, other):
         try:
             return self.name < other.name
@@ -236,12 +557,16 @@ class IVCurveSeries(Measurement):
     >>> depol.injection
     array([  2.20000000e-10,   3.20000000e-10])
     """
-    def __init__(self, dirname, params, *, IV, IF, time, bad_extra=(), features=None):
-        super().__init__(dirname, params, features=features)
+    def __init__(self, dirname, params, *, IV, IF, time, bad_extra=(), features=None,
+                 cache=None):
+        super().__init__(dirname, params, features=features, cache=cache)
 
         self._load_args = dict(IV=IV, IF=IF, endtime=time)
         self._bad_extra = bad_extra
 
+    def _load_settings(self):
+        return sorted(self._load_args.items()), self._bad_extra
+
     def _waves(self):
         ls = os.listdir(self.dirname)
         waves = [IVCurve.load(self.dirname, f, features=self.features, **self._load_args)
@@ -277,6 +602,9 @@ class CSVSeries(Measurement):
         from ajustador.helpers.scaling_factors import get_units_scale_factor
         self.voltage_scale = get_units_scale_factor('mV') if voltage_units is None else get_units_scale_factor(voltage_units)
 
+    def _load_settings(self):
+        return self.voltage_scale
+
     def _waves(self):
         import pandas as pd
         #Need to add "time" as in IVCurve, and limit csv to data between 0 and time
@@ -9,15 +9,20 @@ import shlex
 import shutil
 import subprocess
 import glob
+import inspect
 import re
 import pickle
+import select
+import tempfile
+import time
+import threading
 import multiprocessing
 
 import numpy as np
 import cma
 
 # _features holds all feature classes.
-from . import loader, features as _features, fitnesses, utilities
+from . import loader, features as _features, fitnesses, utilities, vartype, cache as _cache, store as _store
 
 from ajustador.helpers.loggingsystem import getlogger #SRIRAM 02152018
 import logging
@@ -46,27 +51,77 @@ def exe_map(single=False, do_async=False, map_func = None):
 def iv_filename(injection_current):
     return 'ivdata-{}.npy'.format(injection_current)
 
+"All traces of a batched simulation are saved in this file"
+iv_batch_filename = 'ivdata.npz'
+
+simulation_job = collections.namedtuple('simulation_job',
+                                        'dirname injection junction_potential params features transport timeout abort cache',
+                                        defaults=(None, None, None, None))
+simulation_job.__doc__ = """A single simulation to be run by an executor
+
+`injection` is either a single current or a list of currents to be
+simulated in one process. `transport` selects how the traces are passed
+back: through files in `dirname` (None), or through shared memory ('shm').
+The simulation process is killed if it runs longer than `timeout` seconds.
+`abort` is None or (targets file, threshold), to stop the simulation early
+if its fitness cannot be better than threshold. `cache` is None or a
+:class:`ajustador.cache.SimulationCache` to reuse traces from.
+"""
+
+"Returned by executors instead of the traces if the simulation was stopped early"
+simulation_aborted = collections.namedtuple('simulation_aborted', 'injection bound')
+
+"Jobs of a simulation are skipped if this file exists in its directory"
+cancel_filename = '.cancel'
+
+"The values of the features of a simulation, see :func:`save_features`"
+features_filename = 'features.pickle'
+
+# protects the lists shared by the copies of a simulation, see MooseSimulation
+_race_lock = threading.Lock()
+
+def _cancelled(job):
+    return os.path.exists(os.path.join(job.dirname, cancel_filename))
+
+def extremes_first(currents):
+    """Order injection currents from the outside in
+
+    The most hyperpolarizing and the most depolarizing currents usually
+    tell the most about a candidate, so they are simulated first.
+
+    >>> extremes_first([-2, -1, 0, 1, 2, 3])
+    [-2, 3, -1, 2, 0, 1]
+    """
+    ordered = sorted(currents)
+    ans = []
+    while ordered:
+        ans.append(ordered.pop(0))
+        if ordered:
+            ans.append(ordered.pop())
+    return ans
+
+"A trace in shared memory, returned by executors with transport='shm'"
+shared_trace = collections.namedtuple('shared_trace', 'path injection simtime junction_potential')
+
+def _shm_dir():
+    "A directory backed by memory if there is one, /tmp otherwise"
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
 def iv_filename_to_current(ivfile):
     name = os.path.basename(ivfile)
     injection_current = float(name[7:-4])
     return injection_current
 
-def execute(p):
-    #print("starting execute")
-    from . import basic_simulation
-    #print('imported basic_simulation in execute')
-    dirname, injection, junction_potential, params, features = p
-    simtime = params['simtime']
-    logger.debug("Unseralized params:\n {} inject {}".format(params,injection)) #SRIRAM 02192018
-    params['injection_delay'] = params['injection_delay'][0] #SRIRAM 02192018
-    params['injection_width'] = params['injection_width'][0] #SRIRAM 02192018
-    params = basic_simulation.serialize_options(params)
-    result = iv_filename(injection) #result is filename
-    
-    # Ensure PYTHONPATH is correct when calling basic_simulation (below) in a 
-    # subprocess from a different directory than the main optimization script.
-    # Updates the os.environ['PYTHONPATH'] and passes it to 
-    # subprocess.check_call `env` kwarg 
+def _simulation_env():
+    """Return the environment for running basic_simulation out-of-process
+
+    Ensure PYTHONPATH is correct when calling basic_simulation in a
+    subprocess from a different directory than the main optimization script.
+    Updates os.environ['PYTHONPATH'] and returns os.environ, to be passed as
+    the `env` kwarg of subprocess calls.
+    """
     import pathlib
     # Ensure we get absolute path of sys.path[0]--the directory of the main optimization script
     pythonpath_string = str(pathlib.Path(sys.path[0]).absolute())
@@ -77,27 +132,222 @@ def execute(p):
         pythonpath_string = pythonpath_string + ':' + current_python_path
     # update PYTHONPATH environment variable 
     os.environ['PYTHONPATH']=pythonpath_string
-    #print('os.environ: ', os.environ['PYTHONPATH'],basic_simulation.__name__)
+    return os.environ
+
+def _prepare(p):
+    "Unpack a job and return the basic_simulation arguments for it"
+    from . import basic_simulation
+    job = simulation_job(*p)
+    params = dict(job.params)
+    logger.debug("Unseralized params:\n {} inject {}".format(params,job.injection)) #SRIRAM 02192018
+    params['injection_delay'] = params['injection_delay'][0] #SRIRAM 02192018
+    params['injection_width'] = params['injection_width'][0] #SRIRAM 02192018
+    params = basic_simulation.serialize_options(params)
+    if isinstance(job.injection, (list, tuple, np.ndarray)):
+        # all currents in one simulation process
+        currents = job.injection
+        result = iv_batch_filename
+    else:
+        currents = [job.injection]
+        result = iv_filename(job.injection) #result is filename
+    if job.transport == 'shm':
+        fd, result = tempfile.mkstemp(prefix='ajustador-', suffix='.npy', dir=_shm_dir())
+        os.close(fd)
+    args = ['-i={}'.format(inj) for inj in currents] + [
+            '--save-vm={}'.format(result),
+    ] + params
+    if job.abort is not None:
+        targets, threshold = job.abort
+        args += ['--abort-targets={}'.format(os.path.abspath(targets)),
+                 '--abort-threshold={}'.format(threshold),
+                 '--junction-potential={}'.format(float(job.junction_potential))]
+    return job, args, result
+
+def _finish(job, result):
+    "Load the result of a job, or just pass on where it is in shared memory"
+    simtime = job.params['simtime']
+    aborted = os.path.join(job.dirname, result + '.aborted')
+    if os.path.exists(aborted):
+        with open(aborted) as f:
+            bound = float(f.read())
+        if job.transport == 'shm':
+            os.unlink(aborted)
+            _discard(job, result)
+        return simulation_aborted(job.injection, bound)
+    if job.transport == 'shm':
+        return shared_trace(result, job.injection, simtime, job.junction_potential)
+    load = load_simulation_batch if result == iv_batch_filename else load_simulation
+    with utilities.chdir(job.dirname):
+        return load(result,
+                    simtime=simtime,
+                    junction_potential=job.junction_potential,
+                    features=job.features)
+
+def _discard(job, result):
+    "Remove the shared memory of a failed job"
+    if job.transport == 'shm' and os.path.exists(result):
+        os.unlink(result)
+
+def _cache_keys(job):
+    "The cache key for each of the currents of a job"
+    params = dict(job.params)
+    model = params['model'].value
+    morph_file = params.get('morph_file')
+    morph = b''
+    if morph_file is not None and os.path.isfile(morph_file.value):
+        with open(morph_file.value, 'rb') as f:
+            morph = f.read()
+    values = sorted((key, getattr(value, 'value', value))
+                    for key, value in params.items()
+                    # subtracted after the simulation, not part of it
+                    if key != 'junction_potential')
+    model = _cache.model_digest(model)
+    currents = job.injection if isinstance(job.injection, (list, tuple, np.ndarray)) else [job.injection]
+    return [job.cache.key(model, morph, values, float(inj)) for inj in currents]
+
+def _from_cache(job, result):
+    "Write the result of the job from the cache, if all its traces are there"
+    if job.cache is None:
+        return False
+    traces = [job.cache.load(key) for key in _cache_keys(job)]
+    if any(trace is None for trace in traces):
+        return False
+    job.cache.reused('{} {}'.format(job.dirname, job.injection))
+    path = os.path.join(job.dirname, result)
+    if result == iv_batch_filename:
+        np.savez(path, injection=np.array(job.injection), vm=np.array(traces))
+    elif isinstance(job.injection, (list, tuple, np.ndarray)):
+        np.save(path, np.array(traces))
+    else:
+        np.save(path, traces[0])
+    return True
+
+def _to_cache(job, result):
+    "Store the traces of a finished job in the cache"
+    path = os.path.join(job.dirname, result)
+    if job.cache is None or os.path.exists(path + '.aborted'):
+        return
+    if result == iv_batch_filename:
+        with np.load(path) as f:
+            traces = f['vm']
+    else:
+        traces = np.atleast_2d(np.load(path))
+    for key, trace in zip(_cache_keys(job), traces):
+        job.cache.save(key, trace)
+
+def execute(p):
+    "Run a single simulation in a new interpreter and load the result"
+    from . import basic_simulation
+    job = simulation_job(*p)
+    if _cancelled(job):
+        return simulation_aborted(job.injection, None)
+    job, args, result = _prepare(p)
+    if _from_cache(job, result):
+        return _finish(job, result)
+
+    env = _simulation_env()
     cmdline = [sys.executable, '-m',
                basic_simulation.__name__, #basic_simulation.__file__,
-               '-i={}'.format(injection),
-               '--save-vm={}'.format(result),
-    ] + params
+    ] + args
     print('+', ' '.join(shlex.quote(term) for term in cmdline), flush=True)  # shell command print for debug use.
-    #logger.debug("Seralized params:\n {}".format(params))
     logger.debug("Basic_simulation command:\n {}".format(cmdline))
-    with utilities.chdir(dirname):
-        subprocess.check_call(cmdline,env=os.environ) # 'env' updates environment with PYTHONPATH
-        iv = load_simulation(result,
-                             simtime=simtime,
-                             junction_potential=junction_potential,
-                             features=features)
-    return iv
+    try:
+        with utilities.chdir(job.dirname):
+            subprocess.check_call(cmdline,env=env, timeout=job.timeout) # 'env' updates environment with PYTHONPATH
+    except Exception:
+        _discard(job, result)
+        raise
+    _to_cache(job, result)
+    return _finish(job, result)
+
+class SimulationWorker:
+    """A persistent basic_simulation process
+
+    The process imports numpy, moose, and moose_nerp once, and then runs
+    simulations sent to it over a pipe, tearing down the MOOSE element
+    tree between jobs. If the process dies, for example because MOOSE
+    crashed, the job fails with :class:`subprocess.CalledProcessError`
+    and a new process is started for the next job.
+    """
+    def __init__(self):
+        self.process = None
+
+    def start(self):
+        from . import basic_simulation
+        rfd, wfd = os.pipe()
+        cmdline = [sys.executable, '-m', basic_simulation.__name__,
+                   '--serve', str(wfd)]
+        logger.debug("Starting simulation worker:\n {}".format(cmdline))
+        try:
+            self.process = subprocess.Popen(cmdline,
+                                            stdin=subprocess.PIPE,
+                                            pass_fds=(wfd,),
+                                            env=_simulation_env())
+        finally:
+            os.close(wfd)
+        self.replies = os.fdopen(rfd, 'rb')
+
+    def stop(self):
+        "Kill the process and return its exit code"
+        if self.process is None:
+            return None
+        if self.process.poll() is None:
+            self.process.kill()
+        returncode = self.process.wait()
+        self.process.stdin.close()
+        self.replies.close()
+        self.process = None
+        return returncode
+
+    def run(self, dirname, args, timeout=None):
+        if self.process is None or self.process.poll() is not None:
+            self.stop()
+            self.start()
+        print('+ [worker {}]'.format(self.process.pid),
+              ' '.join(shlex.quote(term) for term in args), flush=True)
+        try:
+            pickle.dump((os.path.abspath(dirname), args), self.process.stdin)
+            self.process.stdin.flush()
+            if timeout is not None and not select.select([self.replies], [], [], timeout)[0]:
+                self.stop()
+                logger.warning("Simulation worker timed out after {} s, restarting".format(timeout))
+                raise subprocess.TimeoutExpired(args, timeout)
+            status, info = pickle.load(self.replies)
+        except (EOFError, OSError, pickle.UnpicklingError):
+            returncode = self.stop()
+            logger.warning("Simulation worker died with code {}, restarting".format(returncode))
+            raise subprocess.CalledProcessError(returncode, args)
+        if status != 'ok':
+            raise subprocess.CalledProcessError(1, args, output=info)
+
+_worker = None
+def execute_persistent(p):
+    """Run a single simulation in this process' persistent worker
+
+    This is a drop-in replacement for :func:`execute`, which avoids the
+    interpreter startup and module imports for each simulation.
+    """
+    global _worker
+    if _worker is None:
+        _worker = SimulationWorker()
+    job = simulation_job(*p)
+    if _cancelled(job):
+        return simulation_aborted(job.injection, None)
+    job, args, result = _prepare(p)
+    if _from_cache(job, result):
+        return _finish(job, result)
+    try:
+        _worker.run(job.dirname, args, timeout=job.timeout)
+    except Exception:
+        _discard(job, result)
+        raise
+    _to_cache(job, result)
+    return _finish(job, result)
 
 def load_simulation(ivfile, simtime, junction_potential, features):
     injection_current = iv_filename_to_current(ivfile)
     voltage = np.load(ivfile)
-    x = np.linspace(0, float(simtime), voltage.size)
+    x = loader.timebase(0, float(simtime), voltage.size, True)
     logger.debug("type of voltage {} type of junction_potential {}".format(type(voltage),
                                                                            type(junction_potential)))
     iv = loader.IVCurve(None, None,
@@ -106,6 +356,183 @@ def load_simulation(ivfile, simtime, junction_potential, features):
                         features=features)
     return iv
 
+def load_simulation_batch(ivfile, simtime, junction_potential, features):
+    "Load all traces saved by a batched simulation as a list of IVCurves"
+    data = np.load(ivfile)
+    x = loader.timebase(0, float(simtime), data['vm'].shape[1], True)
+    return [loader.IVCurve(None, None,
+                           injection=injection_current,
+                           x=x, y=voltage - float(junction_potential),
+                           features=features)
+            for injection_current, voltage in zip(data['injection'], data['vm'])]
+
+def attach_shared(trace, features):
+    """Wrap a trace returned through shared memory in IVCurve objects
+
+    The memory is mapped, not copied. The file is removed right away, the
+    memory is released when the mapping is garbage collected. For batched
+    jobs a list of IVCurves is returned.
+    """
+    voltage = np.load(trace.path, mmap_mode='r+')
+    os.unlink(trace.path)
+    voltage -= float(trace.junction_potential)
+    currents = np.atleast_1d(trace.injection)
+    voltage = voltage.reshape(currents.size, -1)
+    x = loader.timebase(0, float(trace.simtime), voltage.shape[1], True)
+    waves = [loader.IVCurve(None, None,
+                            injection=injection_current,
+                            x=x, y=y,
+                            features=features)
+             for injection_current, y in zip(currents, voltage)]
+    return waves if np.ndim(trace.injection) else waves[0]
+
+def archive_waves(dirname, waves, junction_potential):
+    "Save traces like basic_simulation would have"
+    for wave in waves:
+        path = os.path.join(dirname, iv_filename(wave.injection))
+        np.save(path, wave.wave.y + float(junction_potential))
+
+fitness_job = collections.namedtuple('fitness_job', 'job executor targets compact archive')
+fitness_job.__doc__ = """A simulation job which also evaluates the fitness
+
+`job` is a batched :class:`simulation_job` run with `executor`. `targets`
+is a file with the pickled (measurement, fitness function). If `compact`
+is not None, every `compact`-th point of the traces is returned too.
+"""
+
+fitness_result = collections.namedtuple('fitness_result', 'fitness vector waves')
+
+class TraceSet(loader.Attributable):
+    "A group of traces from one simulation"
+    def __init__(self, waves, features):
+        super().__init__(features)
+        self.features = features
+        self.waves = np.array(waves, dtype=object)
+
+def save_targets(filename, measurement, fitness_func):
+    """Write the measurement and fitness function for :func:`execute_fitness`
+
+    Measurement features are calculated before pickling, so workers only
+    need to calculate the features of the simulated traces.
+    """
+    measurement.precompute()
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump((measurement, fitness_func), f)
+    os.replace(tmp, filename)
+
+_targets = {}
+def _load_targets(filename):
+    "Load the (measurement, fitness function) once per process"
+    key = filename, os.stat(filename).st_mtime
+    try:
+        return _targets[key]
+    except KeyError:
+        pass
+    with open(filename, 'rb') as f:
+        ans = _targets[key] = pickle.load(f)
+    return ans
+
+def _fitness_and_vector(fitness_func, sim, measurement):
+    """The fitness of sim, and the vector returned with full=True
+
+    The vector is calculated once, and the fitness is its rms, like
+    :class:`fitnesses.combined_fitness` calculates it.
+    """
+    if 'full' not in inspect.signature(fitness_func).parameters:
+        fitness = fitness_func(sim, measurement)
+        return fitness, np.atleast_1d(fitness)
+    vector = np.asarray(fitness_func(sim, measurement, full=True))
+    return vartype.array_rms(np.array(vector, dtype=float, ndmin=1),
+                             nan_replacement=fitnesses.NAN_REPLACEMENT), vector
+
+def execute_fitness(p):
+    """Run a batched simulation job and evaluate the fitness in this process
+
+    Only the fitness (and optionally a decimated copy of the traces) is
+    returned, so the parent does not need to receive the full traces nor
+    to calculate their features.
+    """
+    job, executor, targets, compact, archive = p
+    measurement, fitness_func = _load_targets(targets)
+
+    waves = executor(job)
+    if isinstance(waves, simulation_aborted):
+        return waves
+    if isinstance(waves, shared_trace):
+        waves = attach_shared(waves, job.features)
+        if archive:
+            archive_waves(job.dirname, waves, job.junction_potential)
+    sim = TraceSet(waves, job.features)
+
+    fitness, vector = _fitness_and_vector(fitness_func, sim, measurement)
+    if compact is not None:
+        waves = [loader.IVCurve(None, None,
+                                injection=wave.injection,
+                                x=wave.wave.x[::compact],
+                                y=wave.wave.y[::compact].astype(np.float32),
+                                features=job.features)
+                 for wave in waves]
+    else:
+        waves = []
+    return fitness_result(fitness, vector, waves)
+
+guarded_job = collections.namedtuple('guarded_job', 'job executor retries')
+guarded_job.__doc__ = "A job which is retried `retries` times if `executor` fails"
+
+"Returned instead of the traces by :func:`execute_guarded` for failed jobs"
+simulation_failure = collections.namedtuple('simulation_failure', 'injection error')
+
+def execute_guarded(p):
+    """Run a job, retrying if the simulation process crashes or times out
+
+    If the job still fails, or if it fails in some other way, a
+    :class:`simulation_failure` is returned instead of raising, so that
+    one bad simulation does not stop the whole fit.
+    """
+    job, executor, retries = p
+    inner = job.job if isinstance(job, fitness_job) else job
+    for attempt in range(retries + 1):
+        try:
+            return executor(job)
+        except (subprocess.SubprocessError, OSError) as e:
+            error = '{}: {}'.format(e.__class__.__name__, e)
+            logger.warning("Simulation at {} failed (attempt {}/{}): {}".format(
+                inner.injection, attempt + 1, retries + 1, error))
+        except Exception as e:
+            error = '{}: {}'.format(e.__class__.__name__, e)
+            logger.warning("Simulation at {} failed: {}".format(inner.injection, error))
+            break
+    return simulation_failure(inner.injection, error)
+
+
+class IncrementalResult:
+    """Like the result of Pool.map_async, but each job can be checked separately
+
+    This allows looking at the traces of a simulation before all of them
+    are finished.
+    """
+    def __init__(self, pool, func, iterable):
+        self.results = [pool.apply_async(func, (item,)) for item in iterable]
+
+    def ready(self):
+        return all(result.ready() for result in self.results)
+
+    def wait(self, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for result in self.results:
+            result.wait(max(deadline - time.monotonic(), 0) if deadline is not None else None)
+
+    def successful(self):
+        return all(result.successful() for result in self.results)
+
+    def get(self):
+        return [result.get() for result in self.results]
+
+    def finished(self):
+        "Return (index, value) of the jobs which have finished successfully"
+        return [(i, result.get()) for i, result in enumerate(self.results)
+                if result.ready() and result.successful()]
 
 class Simulation(loader.Attributable):
     def __init__(self, dir, *, params, constant=None, features):
@@ -114,6 +541,9 @@ class Simulation(loader.Attributable):
         self.params = params
         self.features = features
         self.constant=constant
+        self.failed = None
+        self.aborted = None
+        self._complete = False
 
         self.name = (', '.join('{}={}'.format(k,v) for k,v in self.params.items())
                      if self.params else 'unmodified')
@@ -134,16 +564,47 @@ class Simulation(loader.Attributable):
             self.__class__.__name__,
             self.tmpdir, self._param_str())
 
-    def wait(self):
+    def wait(self, timeout=None):
+        """Wait for the simulation to finish
+
+        If it does not finish in `timeout` seconds, or if it raised an
+        error, it is marked as failed.
+        """
         if self._result is not None:
             if type(self._result)==list:
                 import concurrent.futures
-                concurrent.futures.wait(self._result,timeout=300)
-                result = [f.result() for f in self._result]
-                self._set_result(result)
+                done, not_done = concurrent.futures.wait(self._result, timeout=timeout)
+                if not_done:
+                    self._set_failed('timed out after {} s'.format(timeout))
+                elif any(f.exception() is not None for f in done):
+                    self._set_failed(str(next(f.exception() for f in done
+                                              if f.exception() is not None)))
+                else:
+                    self._set_result([f.result() for f in self._result])
 
             else:
-                self._result.wait()
+                self._result.wait(timeout)
+                if not self._result.ready():
+                    self._set_failed('timed out after {} s'.format(timeout))
+                elif not self._result.successful():
+                    try:
+                        self._result.get()
+                    except Exception as e:
+                        self._set_failed(str(e))
+                elif isinstance(self._result, IncrementalResult):
+                    self._set_result(self._result.get())
+
+    def _set_failed(self, error):
+        self.failed = error
+        self._set_result([])
+
+    def ready(self):
+        "Check if the simulation has finished, without waiting"
+        if self._result is None:
+            return True
+        if type(self._result)==list:
+            return all(f.done() for f in self._result)
+        return self._result.ready()
 
 class MooseSimulation(Simulation):
     def __init__(self, dir,
@@ -157,7 +618,94 @@ class MooseSimulation(Simulation):
                  do_async=True,
                  features=None,
                  params,
-                 map_func=None):
+                 map_func=None,
+                 executor=None,
+                 batch=False,
+                 transport=None,
+                 archive=True,
+                 fitness_targets=None,
+                 compact=None,
+                 timeout=None,
+                 retries=None,
+                 abort_targets=None,
+                 abort_threshold=None,
+                 order=None,
+                 cache=None,
+                 store=None,
+                 race=None):
+        """Run simulations of the model for each of the injection `currents`
+
+        `executor` is the function which runs a single simulation job,
+        :func:`execute` (a new interpreter for each simulation) by default.
+        Use :func:`execute_persistent` to run simulations in long-lived
+        worker processes instead.
+
+        With `batch`, all currents are simulated in one job, so the model
+        is only set up once.
+
+        With `transport='shm'`, traces are returned through shared memory
+        instead of files, and are only written to the simulation directory
+        if `archive` is true.
+
+        With `fitness_targets` (a file written by :func:`save_targets`), the
+        fitness is evaluated by the worker next to the simulation (see
+        :func:`execute_fitness`) and stored as `.fitness_value` and
+        `.fitness_vector`. Only traces decimated by `compact` are kept then,
+        if any. This implies `batch`.
+
+        With `timeout` (in seconds, for each simulation process) or
+        `retries`, crashed or hung simulations are restarted up to `retries`
+        times (see :func:`execute_guarded`). If they still fail, `.failed`
+        is set to the error and the fit treats the simulation as the worst
+        possible.
+
+        With `abort_targets` (a file written by :func:`save_targets`) and
+        `abort_threshold`, simulations are stopped as soon as their fitness
+        cannot be better than `abort_threshold`. `.aborted` is then set to
+        the lower bound of the fitness.
+
+        With `order='extremes'`, the currents are simulated in the order
+        given by :func:`extremes_first`, and asynchronous simulations make
+        the traces available as they finish (see :meth:`finished_waves`),
+        so that the rest can be cancelled (see :meth:`cancel`) if they are
+        already bad enough.
+
+        With `cache` (a :class:`ajustador.cache.SimulationCache`), traces
+        simulated before with the same model and parameters are reused.
+
+        With `store` (a :class:`ajustador.store.ResultStore`), the traces
+        are appended to the store when the simulation completes, and the
+        simulation directory is removed.
+
+        `race` is a list shared by the copies of one simulation (see
+        `Fit.speculative`). The first copy put in it is the one whose
+        results are kept: the others are not tagged as complete or stored,
+        and their directories are removed when they finish. See
+        :meth:`abandon`.
+        """
+        self.executor = executor if executor is not None else execute
+        self.batch = batch or fitness_targets is not None
+        self.fitness_targets = fitness_targets
+        self.compact = compact
+        self.transport = transport
+        self.archive = archive
+        self.timeout = timeout
+        self.retries = retries
+        if abort_targets is not None and abort_threshold is not None:
+            self.abort = (abort_targets, abort_threshold)
+        else:
+            self.abort = None
+        self.order = order
+        self.cache = cache
+        self.store = store
+        # the entry in the store, once the simulation is stored
+        self.record = None
+        self._converted = {}
+        # the fitness bound given to cancel()
+        self.cancelled = None
+        self._race = race
+        # another copy of the simulation finished first
+        self.abandoned = False
 
         junction_potential = params['junction_potential'].value # FIXME: nicer syntax?
         params = filtereddict(simtime=simtime,
@@ -173,21 +721,44 @@ class MooseSimulation(Simulation):
             self.execute_for(currents, junction_potential, single, do_async=do_async,map_func=map_func)
 
     def execute_for(self, injection_currents, junction_potential, single, do_async,map_func=None):
-        params = ((self.tmpdir.name, inj, junction_potential, self.params, self.features)
+        if self.order == 'extremes':
+            injection_currents = extremes_first(injection_currents)
+        elif self.order is not None:
+            raise ValueError('unknown order {!r}'.format(self.order))
+        if self.batch:
+            injection_currents = [list(injection_currents)]
+        # the number of workers this simulation occupies
+        self.jobs = len(injection_currents)
+        params = (simulation_job(self.tmpdir.name, inj, junction_potential,
+                                 self.params, self.features, self.transport,
+                                 self.timeout, self.abort, self.cache)
                   for inj in injection_currents)
+        executor = self.executor
+        if self.fitness_targets is not None:
+            params = (fitness_job(job, self.executor, self.fitness_targets,
+                                  self.compact, self.archive)
+                      for job in params)
+            executor = execute_fitness
+        if self.timeout is not None or self.retries is not None:
+            params = [guarded_job(job, executor, self.retries or 0)
+                      for job in params]
+            executor = execute_guarded
         if map_func is not None:
             logger.debug("MooseSimulation, Params in execute_for \n {}".format(params)) #SRIRAM
-            self._result = map_func(execute, params)
+            self._result = map_func(executor, params)
             #self._result[-1].add_done_callback(self._map_func_set_result)
     
 
+        elif do_async and self.order is not None:
+            exe_map(do_async=True)      # make sure the pool exists
+            self._result = IncrementalResult(_exe, executor, params)
         elif do_async:
             logger.debug("MooseSimulation, Params in execute_for \n {}".format(params)) #SRIRAM
-            self._result = exe_map(single=False, do_async=True,map_func=map_func)(execute, params, callback=self._set_result)
+            self._result = exe_map(single=False, do_async=True,map_func=map_func)(executor, params, callback=self._set_result)
         else:
             self._result = None
             logger.debug("MooseSimulation, Params in execute_for \n {} featues {}".format(self.params, self.features)) #SRIRAM
-            result = exe_map(single=single, do_async=False,map_func=map_func)(execute, params)
+            result = exe_map(single=single, do_async=False,map_func=map_func)(executor, params)
             self._set_result(result)
 
     def _map_func_set_result(self, result):
@@ -195,14 +766,119 @@ class MooseSimulation(Simulation):
         concurrent.futures.wait(self._result,timeout=300)
         self._set_result(self._result)
 
+    def finished_waves(self):
+        "The traces which have been simulated so far"
+        if self._complete:
+            return list(self.waves)
+        if not isinstance(self._result, IncrementalResult):
+            return []
+        waves = []
+        for i, item in self._result.finished():
+            if i not in self._converted:
+                self._converted[i] = self._convert(item)
+            waves.extend(self._converted[i])
+        return waves
+
+    def cancel(self, bound):
+        """Skip the simulations which have not started yet
+
+        The simulation is marked as aborted with the fitness `bound`,
+        unless all the simulations had already started.
+        """
+        self.cancelled = bound
+        if self._complete:
+            # nothing left to skip, and the directory may be gone
+            return
+        open(os.path.join(self.tmpdir.name, cancel_filename), 'w').close()
+
+    def abandon(self):
+        """Stop the simulation, because another copy of it finished first
+
+        The jobs which have not started yet are skipped, and the results
+        of the others are dropped.
+        """
+        self.abandoned = True
+        if not self._complete:
+            open(os.path.join(self.tmpdir.name, cancel_filename), 'w').close()
+
+    def _won(self):
+        "Whether this is the copy whose results are kept"
+        if self._race is None:
+            return True
+        with _race_lock:
+            if not self._race and not self.abandoned:
+                self._race.append(self)
+            return bool(self._race) and self._race[0] is self
+
+    def _convert(self, item):
+        "Turn a job result into a list of waves"
+        if isinstance(item, simulation_failure):
+            self.failed = item.error
+            return []
+        if isinstance(item, simulation_aborted):
+            bound = item.bound if item.bound is not None else self.cancelled
+            if bound is None:
+                # cancelled without a bound, so nothing is known about it
+                bound = Fit.fitness_max
+            self.aborted = max(self.aborted or 0, bound)
+            return []
+        if isinstance(item, fitness_result):
+            self.fitness_value = item.fitness
+            self.fitness_vector = item.vector
+            item = item.waves
+        if isinstance(item, shared_trace):
+            item = attach_shared(item, self.features)
+            if self.archive:
+                archive_waves(self.tmpdir.name,
+                              item if isinstance(item, list) else [item],
+                              self.params['junction_potential'].value)
+        # batched jobs return a list of waves
+        return item if isinstance(item, list) else [item]
+
     def _set_result(self, result):
-        self.waves = np.array(result, dtype=object)
+        if self._complete:
+            # a late result after a timeout
+            return
+        self._complete = True
+        waves = []
+        for i, item in enumerate(result):
+            if i not in self._converted:
+                self._converted[i] = self._convert(item)
+            waves.extend(self._converted[i])
+        if self.order is not None:
+            waves.sort(key=operator.attrgetter('injection'))
+        self.waves = np.array(waves, dtype=object)
 
-        tag = os.path.join(self.tmpdir.name, '.complete')
-        open(tag, 'w').close()
+        if not self._won():
+            # the results of another copy are used
+            self.abandoned = True
+            self.tmpdir.cleanup()
+            return
+
+        # failed and aborted simulations are not loaded by SimulationResults
+        if self.failed is not None:
+            tag, info = '.failed', self.failed
+        elif self.aborted is not None:
+            tag, info = '.aborted', str(self.aborted)
+        else:
+            tag, info = '.complete', ''
+            if self.store is not None and len(waves):
+                self._store_result()
+                return
+        with open(os.path.join(self.tmpdir.name, tag), 'w') as f:
+            f.write(info)
+
+    def _store_result(self):
+        junction_potential = self.params['junction_potential'].value
+        self.record = self.store.append(os.path.basename(self.tmpdir.name),
+                          self.params,
+                          [wave.injection for wave in self.waves],
+                          [wave.wave.y + junction_potential for wave in self.waves],
+                          simtime=self.waves[0].wave.x[-1])
+        self.tmpdir.cleanup()
 
     @classmethod
-    def make(cls, *, dir, model, measurement, params,map_func=None):
+    def make(cls, *, dir, model, measurement, params, **kwargs):
         # A hack wrapper to push moose-specific stuff out from Fit
         simtime = measurement.waves[0].time
         injection_delay=measurement.features[0].injection_start,    #SRIRAM 02192018
@@ -220,27 +896,85 @@ class MooseSimulation(Simulation):
                    simtime=simtime,
                    features=measurement.features,
                    params=params,
-                   map_func=map_func)
+                   **kwargs)
+
+def _load_params(params):
+    "Make a ParamSet from the dictionary pickled by Simulation"
+    if isinstance(params, ParamSet):
+        return params
+    # MooseSimulation.make passes injection_delay and injection_width as
+    # 1-tuples
+    return ParamSet(*(v if isinstance(v, Param) else
+                      Param(k, v[0] if isinstance(v, tuple) and len(v) == 1 else v)
+                      for k, v in params.items()))
+
+def _feature_names(features):
+    return tuple('{}.{}'.format(feature.__module__, feature.__qualname__)
+                 for feature in features)
+
+def save_features(sim, store=None):
+    """Save the values of the array attributes of all waves of sim
+
+    Missing values are calculated. The values are saved with the
+    simulation in `store` if it is stored there, otherwise in the
+    directory of the simulation, and they are used instead of the traces
+    when the simulation is loaded as a :class:`SimulationResult`.
+    """
+    waves = sorted(sim.waves, key=operator.attrgetter('injection'))
+    summary = loader.feature_summary(waves, sim._array_attributes, calculate=True)
+    names = _feature_names(sim.features)
+    record = getattr(sim, 'record', None)
+    if record is not None:
+        store.add_features(record.name, names, summary)
+    else:
+        dirname = getattr(sim, 'dirname', None) or sim.tmpdir.name
+        path = os.path.join(dirname, features_filename)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(_store.stored_features(os.path.basename(dirname), names, summary), f)
+        os.replace(path + '.tmp', path)
+    sim.saved_features = True
 
 class SimulationResult(loader.Attributable):
-    def __init__(self, dirname, features):
+    def __init__(self, dirname, features, params=None):
         self.name = os.path.basename(dirname)
 
         if not isinstance(features, (list, tuple)):
             features = [features, *_features.standard_features]
 
-        jar = os.path.join(dirname, 'params.pickle')
-        if os.path.exists(jar):
-            with open(jar, 'rb') as f:
-                params = pickle.load(f)
-        else:
-            params = {}
-        params = ParamSet(*params)
+        if params is None:
+            jar = os.path.join(dirname, 'params.pickle')
+            if os.path.exists(jar):
+                with open(jar, 'rb') as f:
+                    params = pickle.load(f)
+            else:
+                params = {}
+        params = _load_params(params)
 
         super().__init__(features)
         self.features = features
         self.params = params
+        # the fitness saved when the simulation was evaluated, if any
+        self.stored_fitness = None
+        # the values of array attributes for each wave, which are used
+        # instead of calculating them from the traces
+        self.summary = {}
+        self.saved_features = False
+
+    def _load_features(self, saved):
+        "Use the values saved by :func:`save_features`, if they match the features"
+        if saved is not None and saved.features == _feature_names(self.features):
+            self.summary = dict(saved.summary)
+            self.saved_features = True
+
+    @property
+    @utilities.once
+    def waves(self):
+        "The traces, only loaded when first used"
+        return self._selected(lambda: np.array(self._waves(), dtype=object))
 
+    @waves.setter
+    def waves(self, value):
+        self._waves_value = value
 
     def _param_str(self, sep=' '):
         return sep.join(('{}={:.3g}' if isinstance(v, float) else '{}={}').format(k, v)
@@ -268,28 +1002,71 @@ class SimulationResult(loader.Attributable):
     def wait(self):
         pass
 
+    def ready(self):
+        return True
+
 class MooseSimulationResult(SimulationResult):
     def __init__(self, dirname, features):
         super().__init__(dirname, features)
+        self.dirname = dirname
+        path = os.path.join(dirname, features_filename)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                self._load_features(pickle.load(f))
 
-        ivfiles = glob.glob(os.path.join(dirname, 'ivdata-*.npy'))
+    def _waves(self):
+        ivfiles = glob.glob(os.path.join(self.dirname, 'ivdata-*.npy'))
 
         junction_potential = self.params.get('junction_potential', 0)
         simtime = self.params.get('simtime')
         waves = [load_simulation(ivfile,
                                  simtime=simtime,
                                  junction_potential=junction_potential,
-                                 features=features)
+                                 features=self.features)
                  for ivfile in ivfiles]
+        batchfile = os.path.join(self.dirname, iv_batch_filename)
+        if os.path.exists(batchfile):
+            waves.extend(load_simulation_batch(batchfile,
+                                               simtime=simtime,
+                                               junction_potential=junction_potential,
+                                               features=self.features))
 
         waves.sort(key=operator.attrgetter('injection'))
-        self.waves = np.array(waves, dtype=object)
+        return waves
+
+class StoredSimulationResult(SimulationResult):
+    "A simulation loaded from a :class:`ajustador.store.ResultStore`"
+    def __init__(self, store, record, features):
+        super().__init__(record.name, features, params=record.params)
+        self.store = store
+        self.record = record
+        self.stored_fitness = store.fitness(record.name)
+        self._load_features(store.features(record.name))
+
+    def _waves(self):
+        junction_potential = float(self.params.get('junction_potential', 0))
+        traces = self.store.traces(self.record)
+        x = loader.timebase(0, self.record.simtime, self.record.shape[1], True)
+        return [loader.IVCurve(None, None,
+                               injection=injection,
+                               x=x, y=voltage - junction_potential,
+                               features=self.features)
+                for injection, voltage in zip(self.record.injection, traces)]
 
 class SimulationResults(object):
     def __init__(self, dirname, features, *, constructor=MooseSimulationResult):
+        """Load the simulations of a fit from `dirname`
+
+        If the fit kept its results in a :class:`ajustador.store.ResultStore`,
+        they are read from there, otherwise from the simulation directories.
+        """
         self.dirname = dirname
         self.features = features
         self._constructor = constructor
+        if os.path.exists(os.path.join(dirname, _store.index_filename)):
+            self.store = _store.ResultStore(dirname)
+        else:
+            self.store = None
 
     def _dirs(self, last=None):
         paths = glob.glob(os.path.join(self.dirname, '*/.complete'))
@@ -303,6 +1080,14 @@ class SimulationResults(object):
             return ans[-last:]
 
     def load(self, last=None):
+        if self.store is not None:
+            records = self.store.records()
+            if last is not None:
+                records = records[-last:]
+            n = len(records)
+            for i, record in enumerate(records):
+                yield i, n, StoredSimulationResult(self.store, record, self.features)
+            return
         dirs = self._dirs(last=last)
         n = len(dirs)
         for i, dir in enumerate(dirs):
@@ -530,6 +1315,157 @@ class ParamSet:
                       for p in self.params)
         return 'ParamSet ' + vv
 
+class WorkerUsage:
+    "Track how many of `workers` are busy over time"
+    def __init__(self, workers):
+        self.workers = workers
+        self.start = self.last = time.monotonic()
+        self.busy = 0.0
+
+    def update(self, busy):
+        now = time.monotonic()
+        self.busy += min(busy, self.workers) * (now - self.last)
+        self.last = now
+
+    @property
+    def utilisation(self):
+        elapsed = self.last - self.start
+        return self.busy / (self.workers * elapsed) if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return 'worker utilisation {:.1%} ({} workers, {:.0f} s)'.format(
+            self.utilisation, self.workers, self.last - self.start)
+
+def _loaded_waves(sim):
+    "The traces of sim which are in memory, without loading any"
+    if not getattr(sim, '_complete', True):
+        return ()
+    waves = sim.__dict__.get('waves')
+    if waves is None:
+        waves = sim.__dict__.get('_waves_value', ())
+    return waves
+
+def _waves_nbytes(waves):
+    # a shared time axis is not counted
+    return sum(wave.wave.y.nbytes +
+               (0 if isinstance(wave.wave, loader.UniformWave) else wave.wave.x.nbytes)
+               for wave in waves)
+
+def _has_traces(dirname):
+    return (os.path.exists(os.path.join(dirname, iv_batch_filename)) or
+            bool(glob.glob(os.path.join(dirname, 'ivdata-*.npy'))))
+
+def _spill(sim):
+    """Return a simulation result which loads the traces of sim from disk
+
+    The parameters, the fitness calculated by the workers, and the values
+    of the features which were already calculated are kept. Returns None
+    if the traces cannot be loaded again.
+    """
+    # in the order of the loaded results
+    waves = sorted(_loaded_waves(sim), key=operator.attrgetter('injection'))
+    summary = loader.feature_summary(waves, sim._array_attributes)
+    if isinstance(sim, SimulationResult):
+        spilled = sim
+        del spilled._waves_value
+    elif getattr(sim, 'record', None) is not None:
+        spilled = StoredSimulationResult(sim.store, sim.record, sim.features)
+    else:
+        dirname = sim.tmpdir.name
+        if not _has_traces(dirname):
+            simtime = float(sim.params['simtime'])
+            if not all(isinstance(wave.wave, loader.UniformWave) and
+                       wave.wave.base == (0, simtime, wave.wave.size, True)
+                       for wave in waves):
+                # decimated traces, which would not be loaded the same
+                return None
+            archive_waves(dirname, waves, sim.params['junction_potential'].value)
+        spilled = MooseSimulationResult(dirname, sim.features)
+        for attr in ('fitness_value', 'fitness_vector'):
+            if hasattr(sim, attr):
+                setattr(spilled, attr, getattr(sim, attr))
+    spilled.summary = dict(spilled.summary, **summary)
+    return spilled
+
+class SimulationHistory(collections.OrderedDict):
+    """The simulations of a fit, in the order in which they were added
+
+    At most `budget` bytes of traces are kept in memory (without limit if
+    `budget` is None). Above that, the least recently used simulations
+    are spilled: they are replaced by results with the same parameters,
+    fitness and calculated features, which load the traces from disk
+    when they are used again.
+
+    `hits` counts the lookups of simulations with traces in memory,
+    `misses` the other lookups, and `evictions` the spilled simulations.
+    """
+    def __init__(self, budget=None):
+        super().__init__()
+        self.budget = budget
+        self.hits = self.misses = self.evictions = 0
+        # keys of the simulations which may have traces in memory, least
+        # recently used first
+        self._resident = collections.OrderedDict()
+
+    def __getitem__(self, key):
+        try:
+            sim = super().__getitem__(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        if key in self._resident and len(_loaded_waves(sim)):
+            self.hits += 1
+        else:
+            self.misses += 1
+        self._touch(key)
+        return sim
+
+    def __setitem__(self, key, sim):
+        super().__setitem__(key, sim)
+        if len(_loaded_waves(sim)) or not getattr(sim, '_complete', True):
+            self._touch(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._resident.pop(key, None)
+
+    def _touch(self, key):
+        self._resident[key] = None
+        self._resident.move_to_end(key)
+        self._evict()
+
+    def _peek(self, key):
+        "Return a simulation without counting it as used"
+        return super().__getitem__(key)
+
+    def memory(self):
+        "The number of bytes of traces in memory"
+        return sum(_waves_nbytes(_loaded_waves(self._peek(key))) for key in self._resident)
+
+    def _evict(self):
+        if self.budget is None:
+            return
+        sizes = [(key, _waves_nbytes(_loaded_waves(self._peek(key))))
+                 for key in self._resident]
+        total = sum(size for key, size in sizes)
+        for key, size in sizes:
+            if total <= self.budget:
+                break
+            if not size:
+                continue
+            spilled = _spill(self._peek(key))
+            if spilled is None:
+                continue
+            super().__setitem__(key, spilled)
+            del self._resident[key]
+            total -= size
+            self.evictions += 1
+
+    def __str__(self):
+        return '{} simulations, {} with traces in memory ({:.1f} MB), {} hits, {} misses, {} evictions'.format(
+            len(self), len(self._resident), self.memory() / 2**20,
+            self.hits, self.misses, self.evictions)
+
 class Fit:
     fitness_max = 200
 
@@ -537,7 +1473,31 @@ class Fit:
                  feature_list=None,
                  _make_simulation=None,
                  _result_constructor=MooseSimulationResult,
-                 map_func = None):
+                 map_func = None,
+                 executor = None,
+                 batch = False,
+                 transport = None,
+                 worker_fitness = False,
+                 compact = None,
+                 workers = None,
+                 timeout = None,
+                 retries = None,
+                 speculative = False,
+                 early_abort = False,
+                 lazy = False,
+                 cache = None,
+                 store = False,
+                 memory_budget = None,
+                 save_features = False,
+                 convergence = None,
+                 nonsimilar = None):
+        if store and worker_fitness and compact is None:
+            # the workers would return no traces, so there is nothing to
+            # store, and the fitness would be lost when the fit is loaded
+            raise ValueError('store with worker_fitness needs compact')
+        if lazy and not hasattr(fitness_func, 'lower_bound'):
+            # see _check_bound
+            raise ValueError('lazy needs a fitness function with lower_bound')
         self.dirname = dirname
         self.measurement = measurement
         self.model = model
@@ -550,10 +1510,52 @@ class Fit:
         self._make_simulation = _make_simulation
         self._result_constructor = _result_constructor
         self.map_func = map_func
+        self.executor = executor
+        self.batch = batch
+        self.transport = transport
+        self.worker_fitness = worker_fitness
+        self.compact = compact
+        # the number of simulation jobs which can run in parallel
+        self.workers = workers or multiprocessing.cpu_count()
+        self.usage = None
+        self.timeout = timeout
+        self.retries = retries
+        # start a second copy of simulations which take unusually long
+        self.speculative = speculative
+        # stop simulations which cannot beat the worst of the candidates
+        # selected from the previous generation
+        self.early_abort = early_abort
+        self.abort_threshold = None
+        # simulate the most telling currents first, and cancel the rest
+        # if the fitness bound is already above abort_threshold
+        self.lazy = lazy
+        # a SimulationCache, or the name of a directory for one
+        if isinstance(cache, str):
+            cache = _cache.SimulationCache(cache)
+        self.cache = cache
 
         # we assume that the first param value does not need penalties
         self._fitness_worst = None
         utilities.mkdir_p(dirname)
+        # keep all results in one ResultStore instead of a directory
+        # for each simulation
+        self.store = _store.ResultStore(dirname) if store else None
+        # the simulations, also the cache of self.sim. Only the traces of
+        # memory_budget bytes are kept in memory.
+        self._sim_value = SimulationHistory(memory_budget)
+        # save the values of all features of each simulation with it.
+        # Calculating the features which the fitness function does not
+        # use makes each evaluation slower, so this is off by default.
+        self.save_features = save_features
+        # a helpers.converge.ConvergenceMonitor, fed with the fitness of
+        # each simulation, which stops do_fit when the fit has converged
+        self.convergence = convergence
+        # a fitnesses.NonSimilarSet, kept up to date with the simulations.
+        # It is given their keys in the history, where spilled simulations
+        # are replaced, so that it does not keep their traces in memory.
+        self.nonsimilar = nonsimilar
+        if nonsimilar is not None:
+            nonsimilar.lookup = self._sim_value._peek
 
     def load(self, last=None):
         try:
@@ -561,6 +1563,14 @@ class Fit:
         except AttributeError:
             self._sim_value = collections.OrderedDict()
 
+        if self.store is not None:
+            # a fit started without the store, or an import which was
+            # interrupted. Simulations which are in the store already
+            # are skipped.
+            n = self.store.import_directory()
+            if n:
+                print('Imported {} simulations into {}'.format(n, self.store.index))
+
         new = SimulationResults(self.dirname,
                                 features=self.measurement.features,
                                 constructor=self._result_constructor)
@@ -571,6 +1581,10 @@ class Fit:
             key = tuple(sim.params.scaled)
             if key not in self._sim_value:
                 self._sim_value[key] = sim
+                if sim.stored_fitness is not None:
+                    # the fitness cache of self.fitness
+                    fitness_cache = self.__dict__.setdefault('_fitness_value', {})
+                    fitness_cache.setdefault(key, sim.stored_fitness)
                 print(sim)
                 need_erase = False
 
@@ -580,33 +1594,127 @@ class Fit:
     def param_names(self):
         return [p.name for p in self.params.ajuparams]
 
+    @utilities.once
+    def _fitness_targets(self):
+        "The measurement and fitness function for worker-side fitness"
+        path = os.path.join(self.dirname, 'targets.pickle')
+        save_targets(path, self.measurement, self.fitness_func)
+        return path
+
     @utilities.cached
     def sim(self, scaled_params):
+        return self._new_sim(scaled_params)
+
+    def _new_sim(self, scaled_params, race=None):
         unscaled = self.params.unscaled_dict(scaled_params)
         sim = self._make_simulation(dir=self.dirname,
                                     model=self.model,
                                     measurement=self.measurement,
                                     params=self.params.updated(**unscaled),
-                                    map_func=self.map_func) #define params here SRIRAM
+                                    map_func=self.map_func,
+                                    **filtereddict(executor=self.executor,
+                                                   batch=self.batch or None,
+                                                   transport=self.transport,
+                                                   fitness_targets=self.worker_fitness and self._fitness_targets() or None,
+                                                   compact=self.compact,
+                                                   timeout=self.timeout,
+                                                   retries=self.retries,
+                                                   order='extremes' if self.lazy else None,
+                                                   cache=self.cache,
+                                                   store=self.store,
+                                                   race=race,
+                                                   **self._abort_options())) #define params here SRIRAM
         return sim
 
-    def sim_fitness(self, sim, full=False, max_fitness=None):
-        fitness = self.fitness_func(sim, self.measurement, full=full)
+    def _abort_options(self):
+        if not self.early_abort or self.abort_threshold is None:
+            return {}
+        return dict(abort_targets=self._fitness_targets(),
+                    abort_threshold=self.abort_threshold)
+
+    def _check_bound(self, sim):
+        "Cancel the rest of the simulation if it cannot beat the threshold"
+        if getattr(sim, 'cancelled', None) is not None:
+            return
+        waves = sim.finished_waves()
+        if not waves:
+            return
+        bound = self.fitness_func.lower_bound(waves, self.measurement)
+        if bound > self.abort_threshold:
+            print('{} cancelled, fitness ≥ {}'.format(sim, bound))
+            sim.cancel(bound)
+
+    def _update_abort_threshold(self, values):
+        "Set the threshold to the worst of the values which CMA selects"
+        mu = self.optimizer.sp.weights.mu
+        self.abort_threshold = sorted(values)[mu - 1]
+
+    def _failed_fitness(self, full, value=None):
+        "The fitness of a simulation which did not finish"
+        if value is None:
+            value = self.fitness_max
+        if not full:
+            return value
+        if self._fitness_worst is not None:
+            n = len(self._fitness_worst)
+        else:
+            n = len(getattr(self.fitness_func, 'pairs', ())) or 1
+        return np.full(n, float(value))
+
+    def sim_fitness(self, sim, full=False, max_fitness=None, value=None, key=None):
+        """The fitness of sim, `value` if it was already calculated
+
+        `key` is the key of sim in the history, the scaled parameters.
+        """
+        if getattr(sim, 'failed', None) is not None:
+            logger.warning("{} failed: {}".format(sim, sim.failed))
+            fitness = self._failed_fitness(full)
+        elif getattr(sim, 'aborted', None) is not None:
+            # the bound is above the threshold, so this is never selected,
+            # but it still tells the optimizer how bad the candidate is
+            print('{} aborted, fitness ≥ {}'.format(sim, sim.aborted))
+            fitness = self._failed_fitness(full, sim.aborted)
+        elif getattr(sim, 'fitness_value', None) is not None:
+            # already calculated by the worker
+            fitness = sim.fitness_vector.copy() if full else sim.fitness_value
+        elif value is not None:
+            fitness = value
+        else:
+            fitness = self.fitness_func(sim, self.measurement, full=full)
+        if not full and getattr(sim, 'record', None) is not None:
+            # so that loading the fit does not need to recalculate it
+            self.store.add_fitness(sim.record.name, fitness)
+        if (not full and self.save_features
+            and not getattr(sim, 'saved_features', False)
+            and getattr(sim, 'failed', None) is None
+            and getattr(sim, 'aborted', None) is None
+            and getattr(sim, 'fitness_value', None) is None # decimated traces
+            and len(sim.waves)):
+            save_features(sim, self.store)
         if full and max_fitness is not None:
             for i in range(len(fitness)):
                 if fitness[i] > max_fitness:
                     fitness[i] = max_fitness
         self._history.append(fitness)
+        if not full and self.convergence is not None:
+            self.convergence.add(fitness)
+        if not full and self.nonsimilar is not None and key is not None:
+            self.nonsimilar.add(key, key, fitness)
         return fitness
 
     @property
     def name(self):
         return os.path.basename(self.dirname)
 
+    @property
+    def history(self):
+        "The :class:`SimulationHistory` with all simulations, and its counters"
+        return self._sim_value
+
     @utilities.cached
     def fitness(self, scaled_params):
         sim = self.sim(scaled_params)
-        return self.sim_fitness(sim)
+        return self.sim_fitness(sim, key=tuple(scaled_params))
 
     @utilities.cached
     def fitness_full(self, scaled_params):
@@ -631,17 +1739,105 @@ class Fit:
         self._async = True
         #many values is the population_size set of parameter values
         sims = [self.sim(values) for values in many_values]
+        start = time.monotonic()
+        durations = []
+        # all the running copies of each simulation
+        running = {i:[sim] for i, sim in enumerate(sims)}
+        while running:
+            self._update_usage([sim for copies in running.values() for sim in copies])
+            if self.lazy and self.abort_threshold is not None:
+                for copies in running.values():
+                    self._check_bound(copies[0])
+            for i, copies in list(running.items()):
+                done = [sim for sim in copies if sim.ready()]
+                if done:
+                    sims[i] = self._first_copy(copies, done)
+                    durations.append(time.monotonic() - start)
+                    del running[i]
+            if (self.speculative and running and len(durations) >= len(sims) // 2
+                and time.monotonic() - start > np.percentile(durations, 95)):
+                for i, copies in running.items():
+                    if len(copies) == 1 and hasattr(copies[0], 'abandon'):
+                        print('Simulation {} is slow, starting another copy'.format(copies[0]))
+                        race = copies[0]._race = []
+                        copies.append(self._new_sim(many_values[i], race=race))
+            if running:
+                time.sleep(0.05)
         for sim in sims:
             sim.wait()
+        # before the simulations are put in the history, where they might
+        # be spilled
+        self._population_fitness(many_values, sims)
+        for values, sim in zip(many_values, sims):
+            # the first copy to finish is used
+            self._sim_value[tuple(values)] = sim
         results = [self.fitness(values) for values in many_values]
         return results
 
+    @staticmethod
+    def _first_copy(copies, done):
+        """The copy of a simulation whose results are used
+
+        The first to finish, unless one of the copies already claimed the
+        race (see MooseSimulation). The others are abandoned.
+        """
+        race = getattr(copies[0], '_race', None)
+        if race is None:
+            return done[0]
+        with _race_lock:
+            if not race:
+                race.append(done[0])
+            winner = race[0]
+        for sim in copies:
+            if sim is not winner:
+                sim.abandon()
+        return winner
+
+    def _population_fitness(self, many_values, sims):
+        """Calculate the fitness of the new simulations of a generation together
+
+        See :meth:`fitnesses.combined_fitness.evaluate_population`. The
+        values are put in the cache of :meth:`fitness`.
+        """
+        evaluate = getattr(self.fitness_func, 'evaluate_population', None)
+        if evaluate is None:
+            return
+        cache = self.__dict__.setdefault('_fitness_value', {})
+        todo = collections.OrderedDict()
+        for values, sim in zip(many_values, sims):
+            key = tuple(values)
+            if (key not in cache and key not in todo
+                and getattr(sim, 'failed', None) is None
+                and getattr(sim, 'aborted', None) is None
+                and getattr(sim, 'fitness_value', None) is None):
+                todo[key] = sim
+        if not todo:
+            return
+        parts = evaluate(list(todo.values()), self.measurement)
+        for (key, sim), row in zip(todo.items(), parts):
+            total = vartype.array_rms(row, nan_replacement=fitnesses.NAN_REPLACEMENT)
+            cache[key] = self.sim_fitness(sim, value=total, key=key)
+
     def finished(self):
+        if self.convergence is not None:
+            return self.convergence.converged
         quit = fitnesses.fit_finished(self._history)
         return quit.any()
 
+    def _converged(self, generations):
+        "Whether the fit converged since the monitor had seen `generations`"
+        if self.convergence is None:
+            return False
+        if self.convergence.converged_since(generations):
+            print('Converged after {} generations'.format(self.convergence.generations))
+            return True
+        return False
+
     def __getitem__(self, i):
-        return list(self._sim_value.values()).__getitem__(i)
+        keys = list(self._sim_value.keys())[i]
+        if isinstance(i, slice):
+            return [self._sim_value[key] for key in keys]
+        return self._sim_value[keys]
     def __len__(self):
         return len(self._sim_value)
 
@@ -652,7 +1848,12 @@ class Fit:
                 values[i, j] = item.params[param].value
         return values
 
-    def do_fit(self, count, params=None, sigma=2, popsize=8, seed=123):
+    def _update_usage(self, sims):
+        if self.usage is None:
+            self.usage = WorkerUsage(self.workers)
+        self.usage.update(sum(getattr(sim, 'jobs', 1) for sim in sims))
+
+    def _init_optimizer(self, params, sigma, popsize, seed):
         # what is the order of params which position represents which params?
         if self.optimizer is None:
             if params is None:
@@ -661,11 +1862,79 @@ class Fit:
             opts = dict(bounds=bounds, popsize=popsize, seed=seed)
             self.optimizer = cma.CMAEvolutionStrategy(params, sigma, opts)
 
+    def do_fit(self, count, params=None, sigma=2, popsize=8, seed=123):
+        self._init_optimizer(params, sigma, popsize, seed)
+        self.usage = None
+        seen = self.convergence.generations if self.convergence is not None else 0
+
         for i in range(count):
-            if self.optimizer.stop():
+            if self.optimizer.stop() or self._converged(seen):
                 break
             points = self.optimizer.ask()
             values = self.fitness_multi(points) # runs simulation and computes total fitness across featuers.
             self.optimizer.tell(points, values)
+            self._update_abort_threshold(values)
             self.optimizer.logger.add()  # write plottable data to disc.
             self.optimizer.disp()
+        if self.usage is not None:
+            print(self.usage)
+
+    def do_fit_async(self, count, params=None, sigma=2, popsize=8, seed=123, poll=0.05):
+        """Like :meth:`do_fit`, but without waiting for whole generations
+
+        New candidates are started as soon as workers become idle, and the
+        optimizer is told about the first `popsize` results to finish,
+        whichever generation they were sampled from. A slow simulation
+        thus only occupies its own worker.
+        """
+        self._init_optimizer(params, sigma, popsize, seed)
+        self.usage = None
+        self._async = True
+        seen = self.convergence.generations if self.convergence is not None else 0
+
+        pending = []
+        candidates = []
+        points, values = [], []
+        generation = 0
+        while (generation < count and not self.optimizer.stop()
+               and not self._converged(seen)):
+            busy = sum(getattr(sim, 'jobs', 1) for point, sim in pending)
+            while busy < self.workers:
+                if not candidates:
+                    candidates = self.optimizer.ask()
+                point = candidates.pop(0)
+                sim = self.sim(point)
+                pending.append((point, sim))
+                busy += getattr(sim, 'jobs', 1)
+            self._update_usage([sim for point, sim in pending])
+            if self.lazy and self.abort_threshold is not None:
+                for point, sim in pending:
+                    self._check_bound(sim)
+
+            finished = [(point, sim) for point, sim in pending if sim.ready()]
+            if not finished:
+                time.sleep(poll)
+                continue
+            pending = [item for item in pending
+                       if not any(item[1] is sim for point, sim in finished)]
+            for point, sim in finished:
+                sim.wait()
+                points.append(point)
+                values.append(self.fitness(point))
+
+            while len(points) >= popsize and generation < count:
+                self.optimizer.tell(points[:popsize], values[:popsize])
+                self._update_abort_threshold(values[:popsize])
+                del points[:popsize], values[:popsize]
+                self.optimizer.logger.add()  # write plottable data to disc.
+                self.optimizer.disp()
+                generation += 1
+                # sample the rest from the updated distribution
+                candidates = []
+
+        # let the stragglers finish, their results are kept for later
+        for point, sim in pending:
+            sim.wait()
+            self.fitness(point)
+        if self.usage is not None:
+            print(self.usage)
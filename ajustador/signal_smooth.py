@@ -58,3 +58,30 @@ def smooth(x, window_len=11, window='hanning'):
 
     y=numpy.convolve(w/w.sum(),s,mode='valid')
     return y[window_len // 2 - 1 : -window_len//2]
+
+def smooth_rows(x, window_len=11, window='hanning'):
+    """smooth each row of the 2-D array x like :func:`smooth`
+
+    All rows are convolved with the window at once.
+    """
+    if x.ndim != 2:
+        raise ValueError("smooth_rows only accepts 2 dimension arrays")
+
+    if x.shape[1] < window_len:
+        raise ValueError("Input vector needs to be bigger than window size")
+
+    if window_len<3:
+        return x
+
+    if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
+        raise ValueError("Window is not one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
+
+    s=numpy.concatenate((x[:, window_len-1:0:-1], x, x[:, -1:-window_len:-1]), axis=1)
+    if window == 'flat': #moving average
+        w=numpy.ones(window_len,'d')
+    else:
+        w=getattr(numpy, window)(window_len)
+
+    windows = numpy.lib.stride_tricks.sliding_window_view(s, window_len, axis=1)
+    y = windows @ (w/w.sum())[::-1]
+    return y[:, window_len // 2 - 1 : -window_len//2]
@@ -0,0 +1,266 @@
+"""An append-only store of the simulation results of a fit
+
+All traces of a fit are kept in one data file, and the parameters of each
+simulation in one index file next to it, instead of a directory with
+`params.pickle`, a `.complete` tag and a file for each trace for every
+simulation:
+
+>>> store = ResultStore('/tmp/fit-dir')
+>>> store.append(name, params, injections, traces, simtime=0.9)
+>>> store.add_fitness(name, fitness)
+>>> store.add_features(name, feature_names, summary)
+>>> for record in store.records():
+...     record.params, store.fitness(record.name), store.traces(record)
+
+Records are only ever appended. The traces are written before the index
+entry, and a partially written entry at the end of the index is ignored
+by readers. When a store is opened, an entry cut short by a crash, and
+traces without an index entry, are truncated away, so that the records
+appended after that are seen. Appends from many
+processes are serialized with a lock on the index file. The index is
+the manifest of the fit: the parameters, fitness and feature values of
+all simulations are read from it alone, and traces are read through a memory map, only
+when they are used.
+
+Directories written by earlier versions are imported with
+:meth:`ResultStore.import_directory`.
+"""
+
+import os
+import glob
+import pickle
+import fcntl
+import collections
+import contextlib
+import multiprocessing
+
+import numpy as np
+
+from ajustador.helpers.loggingsystem import getlogger
+logger = getlogger(__name__)
+
+index_filename = 'results.index'
+data_filename = 'results.data'
+"The tag which replaces `.complete` in directories imported into a store"
+imported_tag = '.imported'
+
+stored_result = collections.namedtuple('stored_result',
+                                       'name params injection simtime offset shape dtype')
+stored_result.__doc__ = """The index entry of one simulation
+
+`params` is the dictionary of parameters of the simulation, `injection`
+an array of the injected currents, and the traces are an array of `shape`
+(one row for each current) and `dtype` at `offset` in the data file.
+"""
+
+stored_fitness = collections.namedtuple('stored_fitness', 'name fitness')
+stored_fitness.__doc__ = """The fitness of the simulation `name`, added after it was evaluated"""
+
+stored_features = collections.namedtuple('stored_features', 'name features summary')
+stored_features.__doc__ = """The values of the features of the simulation `name`
+
+`summary` is a dictionary with a list of values, one for each trace, of
+the array attributes calculated by the features named in `features`. See
+:func:`ajustador.loader.feature_summary`.
+"""
+
+class ResultStore(object):
+    def __init__(self, dirname):
+        self.dirname = os.path.abspath(dirname)
+        os.makedirs(self.dirname, exist_ok=True)
+        self.index = os.path.join(self.dirname, index_filename)
+        self.data = os.path.join(self.dirname, data_filename)
+        self._records = []
+        self._fitness = {}
+        self._features = {}
+        self._read_until = 0
+        self._map = None
+        self._repair()
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.dirname)
+
+    def __len__(self):
+        return len(self.records())
+
+    def _repair(self):
+        "Truncate the files to the last complete entry, after a crash"
+        if not os.path.exists(self.index):
+            return
+        self.records()
+        if (os.path.getsize(self.index) == self._read_until and
+            _size(self.data) == self._data_end()):
+            return
+        with self._locked():
+            # the rest may have been written meanwhile
+            self.records()
+            for filename, size in ((self.index, self._read_until),
+                                   (self.data, self._data_end())):
+                if _size(filename) > size:
+                    logger.warning('{}: truncating {} bytes of a partial entry'.format(
+                        filename, _size(filename) - size))
+                    os.truncate(filename, size)
+
+    def _data_end(self):
+        return max((record.offset + _nbytes(record) for record in self._records),
+                   default=0)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self.index, 'ab') as index:
+            fcntl.flock(index, fcntl.LOCK_EX)
+            try:
+                yield index
+            finally:
+                fcntl.flock(index, fcntl.LOCK_UN)
+
+    def append(self, name, params, injection, traces, *, simtime):
+        """Store the traces of one simulation
+
+        `traces` has one row of raw voltage for each of the currents in
+        `injection`.
+        """
+        traces = np.ascontiguousarray(traces)
+        with self._locked() as index:
+            with open(self.data, 'ab') as data:
+                offset = data.seek(0, os.SEEK_END)
+                data.write(traces.tobytes())
+            record = stored_result(name, params, np.asarray(injection, dtype=float),
+                                   float(simtime), offset, traces.shape, traces.dtype.str)
+            self._write_entry(index, record)
+        return record
+
+    def add_fitness(self, name, fitness):
+        "Record the fitness of the simulation `name`"
+        with self._locked() as index:
+            self._write_entry(index, stored_fitness(name, fitness))
+
+    def add_features(self, name, features, summary):
+        "Record the values of the features of the simulation `name`"
+        with self._locked() as index:
+            self._write_entry(index, stored_features(name, tuple(features), summary))
+
+    @staticmethod
+    def _write_entry(index, entry):
+        # write the entry in one go, so readers never see half of it
+        index.write(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+        index.flush()
+
+    def fitness(self, name):
+        "Return the fitness stored for the simulation `name`, or None"
+        self.records()
+        return self._fitness.get(name)
+
+    def features(self, name):
+        "Return the :class:`stored_features` of the simulation `name`, or None"
+        self.records()
+        return self._features.get(name)
+
+    def records(self):
+        "Return the list of records, in the order they were stored"
+        try:
+            f = open(self.index, 'rb')
+        except FileNotFoundError:
+            return self._records
+        with f:
+            f.seek(self._read_until)
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, AttributeError):
+                    # an entry which is still being written, or was cut
+                    # short by a crash (see _repair)
+                    logger.warning('{}: ignoring a partial entry at offset {}'.format(
+                        self.index, self._read_until))
+                    break
+                if isinstance(record, stored_fitness):
+                    self._fitness[record.name] = record.fitness
+                elif isinstance(record, stored_features):
+                    self._features[record.name] = record
+                else:
+                    self._records.append(record)
+                self._read_until = f.tell()
+        return self._records
+
+    def traces(self, record):
+        "Return the traces of record, mapped from the data file"
+        size = _nbytes(record)
+        if self._map is None or len(self._map) < record.offset + size:
+            self._map = np.memmap(self.data, dtype=np.uint8, mode='r')
+        buf = self._map[record.offset:record.offset + size]
+        return buf.view(record.dtype).reshape(record.shape)
+
+    def import_directory(self, dirname=None, processes=None):
+        """Import the simulation directories written by earlier versions
+
+        Directories with a `.complete` tag under `dirname` (by default, the
+        directory of the store) are added in the order of their creation,
+        unless a record with the same name exists already. They are read
+        by a pool of `processes` (all cores by default). The tag of each
+        added directory is then renamed to `.imported`, so that it is not
+        looked at again. Returns the number of imported simulations.
+        """
+        if dirname is None:
+            dirname = self.dirname
+        known = {record.name for record in self.records()}
+        dirs = []
+        for path in glob.glob(os.path.join(dirname, '*/.complete')):
+            dir = os.path.dirname(path)
+            if os.path.basename(dir) in known:
+                # appended before the import was interrupted
+                _mark_imported(dir)
+            else:
+                dirs.append(dir)
+        if not dirs:
+            return 0
+        dirs.sort(key=lambda dir: os.stat(os.path.join(dir, 'params.pickle')).st_mtime)
+        count = 0
+        with multiprocessing.Pool(processes) as pool:
+            for dir, params, injection, traces in pool.imap(_read_directory, dirs,
+                                                            chunksize=16):
+                if not len(injection):
+                    continue
+                self.append(os.path.basename(dir), params, injection, traces,
+                            simtime=_simtime(params))
+                _mark_imported(dir)
+                count += 1
+        return count
+
+def _nbytes(record):
+    "The size of the traces of record in the data file"
+    return np.dtype(record.dtype).itemsize * int(np.prod(record.shape))
+
+def _size(filename):
+    try:
+        return os.path.getsize(filename)
+    except FileNotFoundError:
+        return 0
+
+def _simtime(params):
+    simtime = params['simtime']
+    return getattr(simtime, 'value', simtime)
+
+def _mark_imported(dirname):
+    os.replace(os.path.join(dirname, '.complete'), os.path.join(dirname, imported_tag))
+
+def _read_directory(dirname):
+    with open(os.path.join(dirname, 'params.pickle'), 'rb') as f:
+        params = pickle.load(f)
+    return (dirname, params, *_read_traces(dirname))
+
+def _read_traces(dirname):
+    "Read the ivdata files of a simulation directory, sorted by current"
+    injection, traces = [], []
+    for ivfile in glob.glob(os.path.join(dirname, 'ivdata-*.npy')):
+        injection.append(float(os.path.basename(ivfile)[7:-4]))
+        traces.append(np.load(ivfile))
+    batchfile = os.path.join(dirname, 'ivdata.npz')
+    if os.path.exists(batchfile):
+        with np.load(batchfile) as data:
+            injection.extend(data['injection'])
+            traces.extend(data['vm'])
+    order = np.argsort(injection)
+    return (np.array(injection)[order],
+            np.array(traces)[order] if traces else np.empty((0, 0)))
@@ -0,0 +1,48 @@
+"""Simulations made of synthetic traces, shared by the tests
+
+No MOOSE is needed: the traces come from
+:func:`ajustador.test.test_features_batch.synthetic`.
+"""
+import os
+
+from ajustador import optimize, features, store
+from ajustador.test.test_features_batch import Params, synthetic
+
+feature_list = (Params, *features.standard_features)
+currents = [-2e-10, 1e-10, 2e-10]
+
+def params(RA=4.0):
+    return optimize.ParamSet(
+        optimize.AjuParam('junction_potential', -0.01, fixed=1),
+        optimize.AjuParam('RA', RA, min=1, max=100),
+        optimize.AjuParam('model', 'fake', fixed=1),
+        optimize.AjuParam('neuron_type', 'FAKE', fixed=1))
+
+def simulation(dirname, currents=None, **kwargs):
+    "A MooseSimulation in dirname, only run if currents are given"
+    os.makedirs(dirname, exist_ok=True)
+    kwargs.setdefault('params', params())
+    return optimize.MooseSimulation(dirname, currents, simtime=0.9,
+                                    injection_delay=(0.2,), injection_width=(0.4,),
+                                    features=feature_list, **kwargs)
+
+def traces(seed=0, currents=currents):
+    "Traces which spike for positive currents"
+    return [synthetic(inj, 20 * (inj > 0), seed=seed) for inj in currents]
+
+def trace_set(seed, rates, currents=(-1e-10, 1e-10, 2e-10, 3e-10)):
+    "A TraceSet with the spike rate given for each current"
+    return optimize.TraceSet([synthetic(inj, rate, seed + i)
+                              for i, (inj, rate) in enumerate(zip(currents, rates))],
+                             feature_list)
+
+def stored_results(dirname, n):
+    "A ResultStore with n simulations, loaded as StoredSimulationResults"
+    results = store.ResultStore(dirname)
+    for i in range(n):
+        results.append('sim{}'.format(i),
+                       dict(RA=float(i), junction_potential=0.0, simtime=0.8999),
+                       currents, [trace.wave.y for trace in traces(seed=i)],
+                       simtime=0.8999)
+    return [optimize.StoredSimulationResult(results, record, feature_list)
+            for record in results.records()]
@@ -0,0 +1,107 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from ajustador import optimize, cache
+from ajustador.test.simulated import feature_list, currents, params, simulation
+
+def test_key_stable():
+    parts = 'model', b'morph', [('RA', 4.0), ('RM', 2.0)], 1e-10
+    key = cache.SimulationCache.key(*parts)
+    # the same in another interpreter, whatever its hash seed
+    code = ('from ajustador.cache import SimulationCache;'
+            'print(SimulationCache.key("model", b"morph", [("RA", 4.0), ("RM", 2.0)], 1e-10))')
+    env = dict(os.environ, PYTHONHASHSEED='123')
+    out = subprocess.check_output([sys.executable, '-c', code], env=env)
+    assert out.decode().strip() == key
+
+    assert cache.SimulationCache.key('model', 'morph', *parts[2:]) == key
+    assert cache.SimulationCache.key(*parts[:3], 2e-10) != key
+    assert cache.SimulationCache.key(*parts[:2], [('RA', 4.0), ('RM', 2.1)], 1e-10) != key
+    # the parts are separated
+    assert cache.SimulationCache.key('ab', 'c') != cache.SimulationCache.key('a', 'bc')
+
+def test_job_keys(tmp_path, monkeypatch):
+    monkeypatch.setitem(cache._model_digests, 'fake', 'digest')
+    results = cache.SimulationCache(str(tmp_path / 'cache'))
+    sim = simulation(str(tmp_path / 'sims'))
+    job = optimize.simulation_job(sim.tmpdir.name, currents, -0.01, sim.params,
+                                  feature_list, cache=results)
+    keys = optimize._cache_keys(job)
+    assert len(set(keys)) == len(currents)
+    # the junction potential is only subtracted afterwards
+    other = simulation(str(tmp_path / 'sims'),
+                       params=params().updated(junction_potential=0.0))
+    assert optimize._cache_keys(job._replace(params=other.params)) == keys
+    other = simulation(str(tmp_path / 'sims'), params=params(RA=5.0))
+    assert not set(optimize._cache_keys(job._replace(params=other.params))) & set(keys)
+    # a single current has the same key as in a batch
+    assert optimize._cache_keys(job._replace(injection=currents[1])) == keys[1:2]
+
+def test_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setitem(cache._model_digests, 'fake', 'digest')
+    results = cache.SimulationCache(str(tmp_path / 'cache'))
+    sim = simulation(str(tmp_path / 'sims'))
+    job = optimize.simulation_job(sim.tmpdir.name, currents, -0.01, sim.params,
+                                  feature_list, cache=results)
+    vm = np.array([np.linspace(-0.08, 0.0, 1000) + i for i in range(3)])
+    assert not optimize._from_cache(job, optimize.iv_batch_filename)
+    np.savez(os.path.join(sim.tmpdir.name, optimize.iv_batch_filename),
+             injection=np.array(currents), vm=vm)
+    optimize._to_cache(job, optimize.iv_batch_filename)
+
+    # another simulation with the same parameters
+    again = simulation(str(tmp_path / 'sims'))
+    job = job._replace(dirname=again.tmpdir.name, injection=currents[2])
+    result = optimize.iv_filename(currents[2])
+    assert optimize._from_cache(job, result)
+    np.testing.assert_array_equal(np.load(os.path.join(again.tmpdir.name, result)), vm[2])
+    # one lookup for each trace
+    assert (results.hits, results.misses) == (1, 3)
+
+def test_evict_least_recently_used(tmp_path):
+    array = np.zeros(1000)
+    results = cache.SimulationCache(str(tmp_path))
+    results.save('aa1', array)
+    size = os.path.getsize(results.path('aa1'))
+    results.max_size = 2 * size
+    results.save('aa2', array)
+    results.save('bb3', array)
+    for i, key in enumerate(['aa1', 'aa2', 'bb3']):
+        os.utime(results.path(key), (1000 + i, 1000 + i))
+    # loading counts as a use
+    assert results.load('aa1') is not None
+
+    results.evict()
+    assert results.load('aa2') is None
+    assert results.load('aa1') is not None
+    assert results.load('bb3') is not None
+
+def test_atomic_store(tmp_path):
+    results = cache.SimulationCache(str(tmp_path))
+    def write(f):
+        f.write(b'partial')
+        raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        results._write('aa1', '.npy', write)
+    assert results.load('aa1') is None
+    # no temporary file is left behind
+    assert os.listdir(os.path.join(str(tmp_path), 'aa')) == []
+
+    results.save_pickle('aa1', {'RA': 4.0})
+    assert results.load_pickle('aa1') == {'RA': 4.0}
+    # a damaged entry is a miss
+    with open(results.path('aa2'), 'wb') as f:
+        f.write(b'garbage')
+    assert results.load('aa2') is None
+
+def test_reused_verbose(tmp_path, capsys):
+    results = cache.SimulationCache(str(tmp_path))
+    results.reused('sim')
+    assert capsys.readouterr().out == ''
+    results.verbose = True
+    results.reused('sim')
+    assert capsys.readouterr().out == '+ [cached] sim\n'
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+from ajustador import fitnesses
+from ajustador.helpers import converge
+
+def history(n, seed=0):
+    rng = np.random.RandomState(seed)
+    # a fit which improves and then levels off
+    return 1 + 3 * np.exp(-np.arange(n) / 100) + 0.001 * rng.rand(n)
+
+def test_monitor_same_as_converge_dict():
+    popsize, test_size = 8, 5
+    values = history(popsize * test_size * 6)
+    mean_dict, std_dict, CV = converge.converge_dict(values, test_size, popsize)
+    monitor = converge.ConvergenceMonitor(popsize, test_size)
+    monitor.extend(values)
+    assert monitor.generations == 30
+    np.testing.assert_allclose(monitor.CV, CV)
+    for expected, which in ((mean_dict, 'mean'), (std_dict, 'std')):
+        got = monitor.window_dict(which)
+        for key in ('mean', 'std', 'slope'):
+            np.testing.assert_allclose(got[key], expected[key], rtol=1e-6, atol=1e-12)
+
+def test_monitor_converged(tmp_path):
+    filename = str(tmp_path / 'convergence.dat')
+    monitor = converge.ConvergenceMonitor(4, 10, slope_crit=1e-4, std_crit=0.01,
+                                          filename=filename)
+    values = history(4 * 10 * 20)
+    converged = []
+    for i, value in enumerate(values):
+        monitor.add(value)
+        if (i + 1) % 40 == 0:
+            converged.append(monitor.converged)
+    # the fitness values level off
+    assert not converged[0] and converged[-1]
+    assert converged == sorted(converged)
+    assert monitor.converged_since(150) and not monitor.converged_since(200)
+    with open(filename) as f:
+        assert len(f.readlines()) == 2 + 20
+
+def test_fit_finished_same_as_pandas():
+    values = history(800)
+    values[50] = np.nan
+    expected = (pd.DataFrame(values).rolling(10).var() ** 0.5)
+    expected = (expected / expected.max() < 0.01).values.flatten()
+    np.testing.assert_array_equal(fitnesses.fit_finished(values), expected)
+    assert fitnesses.fit_finished(values).any()
+
+    frame = pd.DataFrame(np.vstack((values, values[::-1])).T)
+    quit = fitnesses.fit_finished(frame)
+    assert isinstance(quit, pd.DataFrame)
+    np.testing.assert_array_equal(quit[0], expected)
+    assert not fitnesses.fit_finished(values[:5]).any()
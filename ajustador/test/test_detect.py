@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from ajustador import detect
+
+@detect.arrayize(int)
+def detect_peaks_loop(y, min_high_ratio=0.25, P_low=0.5, P_high=0.5, both=False):
+    "The original sample by sample implementation of detect_peaks"
+    low_i, low = 0, y[0]
+    high_i, high = 0, y[0]
+
+    i = (y > y.max() * min_high_ratio).argmax() # find True
+    while True:
+        for i in range(i, len(y)):
+            if y[i] < low:
+                low_i, low = i, y[i]
+            if y[i] > high:
+                high_i, high = i, y[i]
+
+            if y[i] - low < (high - low) * P_high:
+                break
+        else:
+            break
+
+        yield high_i
+        low_i, low = i, y[i]
+
+        for i in range(i, len(y)):
+            if y[i] < low:
+                low_i, low = i, y[i]
+            if y[i] > high:
+                high_i, high = i, y[i]
+
+            if y[i] - low > (high - low) * P_low:
+                break
+        else:
+            break
+
+        if both:
+            yield low_i
+        high_i, high = i, y[i]
+
+def spiking(seed, n=9000, rate=0.002):
+    "A membrane potential like trace with spikes of varying height"
+    rng = np.random.RandomState(seed)
+    y = -0.08 + 0.002 * rng.randn(n)
+    t = np.arange(n)
+    for start in np.flatnonzero(rng.rand(n) < rate):
+        shape = np.exp(-((t - start) / (2 + 3 * rng.rand())) ** 2)
+        y += (0.06 + 0.06 * rng.rand()) * shape
+    return y
+
+def traces():
+    yield 'noise', np.random.RandomState(0).randn(3000)
+    yield 'walk', np.random.RandomState(1).randn(20000).cumsum()
+    yield 'sine', np.sin(np.linspace(0, 60, 5000))
+    yield 'flat', np.zeros(100)
+    yield 'single', np.array([1.0])
+    yield 'plateaus', np.repeat([0, 3, 3, 1, 3, 0, 2, 2, 0], 50).astype(float)
+    yield 'integers', np.random.RandomState(2).randint(-5, 6, 2000)
+    yield 'float32', spiking(4).astype(np.float32)
+    yield 'subthreshold', -0.08 + 0.0005 * np.random.RandomState(5).randn(9000)
+    with_nan = spiking(3)
+    with_nan[100:110] = np.nan
+    yield 'nan', with_nan
+    for seed in range(5):
+        yield 'spiking{}'.format(seed), spiking(seed)
+
+names, ys = zip(*traces())
+
+@pytest.mark.parametrize("y", ys, ids=names)
+@pytest.mark.parametrize("kwargs", [dict(),
+                                    dict(P_low=0.75, P_high=0.50),
+                                    dict(min_high_ratio=0.9, P_low=0.1, P_high=0.9),
+                                    dict(both=True),
+                                    dict(P_low=0.75, P_high=0.50, both=True)],
+                         ids=['default', 'features', 'strict', 'both', 'features-both'])
+def test_same_as_loop(y, kwargs):
+    expected = detect_peaks_loop(y, **kwargs)
+    got = detect.detect_peaks(y, **kwargs)
+    assert got.dtype == expected.dtype
+    np.testing.assert_array_equal(got, expected)
@@ -0,0 +1,109 @@
+import os
+import subprocess
+
+import numpy as np
+
+from ajustador import optimize, fitnesses
+from ajustador.test.simulated import feature_list, currents, params, traces
+
+calls = []
+def counted_fitness(sim, measurement, full=False, error=None):
+    calls.append(full)
+    return float(len(sim.waves))
+
+def plain_fitness(sim, measurement):
+    return 2.0
+
+def fitness_job(tmp_path, fitness_func, compact=None):
+    targets = str(tmp_path / 'targets.pickle')
+    optimize.save_targets(targets, optimize.TraceSet(traces(seed=1), feature_list), fitness_func)
+    job = optimize.simulation_job(str(tmp_path), currents, 0.0, params(), feature_list)
+    return job, lambda job: traces(), targets, compact, False
+
+def test_execute_fitness(tmp_path):
+    fitness = fitnesses.combined_fitness('simple_combined_fitness', spike_count=0,
+                                         extra={counted_fitness: 0.5})
+    del calls[:]
+    job = fitness_job(tmp_path, fitness)
+    result = optimize.execute_fitness(job)
+    # each feature is only evaluated once
+    assert len(calls) == 1
+    sim = optimize.TraceSet(traces(), feature_list)
+    measurement, fitness = optimize._load_targets(job[2])
+    assert result.fitness == fitness(sim, measurement)
+    np.testing.assert_array_equal(result.vector, fitness(sim, measurement, full=True))
+    assert result.waves == []
+
+def test_execute_fitness_plain(tmp_path):
+    result = optimize.execute_fitness(fitness_job(tmp_path, plain_fitness, compact=10))
+    assert result.fitness == 2.0
+    np.testing.assert_array_equal(result.vector, [2.0])
+    assert [wave.injection for wave in result.waves] == currents
+    assert result.waves[0].wave.size == 900
+
+def test_load_simulation_batch(tmp_path):
+    path = str(tmp_path / optimize.iv_batch_filename)
+    vm = np.array([np.linspace(-0.08, 0.0, 1000) + i for i in range(3)])
+    np.savez(path, injection=np.array(currents), vm=vm)
+    waves = optimize.load_simulation_batch(path, simtime=0.9, junction_potential=-0.01,
+                                           features=feature_list)
+    assert [wave.injection for wave in waves] == currents
+    for wave, y in zip(waves, vm):
+        np.testing.assert_allclose(wave.wave.y, y + 0.01)
+        assert wave.wave.x[-1] == 0.9
+
+def test_attach_shared(tmp_path):
+    path = str(tmp_path / 'trace.npy')
+    y = np.linspace(-0.08, 0.0, 1000)
+    np.save(path, y)
+    wave = optimize.attach_shared(optimize.shared_trace(path, 1e-10, 0.9, -0.01),
+                                  feature_list)
+    # the file is removed, the mapping stays valid
+    assert not os.path.exists(path)
+    assert wave.injection == 1e-10
+    np.testing.assert_allclose(wave.wave.y, y + 0.01)
+    assert wave.wave.x[-1] == 0.9
+
+def test_attach_shared_batch(tmp_path):
+    path = str(tmp_path / 'trace.npy')
+    vm = np.array([np.linspace(-0.08, 0.0, 1000) + i for i in range(3)])
+    np.save(path, vm)
+    waves = optimize.attach_shared(optimize.shared_trace(path, currents, 0.9, 0.0),
+                                   feature_list)
+    assert not os.path.exists(path)
+    assert [wave.injection for wave in waves] == currents
+    for wave, y in zip(waves, vm):
+        np.testing.assert_array_equal(wave.wave.y, y)
+
+def flaky(failures, error):
+    "An executor which raises error the first `failures` times"
+    attempts = []
+    def executor(job):
+        attempts.append(job)
+        if len(attempts) <= failures:
+            raise error
+        return traces()
+    return executor, attempts
+
+def test_execute_guarded_retries(tmp_path):
+    job = optimize.simulation_job(str(tmp_path), 1e-10, 0.0, params(), feature_list)
+    executor, attempts = flaky(2, subprocess.CalledProcessError(-9, ['sim']))
+    result = optimize.execute_guarded(optimize.guarded_job(job, executor, 2))
+    assert len(result) == len(currents)
+    assert len(attempts) == 3
+
+    executor, attempts = flaky(2, subprocess.TimeoutExpired(['sim'], 10))
+    result = optimize.execute_guarded(optimize.guarded_job(job, executor, 1))
+    assert isinstance(result, optimize.simulation_failure)
+    assert result.injection == 1e-10
+    assert result.error.startswith('TimeoutExpired')
+    assert len(attempts) == 2
+
+def test_execute_guarded_other_errors(tmp_path):
+    job = optimize.simulation_job(str(tmp_path), currents, 0.0, params(), feature_list)
+    job = optimize.fitness_job(job, None, None, None, False)
+    # not a crash of the simulation, so it is not retried
+    executor, attempts = flaky(1, ValueError('bad parameters'))
+    result = optimize.execute_guarded(optimize.guarded_job(job, executor, 3))
+    assert result == optimize.simulation_failure(currents, 'ValueError: bad parameters')
+    assert len(attempts) == 1
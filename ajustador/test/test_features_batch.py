@@ -0,0 +1,161 @@
+import os
+import numpy as np
+import pytest
+
+from ajustador import loader, features, vartype
+
+recording = os.path.join(os.path.dirname(__file__),
+                         '../../docs/static/recording/042811-6ivifcurves_Waves')
+
+class Params:
+    requires = ()
+    provides = ('baseline_before', 'baseline_after',
+                'steady_after', 'steady_before', 'steady_cutoff',
+                'falling_curve_window',
+                'injection_start', 'injection_end', 'injection_interval')
+    def __init__(self, obj):
+        pass
+    baseline_before = 0.2
+    baseline_after = 0.75
+    steady_after = 0.25
+    steady_before = 0.6
+    steady_cutoff = 80
+    falling_curve_window = 20
+    injection_start = 0.2
+    injection_end = 0.6
+    injection_interval = 0.4
+
+def synthetic(injection, rate, seed, n=9000, dt=1e-4):
+    "A trace with a charging curve and spikes with an AHP"
+    rng = np.random.RandomState(seed)
+    x = np.arange(n) * dt
+    y = -0.08 + 0.0005 * rng.randn(n)
+    on = (x > 0.2) & (x < 0.6)
+    y[on] += injection * 1e8 * (1 - np.exp(-(x[on] - 0.2) / 0.01))
+    for t in np.arange(0.22, 0.6, 1 / rate) if rate else ():
+        k = int(t / dt)
+        y[k:k+60] += 0.1 * np.exp(-np.arange(60) / 8)
+        y[k+60:k+210] -= 0.01 * np.exp(-np.arange(150) / 40)
+    return loader.Trace(injection, x, y, (Params, *features.standard_features))
+
+def synthetic_series():
+    return [synthetic(inj, rate, seed)
+            for seed, (inj, rate) in enumerate([(-2e-10, 0), (-1e-10, 0), (0, 0),
+                                                (1e-10, 20), (2e-10, 40)])]
+
+def recorded_series():
+    mes = loader.IVCurveSeries(recording, Params,
+                               IV=(-500e-12, 50e-12), IF=(200e-12, 20e-12), time=.9)
+    return list(mes.waves)
+
+names = ('baseline', 'baseline_pre', 'baseline_post', 'steady', 'response',
+         'spike_i', 'spike_threshold', 'spike_count',
+         'falling_curve', 'rectification',
+         'charging_curve')
+
+def same(a, b):
+    if isinstance(a, vartype.vartype):
+        np.testing.assert_allclose([a.x, a.dev], [b.x, b.dev], rtol=1e-9, equal_nan=True)
+    elif isinstance(a, np.recarray):
+        np.testing.assert_array_equal(a.x, b.x)
+        np.testing.assert_array_equal(a.y, b.y)
+    else:
+        np.testing.assert_allclose(a, b, rtol=1e-9, equal_nan=True)
+
+@pytest.mark.parametrize("series", [synthetic_series, recorded_series],
+                         ids=['synthetic', 'recorded'])
+def test_batch_same_as_single(series):
+    single = series()
+    batched = series()
+    features.compute_batch(batched)
+    for one, other in zip(single, batched):
+        for name in names:
+            same(getattr(one, name), getattr(other, name))
+
+def test_batch_attributes():
+    waves = synthetic_series()
+    features.compute_batch(waves, 'baseline')
+    assert waves[0]._attributes['baseline']._batched
+    assert not hasattr(waves[0]._attributes['spike_i'], '_batched')
+    # already calculated values are kept
+    baseline = waves[1].baseline
+    features.compute_batch(waves)
+    assert waves[1].baseline is baseline
+
+def find_spikes_loop(wave, min_height=0.0, max_charge_time=0.004, charge_threshold=0.02):
+    "The original spike threshold calculation, one spike at a time"
+    peaks = features.detect.detect_peaks(wave.y, P_low=0.75, P_high=0.50)
+    peaks = peaks[wave.y[peaks] > min_height]
+    thresholds = np.empty(peaks.size)
+    for i in range(len(peaks)):
+        start = (wave.x >= wave.x[peaks[i]] - max_charge_time).argmax()
+        y = wave.y[start:peaks[i] + 1]
+        yderiv = np.diff(y)
+        try:
+            ythresh = charge_threshold * yderiv.max()
+            thresholds[i] = y[1:][yderiv > ythresh].min()
+        except Exception:
+            thresholds[i] = np.nan
+    return peaks, thresholds
+
+def spike_bounds_loop(trace):
+    y = trace.wave.y
+    halfheight = (trace.spikes.y - trace.spike_threshold) / 2 + trace.spike_threshold
+    ans = []
+    for i, k in enumerate(trace.spike_i):
+        beg = end = k
+        while beg > 1 and y[beg - 1] > halfheight[i]:
+            beg -= 1
+        while end + 2 < y.size and y[end + 1] > halfheight[i]:
+            end += 1
+        ans.append((beg, end))
+    return ans
+
+def ahp_window_loop(trace):
+    spike_bounds = trace.spike_bounds
+    thresholds = trace.spike_threshold
+    x, y = trace.wave.x, trace.wave.y
+    ans = []
+    for i in range(len(trace.spikes)):
+        beg = spike_bounds[i].right_i
+        rlimit = min(spike_bounds[i+1].left if i < len(trace.spikes)-1 else x[-1],
+                     trace.injection_start if trace.injection_start > x[beg] else np.inf,
+                     trace.injection_end if trace.injection_end > x[beg] else np.inf)
+        w = spike_bounds[i].width
+        n = int(w // (x[1] - x[0])) + 1 if not np.isnan(w) else 5
+        while (beg < y.size - n and y[beg] >= thresholds[i] and
+               x[beg + 1] < rlimit and y[beg] > y[beg + n]):
+            beg += 1
+        end = beg + n
+        while (end < x.size and (y[end] < thresholds[i] or end - beg < 5) and
+               x[end] < rlimit):
+            end += 1
+        ans.append((beg, end))
+    return ans
+
+def fast_spiking():
+    "Many spikes, some of them close together, with an AHP after each"
+    return [synthetic(2e-10, rate, seed) for seed, rate in enumerate([80, 150, 300])]
+
+@pytest.mark.parametrize("series", [synthetic_series, recorded_series, fast_spiking],
+                         ids=['synthetic', 'recorded', 'fast'])
+def test_spikes_same_as_loop(series):
+    for trace in series():
+        peaks, thresholds = find_spikes_loop(trace.wave)
+        np.testing.assert_array_equal(trace.spike_i, peaks)
+        np.testing.assert_array_equal(trace.spike_threshold, thresholds)
+        assert [(b.left_i, b.right_i) for b in trace.spike_bounds] == spike_bounds_loop(trace)
+        assert [(w.left_i, w.right_i) for w in trace.spike_ahp_window] == ahp_window_loop(trace)
+
+@pytest.mark.parametrize("series", [synthetic_series, recorded_series, fast_spiking],
+                         ids=['synthetic', 'recorded', 'fast'])
+def test_ahp_batch_same_as_loop(series):
+    traces = series()
+    features.compute_batch(traces, 'spike_ahp')
+    for trace in traces:
+        assert trace._attributes['spike_ahp']._batched
+        assert '_spike_ahp_window_value' in trace._attributes['spike_ahp'].__dict__
+        assert [(w.left_i, w.right_i) for w in trace.spike_ahp_window] == ahp_window_loop(trace)
+    for one, other in zip(series(), traces):
+        for name in ('spike_ahp', 'spike_ahp_position'):
+            np.testing.assert_array_equal(getattr(one, name).x, getattr(other, name).x)
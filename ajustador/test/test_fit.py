@@ -0,0 +1,108 @@
+import pytest
+
+from ajustador import optimize, fitnesses
+from ajustador.test.simulated import trace_set
+
+def params():
+    return optimize.ParamSet(
+        optimize.AjuParam('junction_potential', -0.01, fixed=1),
+        optimize.AjuParam('RA', 4.0, min=1, max=100),
+        optimize.AjuParam('RM', 2.0, min=0.1, max=10))
+
+class FakeSimulation:
+    "Finishes after `polls` calls of ready(), or when waited for"
+    def __init__(self, params, polls, running):
+        self.params = params
+        self.polls = polls
+        self.running = running
+        running.append(self)
+
+    def ready(self):
+        self.polls -= 1
+        if self.polls < 0 and self in self.running:
+            self.running.remove(self)
+        return self.polls < 0
+
+    def wait(self):
+        self.polls = 0
+        self.ready()
+
+def fitness(sim, measurement, full=False):
+    return (sim.params['RA'].value - 10)**2 + (sim.params['RM'].value - 1)**2
+
+def test_worker_usage(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(optimize.time, 'monotonic', lambda: clock[0])
+    usage = optimize.WorkerUsage(4)
+    clock[0] = 1
+    usage.update(4)
+    clock[0] = 3
+    usage.update(2)
+    # more jobs than workers are waiting in the queue
+    clock[0] = 4
+    usage.update(8)
+    assert usage.utilisation == 0.75
+    assert str(usage) == 'worker utilisation 75.0% (4 workers, 4 s)'
+
+def test_do_fit_async(tmp_path, monkeypatch):
+    # the optimizer logs to outcmaes/
+    monkeypatch.chdir(str(tmp_path))
+    sims, running, most = [], [], []
+    def make_simulation(*, params, **kwargs):
+        # the first simulation does not finish on its own
+        sim = FakeSimulation(params, 10**6 if not sims else len(sims) % 4, running)
+        sims.append(sim)
+        most.append(len(running))
+        return sim
+
+    fit = optimize.Fit(str(tmp_path / 'fit'), None, 'fake', 'FAKE', fitness, params(),
+                       _make_simulation=make_simulation, workers=3)
+    fit.do_fit_async(3, popsize=4, poll=0)
+
+    # the slow simulation occupied one worker, the others went on
+    assert fit.optimizer.countiter == 3
+    assert max(most) == 3
+    assert fit.usage.utilisation > 0
+    # and it was waited for at the end
+    assert not running
+    assert len(fit) == len(fit._fitness_value) == len(sims) >= 13
+
+def test_fit_store_needs_traces(tmp_path):
+    fitness = lambda sim, measurement, full=False: 1.0
+    with pytest.raises(ValueError):
+        optimize.Fit(str(tmp_path / 'fit'), None, 'fake', 'FAKE', fitness, None,
+                     store=True, worker_fitness=True)
+    fit = optimize.Fit(str(tmp_path / 'fit'), None, 'fake', 'FAKE', fitness, None,
+                       store=True, worker_fitness=True, compact=10)
+    assert fit.store is not None
+
+def test_fit_lazy_needs_bound(tmp_path):
+    fitness = lambda sim, measurement, full=False: 1.0
+    with pytest.raises(ValueError):
+        optimize.Fit(str(tmp_path / 'fit'), None, 'fake', 'FAKE', fitness, None,
+                     lazy=True)
+    fitness = fitnesses.combined_fitness('simple_combined_fitness')
+    fit = optimize.Fit(str(tmp_path / 'fit2'), None, 'fake', 'FAKE', fitness, None,
+                       lazy=True)
+    assert fit.lazy
+
+@pytest.mark.parametrize('preset', ['simple_combined_fitness', 'new_combined_fitness'])
+def test_lower_bound(preset):
+    fitness = fitnesses.combined_fitness(preset)
+    measurement = trace_set(0, [0, 10, 20, 30])
+    sim = trace_set(7, [0, 15, 35, 60])
+    final = fitness(sim, measurement)
+    assert final > 0
+
+    # the bound only grows as the traces are simulated, and never goes
+    # above the fitness of the whole simulation
+    order = optimize.extremes_first(list(sim.injection))
+    waves = {wave.injection: wave for wave in sim.waves}
+    bounds = []
+    for i in range(len(order) + 1):
+        done = [waves[inj] for inj in order[:i]]
+        partial = waves[order[i]] if i < len(order) else None
+        bounds.append(fitness.lower_bound(done, measurement, partial=partial))
+    assert bounds[0] <= bounds[-1] <= final
+    assert bounds == sorted(bounds)
+    assert bounds[-1] > 0
@@ -0,0 +1,145 @@
+import gc
+import os
+import pickle
+import weakref
+import numpy as np
+
+from ajustador import optimize, fitnesses
+from ajustador.test import simulated
+from ajustador.test.simulated import feature_list, currents, stored_results
+
+def test_history_budget(tmp_path):
+    sims = stored_results(str(tmp_path), 5)
+    size = optimize._waves_nbytes(sims[0].waves)
+    history = optimize.SimulationHistory(budget=2 * size)
+    for i, sim in enumerate(sims):
+        sim.waves
+        history[i] = sim
+    assert history.evictions == 3
+    assert history.memory() == 2 * size
+    assert list(history) == list(range(5))
+
+    # the budget is checked on the next access, and the least recently
+    # used one is spilled
+    history[3]
+    history[0].waves
+    assert history.evictions == 3
+    history[3]
+    assert history.evictions == 4
+    assert '_waves_value' not in history._peek(4).__dict__
+    assert '_waves_value' in history._peek(0).__dict__
+    assert (history.hits, history.misses) == (2, 1)
+
+def test_history_spilled_features(tmp_path):
+    sims = stored_results(str(tmp_path), 2)
+    spike_height = sims[0].spike_height
+    baseline = sims[0].mean_baseline
+    history = optimize.SimulationHistory(budget=0)
+    history[0] = sims[0]
+    assert history.evictions == 1
+    assert history.memory() == 0
+
+    # calculated features are kept, the others load the traces again
+    spilled = history._peek(0)
+    np.testing.assert_array_equal(spilled.spike_height, spike_height)
+    assert '_waves_value' not in spilled.__dict__
+    assert spilled.mean_baseline.x == baseline.x
+    again = optimize.StoredSimulationResult(sims[0].store, sims[0].record, feature_list)
+    np.testing.assert_array_equal(spilled.spike_count, again.spike_count)
+    assert '_waves_value' in spilled.__dict__
+
+def test_history_unlimited(tmp_path):
+    sims = stored_results(str(tmp_path), 3)
+    history = optimize.SimulationHistory()
+    for i, sim in enumerate(sims):
+        sim.waves
+        history[i] = sim
+    assert history.evictions == 0
+    try:
+        history[3]
+    except KeyError:
+        pass
+    assert history.misses == 1
+
+def test_saved_features_store(tmp_path):
+    sims = stored_results(str(tmp_path), 1)
+    optimize.save_features(sims[0], sims[0].store)
+    assert sims[0].saved_features
+
+    loaded = optimize.StoredSimulationResult(sims[0].store, sims[0].record, feature_list)
+    assert loaded.saved_features
+    for name in ('spike_count', 'injection'):
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(sims[0], name))
+    for name in ('mean_baseline', 'falling_curve_tau'):
+        np.testing.assert_array_equal(getattr(loaded, name).x, getattr(sims[0], name).x)
+    assert '_waves_value' not in loaded.__dict__
+    part = loaded[np.array([2, 0])]
+    assert len(part) == 2
+    np.testing.assert_array_equal(part.spike_count, sims[0].spike_count[[2, 0]])
+    assert '_waves_value' not in loaded.__dict__
+    # charging_curve is a part of the trace, which is not saved
+    loaded.charging_curve
+    assert '_waves_value' in loaded.__dict__
+    np.testing.assert_array_equal(part.injection, [wave.injection for wave in part.waves])
+    assert part.waves[0] is loaded.waves[2]
+
+    other = optimize.StoredSimulationResult(sims[0].store, sims[0].record,
+                                            feature_list[:-1])
+    assert not other.saved_features
+
+def test_saved_features_directory(tmp_path):
+    dirname = str(tmp_path / 'sim')
+    sim = stored_results(str(tmp_path / 'store'), 1)[0]
+    os.mkdir(dirname)
+    with open(os.path.join(dirname, 'params.pickle'), 'wb') as f:
+        pickle.dump(sim.record.params, f)
+    for wave in sim.waves:
+        np.save(os.path.join(dirname, optimize.iv_filename(wave.injection)), wave.wave.y)
+
+    result = optimize.MooseSimulationResult(dirname, feature_list)
+    optimize.save_features(result)
+    loaded = optimize.MooseSimulationResult(dirname, feature_list)
+    np.testing.assert_array_equal(loaded.spike_height, sim.spike_height)
+    assert '_waves_value' not in loaded.__dict__
+
+def test_fit_saves_features_on_request(tmp_path):
+    sim = stored_results(str(tmp_path / 'store'), 1)[0]
+    fitness = lambda sim, measurement, full=False: 1.0
+    fit = optimize.Fit(str(tmp_path / 'fit'), None, 'fake', 'FAKE', fitness, None)
+    fit.store = sim.store
+    assert fit.sim_fitness(sim) == 1.0
+    assert sim.store.features(sim.record.name) is None
+
+    fit = optimize.Fit(str(tmp_path / 'fit2'), None, 'fake', 'FAKE', fitness, None,
+                       save_features=True)
+    fit.store = sim.store
+    fit.sim_fitness(sim)
+    assert sim.store.features(sim.record.name) is not None
+
+def test_fit_nonsimilar_spilled(tmp_path):
+    fitness = lambda sim, measurement, full=False: 1.0
+    params = simulated.params()
+    fit = optimize.Fit(str(tmp_path / 'fit'), None, 'fake', 'FAKE', fitness, params,
+                       store=True, memory_budget=None,
+                       nonsimilar=fitnesses.NonSimilarSet(params.scaled_bounds))
+    refs = []
+    for RA in (2.0, 40.0, 80.0):
+        sim = simulated.simulation(str(tmp_path / 'sims'), params=simulated.params(RA),
+                                   store=fit.store)
+        sim._set_result(simulated.traces())
+        key = tuple(params.scale([RA]))
+        fit._sim_value[key] = sim
+        assert fit.fitness(key) == 1.0
+        refs.append(weakref.ref(sim))
+    del sim
+    assert len(fit.nonsimilar) == 3
+
+    # the traces are freed when the simulations are spilled
+    fit.history.budget = 0
+    fit.history._evict()
+    assert fit.history.evictions == 3
+    gc.collect()
+    assert [ref() for ref in refs] == [None] * 3
+    items = fit.nonsimilar.items
+    assert [type(item) for item in items] == [optimize.StoredSimulationResult] * 3
+    assert all('_waves_value' not in item.__dict__ for item in items)
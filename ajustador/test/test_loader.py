@@ -0,0 +1,143 @@
+import numpy as np
+
+from ajustador import loader, features, fitnesses
+from ajustador.test.test_features_batch import (Params, recorded_series, recording,
+                                                names, same)
+
+def test_uniform_wave_like_recarray():
+    base = loader.timebase(0, 0.9, 9000, False)
+    y = np.sin(np.arange(9000) / 100).astype(np.float32)
+    wave = loader.UniformWave(base, y)
+    rec = np.rec.fromarrays((np.linspace(0, 0.9, 9000, endpoint=False), y), names='x,y')
+
+    np.testing.assert_array_equal(wave.x, rec.x)
+    assert wave.y.dtype == np.float32
+    assert wave.size == rec.size == len(wave)
+    for index in (slice(10, 20), slice(None, None, 7), wave.x > 0.5, [3, 5, 8]):
+        np.testing.assert_array_equal(wave[index], rec[index])
+    assert wave[17].x == rec[17].x and wave[17].y == rec[17].y
+    assert wave.dt == 1e-4
+
+def test_uniform_wave_shares_time_axis():
+    base = loader.timebase(0, 0.9, 9001, True)
+    one = loader.UniformWave(base, np.zeros(9001))
+    two = loader.UniformWave(base, np.ones(9001))
+    assert one.x is two.x
+    assert not one.x.flags.writeable
+
+def test_uniform_features_same():
+    uniform = recorded_series()
+    explicit = [loader.Trace(wave.injection, wave.wave.x.copy(), wave.wave.y,
+                             (Params, *features.standard_features))
+                for wave in recorded_series()]
+    assert isinstance(uniform[0].wave, loader.UniformWave)
+    assert isinstance(explicit[0].wave, np.recarray)
+    for one, other in zip(uniform, explicit):
+        for name in names:
+            same(getattr(one, name), getattr(other, name))
+
+def cached_series(cache, params=Params):
+    return loader.IVCurveSeries(recording, params, IV=(-500e-12, 50e-12),
+                                IF=(200e-12, 20e-12), time=.9, cache=cache)
+
+def test_measurement_cache(tmp_path):
+    cache = str(tmp_path)
+    first = cached_series(cache)
+    assert first.spike_count is not None
+    assert '_waves_value' in first.__dict__
+
+    again = cached_series(cache)
+    for name in ('injection', 'spike_count', 'mean_baseline', 'spike_height'):
+        same(getattr(again, name), getattr(first, name))
+    np.testing.assert_array_equal(again.steady.x, first.steady.x)
+    part = again[again.injection > 0]
+    same(part.spike_count, first.spike_count[first.injection > 0])
+    assert len(part) == (first.injection > 0).sum()
+    assert '_waves_value' not in again.__dict__
+    assert '_waves_value' not in part.__dict__
+    np.testing.assert_array_equal(part.injection, [wave.injection for wave in part.waves])
+    # the waves of a part are loaded by the whole measurement
+    assert '_waves_value' in again.__dict__
+
+    class Other(Params):
+        baseline_before = 0.15
+    other = cached_series(cache, Other)
+    assert other._cache_key() != again._cache_key()
+
+def test_measurement_cache_loads_once(tmp_path, monkeypatch):
+    cache = str(tmp_path)
+    sim = cached_series(cache)
+    sim.spike_count
+    loads = []
+    waves = loader.IVCurveSeries._waves
+    monkeypatch.setattr(loader.IVCurveSeries, '_waves',
+                        lambda self: loads.append(self) or waves(self))
+
+    measurement = cached_series(cache)
+    for i in range(3):
+        assert fitnesses.spike_time_fitness(sim, measurement) == 0
+    assert len(loads) == 1
+    assert '_waves_value' in measurement.__dict__
+
+def test_aggregates_memoized():
+    mes = loader.IVCurveSeries(recording, Params, IV=(-500e-12, 50e-12),
+                               IF=(200e-12, 20e-12), time=.9)
+    spike_count = mes.spike_count
+    assert mes.spike_count is spike_count
+    assert mes.mean_baseline is mes.mean_baseline
+    assert not spike_count.flags.writeable
+
+    # per-wave values are passed on to a part, stacked arrays are not
+    mes.spike_height
+    part = mes[mes.injection > 0]
+    assert 'spike_count' in part._aggregates
+    assert 'spike_height' not in part._aggregates
+    np.testing.assert_array_equal(part.spike_count, spike_count[mes.injection > 0])
+    np.testing.assert_array_equal(part.spike_height,
+                                  np.hstack([wave.spike_height for wave in part.waves]))
+
+    mes.waves = mes.waves[:2]
+    assert len(mes.spike_count) == 2
+
+def test_part_aggregates_kept(monkeypatch):
+    mes = loader.IVCurveSeries(recording, Params, IV=(-500e-12, 50e-12),
+                               IF=(200e-12, 20e-12), time=.9)
+    which = mes.injection > 0
+    calls = []
+    aggregate = loader.Attributable._aggregate
+    monkeypatch.setattr(loader.Attributable, '_aggregate',
+                        staticmethod(lambda arr: calls.append(len(arr)) or aggregate(arr)))
+
+    for i in range(3):
+        part = mes[which]
+        response = part.response
+        np.testing.assert_array_equal(response.x, [wave.response.x for wave in part.waves])
+        # a part of a part has the same waves
+        np.testing.assert_array_equal(part[np.arange(len(part))].response.x, response.x)
+    assert len(calls) == 1
+
+    # the values for all waves are selected
+    baseline = mes.baseline
+    assert len(calls) == 2
+    np.testing.assert_array_equal(mes[which].baseline.x, baseline.x[which])
+    np.testing.assert_array_equal(mes[~which][1:].baseline.x, baseline.x[~which][1:])
+    assert len(calls) == 2
+
+def test_per_wave():
+    mes = loader.IVCurveSeries(recording, Params, IV=(-500e-12, 50e-12),
+                               IF=(200e-12, 20e-12), time=.9)
+    calls = []
+    def injection(waves):
+        calls.append(len(waves))
+        return np.array([wave.injection for wave in waves])
+
+    which = mes.injection > 0
+    part = mes[which][1:]
+    np.testing.assert_array_equal(part.per_wave('_currents', injection),
+                                  mes.injection[which][1:])
+    # calculated once, for all the waves
+    assert calls == [len(mes.waves)]
+    np.testing.assert_array_equal(mes.per_wave('_currents', injection), mes.injection)
+    np.testing.assert_array_equal(mes[~which].per_wave('_currents', injection),
+                                  mes.injection[~which])
+    assert calls == [len(mes.waves)]
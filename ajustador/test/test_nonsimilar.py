@@ -0,0 +1,42 @@
+import numpy as np
+
+from ajustador import fitnesses
+
+def brute_nonsimilar(points, fitness, similarity):
+    "The loop find_nonsimilar used"
+    order = np.argsort(fitness, kind='stable')
+    points = points[order]
+    duplicate = np.zeros(len(points), dtype=bool)
+    for i in range(len(points) - 1):
+        if not duplicate[i]:
+            diff = ((points[i + 1:] - points[i])**2).sum(axis=1)**0.5
+            duplicate[i + 1:] |= diff < similarity
+    return order[~duplicate]
+
+def test_point_index():
+    rng = np.random.RandomState(0)
+    points = rng.uniform(-1, 1, (700, 3))
+    index = fitnesses._PointIndex(3, buffer=16)
+    for i, point in enumerate(points):
+        assert index.add(point) == i
+    assert index._trees[-1][1] <= 700
+    for point in points[::37]:
+        expected = (((points - point)**2).sum(axis=1)**0.5 < 0.3).nonzero()[0]
+        assert sorted(index.near(point, 0.3)) == list(expected)
+
+def test_nonsimilar_set():
+    rng = np.random.RandomState(1)
+    params = rng.uniform(0, 10, (1500, 4))
+    params[:, 2] = 5        # a fixed parameter
+    fitness = rng.rand(1500)
+    fitness[::100] = np.nan
+    bounds = ([0, 0, 5, 0], [10, 10, 5, 10])
+    nonsimilar = fitnesses.NonSimilarSet(bounds, similarity=0.3)
+    for i in range(len(params)):
+        nonsimilar.add(i, params[i], fitness[i])
+        if i in (10, 500, 1499):
+            normalized = (params[:i+1][:, [0, 1, 3]] - 5) / 5
+            expected = brute_nonsimilar(normalized, np.nan_to_num(fitness[:i+1], nan=np.inf), 0.3)
+            assert nonsimilar.items == list(expected)
+    np.testing.assert_array_equal(nonsimilar.params, params[nonsimilar.items])
+    assert len(nonsimilar) < 1500
@@ -0,0 +1,73 @@
+import numpy as np
+
+from ajustador import fitnesses
+
+def random_scores(n, m=4, seed=0):
+    rng = np.random.RandomState(seed)
+    scores = rng.rand(n, m)
+    scores[rng.rand(n) < 0.02, 1] = np.nan
+    return scores
+
+def brute_front(scores):
+    valid = ~np.isnan(scores).any(axis=1)
+    return [i for i in valid.nonzero()[0]
+            if not any((scores[j] < scores[i]).all() for j in valid.nonzero()[0])]
+
+def brute_prune(scores, similarity):
+    "The loop find_multi_best used to prune similar scores"
+    total = (scores ** 2).sum(axis=1)
+    worse = np.empty(len(scores), dtype=bool)
+    for i in reversed(range(len(scores))):
+        similar = scores[i] - scores[:i]
+        worse[i] = ((similar ** 2).sum(axis=1) < total[i] * similarity).any()
+    return worse
+
+class Fitness:
+    def __init__(self, scores):
+        self.scores = scores
+    def __call__(self, sim, measurement, full=False):
+        return self.scores[sim]
+
+def test_front():
+    scores = random_scores(500)
+    front = fitnesses.ParetoFront()
+    front.update(range(len(scores)), scores)
+    assert list(front.items) == brute_front(scores)
+    np.testing.assert_array_equal(front.scores, scores[brute_front(scores)])
+    assert front.seen == 500
+
+def test_ranks():
+    scores = random_scores(300, m=2)
+    ranks = fitnesses.pareto_ranks(scores)
+    assert (ranks[np.isnan(scores).any(axis=1)] == -1).all()
+    remaining = np.arange(len(scores))
+    for rank in range(ranks.max() + 1):
+        front = remaining[brute_front(scores[remaining])]
+        assert sorted(front) == sorted((ranks == rank).nonzero()[0])
+        remaining = np.setdiff1d(remaining, front)
+    assert not np.isin(remaining, (ranks >= 0).nonzero()[0]).any()
+
+def test_crowding_distance():
+    scores = np.array([[0., 4], [1, 3], [2, 1], [4, 0]])
+    distance = fitnesses.crowding_distance(scores)
+    assert np.isinf(distance[[0, 3]]).all()
+    np.testing.assert_allclose(distance[1:3], [2/4 + 3/4, 3/4 + 3/4])
+
+def test_find_multi_best():
+    scores = random_scores(2000, m=3, seed=1)
+    fitness = Fitness(scores)
+    on_front = brute_front(scores)
+    order = (scores[on_front] ** 2).sum(axis=1).argsort()
+    expected = np.array(on_front)[order]
+    expected = expected[~brute_prune(scores[expected], 0.1)]
+
+    best, best_scores = fitnesses.find_multi_best(list(range(2000)), None, fitness, full=True)
+    np.testing.assert_array_equal(best.astype(int), expected)
+    np.testing.assert_array_equal(best_scores, scores[expected])
+
+    # the front is kept between calls for a growing group
+    front = fitnesses.ParetoFront()
+    fitnesses.find_multi_best(list(range(1000)), None, fitness, front=front)
+    best = fitnesses.find_multi_best(list(range(2000)), None, fitness, front=front)
+    np.testing.assert_array_equal(best.astype(int), expected)
+    assert front.seen == 2000
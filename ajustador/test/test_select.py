@@ -0,0 +1,72 @@
+import numpy as np
+
+from ajustador import loader, fitnesses
+from ajustador.test.test_features_batch import Params, recording
+
+def measurement():
+    return loader.IVCurveSeries(recording, Params,
+                                IV=(-500e-12, 50e-12), IF=(200e-12, 20e-12), time=.9)
+
+def broadcast_select(a, b, which=None):
+    bsel = b[which] if which is not None else b
+    ind1, ind2 = np.where(np.abs(a.injection[:,None] - bsel.injection) < 1e-12)
+    return a[ind1], bsel[ind2]
+
+def test_match_currents():
+    rng = np.random.RandomState(0)
+    a = rng.choice(np.arange(-5, 5) * 1e-10, 30)
+    b = rng.choice(np.arange(-3, 8) * 1e-10, 20) + rng.uniform(-2e-12, 2e-12, 20)
+    ind1, ind2 = fitnesses.match_currents(a, b)
+    expected = np.where(np.abs(a[:,None] - b) < 1e-12)
+    np.testing.assert_array_equal(ind1, expected[0])
+    np.testing.assert_array_equal(ind2, expected[1])
+    assert len(ind1) > 0
+
+def test_select_same_as_broadcast():
+    mes = measurement()
+    sim = mes[mes.injection > -300e-12]
+    for which in (None,
+                  mes.injection > 0,
+                  mes.injection <= -10e-12,
+                  mes.spike_count >= 2,
+                  mes.injection > 1):
+        m1, m2 = fitnesses._select(sim, mes, which)
+        e1, e2 = broadcast_select(sim, mes, which)
+        np.testing.assert_array_equal(m1.injection, e1.injection)
+        np.testing.assert_array_equal(m2.injection, e2.injection)
+        np.testing.assert_array_equal(m1.steady, e1.steady)
+        np.testing.assert_array_equal(m2.spike_count, e2.spike_count)
+
+def test_shared_selections():
+    mes = measurement()
+    sim = mes[mes.injection > -300e-12]
+    which = mes.injection > 0
+    assert fitnesses._select(sim, mes, which)[0] is not fitnesses._select(sim, mes, which)[0]
+    with fitnesses.shared_selections():
+        first = fitnesses._select(sim, mes, which)
+        assert fitnesses._select(sim, mes, which.copy()) is first
+        assert fitnesses._select(sim, mes) is not first
+    assert fitnesses._pairings is None
+    sim = measurement()
+    fitness = fitnesses.combined_fitness('new_combined_fitness')
+    assert fitness(sim, mes) == fitness(sim, mes)
+
+def test_evaluate_population():
+    from ajustador.test.simulated import trace_set
+    currents = [(-2e-10, 0), (-1e-10, 0), (1e-10, 20), (2e-10, 40)]
+    def traces(seed, currents=currents, scale=1):
+        return trace_set(seed, [rate for inj, rate in currents],
+                         [inj * scale for inj, rate in currents])
+    mes = traces(0)
+    sims = [traces(10),
+            traces(20)[[3, 0, 2]],
+            traces(30, currents[::-1]),
+            traces(40, [currents[0], currents[0], currents[2]]),
+            traces(50, scale=3)]
+    for fitness in (fitnesses.combined_fitness('simple_combined_fitness'),
+                    fitnesses.combined_fitness('new_combined_fitness', ahp_curve=0),
+                    fitnesses.combined_fitness('simple_combined_fitness',
+                                               error=fitnesses.ErrorCalc.normal)):
+        matrix = fitness.evaluate_population(sims, mes)
+        expected = np.array([fitness(sim, mes, full=True) for sim in sims])
+        np.testing.assert_array_equal(matrix, expected)
@@ -0,0 +1,114 @@
+import concurrent.futures
+import os
+import threading
+
+import pytest
+
+from ajustador import optimize, store
+from ajustador.test.simulated import simulation, traces, currents
+
+def test_speculative_copy_stored_once(tmp_path):
+    results = store.ResultStore(str(tmp_path / 'store'))
+    race = []
+    first = simulation(str(tmp_path), store=results, race=race)
+    copy = simulation(str(tmp_path), store=results, race=race)
+
+    assert optimize.Fit._first_copy([first, copy], [copy]) is copy
+    assert first.abandoned
+    assert os.path.exists(os.path.join(first.tmpdir.name, optimize.cancel_filename))
+
+    # the straggler finishes later anyway
+    first._set_result(traces())
+    copy._set_result(traces())
+    assert len(list(results.records())) == 1
+    assert copy.record is not None
+    assert first.record is None
+    assert not os.path.exists(first.tmpdir.name)
+
+def test_speculative_copy_directories(tmp_path):
+    race = []
+    first = simulation(str(tmp_path), race=race)
+    copy = simulation(str(tmp_path), race=race)
+
+    # the first copy to finish wins, even before fitness_multi sees it
+    first._set_result(traces())
+    copy._set_result(traces())
+    assert optimize.Fit._first_copy([first, copy], [first, copy]) is first
+    assert os.path.exists(os.path.join(first.tmpdir.name, '.complete'))
+    assert copy.abandoned
+    assert not os.path.exists(copy.tmpdir.name)
+
+def test_aborted_bound(tmp_path):
+    sim = simulation(str(tmp_path))
+    sim._set_result([traces()[0], optimize.simulation_aborted(1e-10, 3.5)])
+    assert sim.aborted == 3.5
+
+def test_aborted_without_bound(tmp_path):
+    # skipped because the simulation was cancelled, but no bound is known
+    sim = simulation(str(tmp_path))
+    sim._set_result([traces()[0], optimize.simulation_aborted(1e-10, None)])
+    assert sim.aborted == optimize.Fit.fitness_max
+    with open(os.path.join(sim.tmpdir.name, '.aborted')) as f:
+        assert float(f.read()) == optimize.Fit.fitness_max
+
+    sim = simulation(str(tmp_path))
+    sim.cancel(7.0)
+    sim._set_result([optimize.simulation_aborted(1e-10, None)])
+    assert sim.aborted == 7.0
+
+def threaded(dirname, executor):
+    "A simulation whose jobs run in threads"
+    pool = concurrent.futures.ThreadPoolExecutor(len(currents))
+    map_func = lambda func, jobs: [pool.submit(func, job) for job in jobs]
+    return simulation(dirname, currents, executor=executor, map_func=map_func)
+
+def test_wait_timeout(tmp_path):
+    release = threading.Event()
+    def executor(job):
+        release.wait(10)
+        return traces(currents=[job.injection])[0]
+    sim = threaded(str(tmp_path), executor)
+    sim.wait(timeout=0.1)
+    assert sim.failed == 'timed out after 0.1 s'
+    assert len(sim.waves) == 0
+    assert os.path.exists(os.path.join(sim.tmpdir.name, '.failed'))
+
+    # the late results are ignored
+    release.set()
+    sim.wait()
+    assert sim.failed == 'timed out after 0.1 s'
+    assert len(sim.waves) == 0
+
+def test_wait_error(tmp_path):
+    def executor(job):
+        if job.injection > 0:
+            raise ValueError('bad parameters')
+        return traces(currents=[job.injection])[0]
+    sim = threaded(str(tmp_path), executor)
+    sim.wait(timeout=10)
+    assert sim.failed == 'bad parameters'
+
+def test_wait(tmp_path):
+    sim = threaded(str(tmp_path), lambda job: traces(currents=[job.injection])[0])
+    sim.wait(timeout=10)
+    assert sim.failed is None
+    assert [wave.injection for wave in sim.waves] == currents
+    assert os.path.exists(os.path.join(sim.tmpdir.name, '.complete'))
+
+def test_extremes_first(tmp_path):
+    assert optimize.extremes_first([3, -1, 2, 0, 1]) == [-1, 3, 0, 2, 1]
+    assert optimize.extremes_first([1]) == [1]
+    started = []
+    def executor(job):
+        started.append(job.injection)
+        return traces(currents=[job.injection])[0]
+    many = [-3e-10, -2e-10, -1e-10, 1e-10, 2e-10]
+    sim = simulation(str(tmp_path), many, executor=executor, order='extremes',
+                     single=True, do_async=False)
+    assert started == [-3e-10, 2e-10, -2e-10, 1e-10, -1e-10]
+    # the traces are sorted again
+    assert [wave.injection for wave in sim.waves] == many
+
+    with pytest.raises(ValueError):
+        simulation(str(tmp_path), many, executor=executor, order='random',
+                   single=True, do_async=False)
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ajustador import fitnesses, loader
+from ajustador.test.simulated import trace_set as traces
+
+def pandas_spikes(meas):
+    frames = [pd.DataFrame(wave.spikes) for wave in meas]
+    for frame, wave in zip(frames, meas):
+        frame['injection'] = wave.injection
+        frame.reset_index(inplace=True)
+        frame.set_index(['index', 'injection'], inplace=True)
+    return pd.concat(frames)
+
+def pandas_align(m1, m2, fill):
+    spikes1, spikes2 = pandas_spikes(m1).align(pandas_spikes(m2), axis=0)
+    spikes1.fillna(fill, inplace=True)
+    spikes2.fillna(fill, inplace=True)
+    return spikes1['x'], spikes2['x']
+
+def pandas_spike_time_fitness(sim, measurement, error=fitnesses.ErrorCalc.relative):
+    m1, m2 = fitnesses._select(sim, measurement, measurement.spike_count >= 2)
+    if len(m1) == 0:
+        m1, m2 = fitnesses._select(measurement, sim, sim.spike_count >= 2)
+        if len(m1) == 0:
+            return 0
+    return fitnesses._evaluate(*pandas_align(m1, m2, sim[0].injection_interval), error=error)
+
+measurement = traces(0, (0, 20, 30, 40))
+
+@pytest.mark.parametrize("rates", [(0, 20, 30, 40),   # the same spike counts
+                                   (0, 25, 30, 60),
+                                   (0, 0, 10, 0),
+                                   (0, 0, 0, 0)])
+@pytest.mark.parametrize("error", [fitnesses.ErrorCalc.relative, fitnesses.ErrorCalc.normal])
+def test_spike_time_same_as_pandas(rates, error):
+    sim = traces(10, rates)
+    for a, b in ((sim, measurement), (measurement, sim), (sim[[3, 1, 2]], measurement)):
+        expected = pandas_spike_time_fitness(a, b, error=error)
+        value = fitnesses.spike_time_fitness(a, b, error=error)
+        if error == fitnesses.ErrorCalc.relative:
+            assert value == expected
+        else:
+            # the mean of a pandas Series is summed in a different order
+            assert value == pytest.approx(expected, rel=1e-14)
+
+def test_spike_times_remembered():
+    times = fitnesses._spike_times(measurement)
+    assert fitnesses._spike_times(measurement) is times
+    part = measurement[[1, 3]]
+    assert fitnesses._spike_times(part).shape == (2, times.shape[1])
+    np.testing.assert_array_equal(fitnesses._spike_times(part), times[[1, 3]])
+
+def test_spike_times_calculated_once(monkeypatch):
+    "The spike times are calculated once for each measurement, not for each part"
+    measurement = traces(0, (0, 20, 30, 40))
+    calculated = []
+    remember = loader.Attributable._remember
+    def counting(self, attr, value, per_wave):
+        if attr == '_spike_times' and '_source' not in self.__dict__:
+            calculated.append(self)
+        return remember(self, attr, value, per_wave)
+    monkeypatch.setattr(loader.Attributable, '_remember', counting)
+
+    for seed in range(3):
+        sim = traces(10 + seed, (0, 25, 30, 60))
+        for i in range(2):
+            fitnesses.spike_time_fitness(sim, measurement)
+    assert len(calculated) == 4
+    assert calculated.count(measurement) == 1
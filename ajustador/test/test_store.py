@@ -0,0 +1,96 @@
+import os
+import glob
+import pickle
+import numpy as np
+
+from ajustador import store
+
+currents = [-2e-10, 1e-10]
+
+def append(results, i):
+    traces = np.full((len(currents), 100), float(i))
+    return results.append('sim{}'.format(i), dict(RA=float(i)), currents, traces,
+                          simtime=0.1)
+
+def test_records(tmp_path):
+    results = store.ResultStore(str(tmp_path))
+    for i in range(3):
+        append(results, i)
+    results.add_fitness('sim1', 2.5)
+
+    loaded = store.ResultStore(str(tmp_path))
+    assert [record.name for record in loaded.records()] == ['sim0', 'sim1', 'sim2']
+    assert loaded.fitness('sim1') == 2.5
+    assert loaded.fitness('sim0') is None
+    np.testing.assert_array_equal(loaded.traces(loaded.records()[2]), 2)
+
+def test_truncated_entry(tmp_path):
+    results = store.ResultStore(str(tmp_path))
+    for i in range(2):
+        append(results, i)
+    size = os.path.getsize(results.index), os.path.getsize(results.data)
+    append(results, 2)
+    # a crash while the last entry was written
+    os.truncate(results.index, (size[0] + os.path.getsize(results.index)) // 2)
+
+    resumed = store.ResultStore(str(tmp_path))
+    assert len(resumed) == 2
+    assert (os.path.getsize(resumed.index), os.path.getsize(resumed.data)) == size
+    append(resumed, 3)
+
+    loaded = store.ResultStore(str(tmp_path))
+    assert [record.name for record in loaded.records()] == ['sim0', 'sim1', 'sim3']
+    np.testing.assert_array_equal(loaded.traces(loaded.records()[2]), 3)
+
+def test_truncated_data(tmp_path):
+    results = store.ResultStore(str(tmp_path))
+    append(results, 0)
+    size = os.path.getsize(results.data)
+    # a crash after the traces were written, before the index entry
+    with open(results.data, 'ab') as f:
+        f.write(b'\0' * 1000)
+
+    resumed = store.ResultStore(str(tmp_path))
+    assert os.path.getsize(resumed.data) == size
+    record = append(resumed, 1)
+    assert record.offset == size
+    np.testing.assert_array_equal(resumed.traces(record), 1)
+
+def simulation_directory(dirname, i):
+    os.makedirs(dirname)
+    with open(os.path.join(dirname, 'params.pickle'), 'wb') as f:
+        pickle.dump(dict(RA=float(i), simtime=0.1), f)
+    for inj in currents:
+        np.save(os.path.join(dirname, 'ivdata-{}.npy'.format(inj)), np.full(100, float(i)))
+    open(os.path.join(dirname, '.complete'), 'w').close()
+
+def test_import_interrupted(tmp_path):
+    for i in range(4):
+        simulation_directory(str(tmp_path / 'sim{}'.format(i)), i)
+        os.utime(str(tmp_path / 'sim{}'.format(i) / 'params.pickle'), (i, i))
+    results = store.ResultStore(str(tmp_path))
+    for i in range(3):
+        append(results, i)
+    # the import crashed while the third simulation was written
+    size = os.path.getsize(results.index)
+    os.truncate(results.index, size - 10)
+
+    resumed = store.ResultStore(str(tmp_path))
+    assert resumed.import_directory(processes=1) == 2
+    assert [record.name for record in resumed.records()] == ['sim0', 'sim1', 'sim2', 'sim3']
+    for i, record in enumerate(resumed.records()):
+        np.testing.assert_array_equal(resumed.traces(record), i)
+    assert store.ResultStore(str(tmp_path)).import_directory(processes=1) == 0
+    for i in range(4):
+        assert os.path.exists(str(tmp_path / 'sim{}'.format(i) / store.imported_tag))
+
+def test_import_once(tmp_path):
+    for i in range(3):
+        simulation_directory(str(tmp_path / 'sim{}'.format(i)), i)
+    results = store.ResultStore(str(tmp_path))
+    assert results.import_directory(processes=1) == 3
+    assert glob.glob(str(tmp_path / '*' / '.complete')) == []
+    # the directories are not looked at again
+    results = store.ResultStore(str(tmp_path))
+    assert results.import_directory(processes=1) == 0
+    assert len(results.records()) == 3
@@ -0,0 +1,175 @@
+import io
+import os
+import pickle
+import subprocess
+import sys
+import types
+
+import numpy as np
+import pytest
+
+import ajustador
+from ajustador import optimize
+from ajustador.test.simulated import simulation, currents
+
+# Speaks the protocol of basic_simulation --serve, without MOOSE
+FAKE_SIMULATION = '''
+import os, pickle, sys, time, traceback
+import numpy as np
+
+def main(args):
+    currents = [float(arg[3:]) for arg in args if arg.startswith('-i=')]
+    save = next(arg[10:] for arg in args if arg.startswith('--save-vm='))
+    if '--crash' in args:
+        os._exit(3)
+    if '--hang' in args:
+        time.sleep(60)
+    if '--fail' in args:
+        raise ValueError('bad parameters')
+    with open('pid', 'w') as f:
+        f.write(str(os.getpid()))
+    vm = np.array([np.full(900, -0.07 + inj * 1e8) for inj in currents])
+    if save.endswith('.npz'):
+        np.savez(save, injection=np.array(currents), vm=vm)
+    else:
+        np.save(save, vm[0] if len(currents) == 1 else vm)
+
+def serve(fd):
+    replies = os.fdopen(fd, 'wb')
+    while True:
+        try:
+            dirname, args = pickle.load(sys.stdin.buffer)
+        except EOFError:
+            break
+        os.chdir(dirname)
+        try:
+            main(args)
+        except Exception:
+            reply = 'error', traceback.format_exc()
+        else:
+            reply = 'ok', None
+        pickle.dump(reply, replies)
+        replies.flush()
+
+if __name__ == '__main__':
+    serve(int(sys.argv[2]))
+'''
+
+@pytest.fixture
+def fake_simulation(tmp_path, monkeypatch):
+    "Run the workers with FAKE_SIMULATION instead of basic_simulation"
+    path = tmp_path / 'lib'
+    path.mkdir()
+    (path / 'fake_simulation.py').write_text(FAKE_SIMULATION)
+    module = types.ModuleType('fake_simulation')
+    module.serialize_options = lambda params: []
+    monkeypatch.setitem(sys.modules, 'ajustador.basic_simulation', module)
+    monkeypatch.setattr(ajustador, 'basic_simulation', module, raising=False)
+    monkeypatch.setenv('PYTHONPATH', str(path))
+    monkeypatch.setattr(optimize, '_worker', None)
+    yield module
+    if optimize._worker is not None:
+        optimize._worker.stop()
+
+@pytest.fixture
+def worker(fake_simulation):
+    worker = optimize.SimulationWorker()
+    yield worker
+    worker.stop()
+
+def worker_pid(dirname):
+    with open(os.path.join(dirname, 'pid')) as f:
+        return int(f.read())
+
+def test_worker_reused(worker, tmp_path):
+    worker.run(str(tmp_path), ['-i=1e-10', '--save-vm=a.npy'])
+    worker.run(str(tmp_path), ['-i=2e-10', '--save-vm=b.npy'])
+    assert worker_pid(str(tmp_path)) == worker.process.pid
+    assert np.load(str(tmp_path / 'a.npy'))[0] == pytest.approx(-0.06)
+    assert np.load(str(tmp_path / 'b.npy'))[0] == pytest.approx(-0.05)
+
+def test_worker_error(worker, tmp_path):
+    worker.run(str(tmp_path), ['-i=1e-10', '--save-vm=a.npy'])
+    pid = worker.process.pid
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        worker.run(str(tmp_path), ['-i=1e-10', '--save-vm=a.npy', '--fail'])
+    assert 'ValueError: bad parameters' in error.value.output
+    # the process is still usable
+    worker.run(str(tmp_path), ['-i=1e-10', '--save-vm=a.npy'])
+    assert worker.process.pid == pid
+
+def test_worker_crash(worker, tmp_path):
+    worker.run(str(tmp_path), ['-i=1e-10', '--save-vm=a.npy'])
+    pid = worker.process.pid
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        worker.run(str(tmp_path), ['-i=1e-10', '--save-vm=a.npy', '--crash'])
+    assert error.value.returncode == 3
+    assert worker.process is None
+    # a new process is started for the next job
+    worker.run(str(tmp_path), ['-i=1e-10', '--save-vm=a.npy'])
+    assert worker.process.pid != pid
+    assert worker_pid(str(tmp_path)) == worker.process.pid
+
+def test_worker_timeout(worker, tmp_path):
+    with pytest.raises(subprocess.TimeoutExpired):
+        worker.run(str(tmp_path), ['-i=1e-10', '--save-vm=a.npy', '--hang'], timeout=0.5)
+    assert worker.process is None
+    worker.run(str(tmp_path), ['-i=1e-10', '--save-vm=a.npy'], timeout=10)
+    assert os.path.exists(str(tmp_path / 'a.npy'))
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_execute_persistent(fake_simulation, tmp_path, batch):
+    sim = simulation(str(tmp_path), currents, executor=optimize.execute_persistent,
+                     batch=batch, single=True, do_async=False)
+    assert sim.failed is None
+    assert [wave.injection for wave in sim.waves] == currents
+    # the junction potential is subtracted
+    for wave in sim.waves:
+        assert wave.wave.y[0] == pytest.approx(-0.06 + wave.injection * 1e8)
+        assert wave.wave.x[-1] == pytest.approx(0.9)
+    # all jobs ran in the same process
+    assert worker_pid(sim.tmpdir.name) == optimize._worker.process.pid
+
+@pytest.mark.parametrize('archive', [False, True])
+def test_execute_persistent_shm(fake_simulation, tmp_path, monkeypatch, archive):
+    shm = tmp_path / 'shm'
+    shm.mkdir()
+    monkeypatch.setattr(optimize, '_shm_dir', lambda: str(shm))
+    sim = simulation(str(tmp_path / 'sims'), currents, executor=optimize.execute_persistent,
+                     transport='shm', archive=archive, batch=True,
+                     single=True, do_async=False)
+    assert [wave.injection for wave in sim.waves] == currents
+    for wave in sim.waves:
+        assert wave.wave.y[0] == pytest.approx(-0.06 + wave.injection * 1e8)
+    # the shared memory is released once the traces are mapped
+    assert os.listdir(str(shm)) == []
+    archived = [os.path.exists(os.path.join(sim.tmpdir.name, optimize.iv_filename(inj)))
+                for inj in currents]
+    assert archived == [archive] * len(currents)
+
+def test_serve(monkeypatch, tmp_path):
+    basic_simulation = pytest.importorskip('ajustador.basic_simulation')
+    runs, resets = [], []
+    def main(args):
+        runs.append((os.getcwd(), args))
+        if args == ['--fail']:
+            raise SystemExit(2)
+    monkeypatch.setattr(basic_simulation, 'main', main)
+    monkeypatch.setattr(basic_simulation, 'reset', lambda: resets.append(True))
+    requests = io.BytesIO()
+    for args in (['-i=1e-10'], ['--fail'], ['-i=2e-10']):
+        pickle.dump((str(tmp_path), args), requests)
+    requests.seek(0)
+    monkeypatch.setattr(sys, 'stdin', types.SimpleNamespace(buffer=requests))
+
+    rfd, wfd = os.pipe()
+    basic_simulation.serve(wfd)
+    with os.fdopen(rfd, 'rb') as replies:
+        assert pickle.load(replies) == ('ok', None)
+        status, info = pickle.load(replies)
+        assert status == 'error' and 'SystemExit' in info
+        assert pickle.load(replies) == ('ok', None)
+    assert runs == [(str(tmp_path), ['-i=1e-10']),
+                    (str(tmp_path), ['--fail']),
+                    (str(tmp_path), ['-i=2e-10'])]
+    assert len(resets) == 3
@@ -6,6 +6,7 @@ In particular, this should be suitable for NeuroRD.
 import copy
 import re
 import shlex
+import shutil
 import subprocess
 import os
 from lxml import etree
@@ -121,7 +122,8 @@ class NeurordSimulation(optimize.Simulation):
                  params,
                  single=False,
                  do_async=True,
-                 map_func=None):
+                 map_func=None,
+                 cache=None):
 
         super().__init__(dir,
                          params=params,
@@ -150,7 +152,7 @@ class NeurordSimulation(optimize.Simulation):
         self.stim_time=start #this assumes that each model file uses same stimulation onset
         self._attributes={'stim_time':self.stim_time}
         #collect all the args into one tuple, similar to execute_for in optimize
-        args=((mfile,fout,num) for mfile,fout,num in zip(model_set,fout_set,param_set))
+        args=((mfile,fout,num,cache) for mfile,fout,num in zip(model_set,fout_set,param_set))
 
         if do_async:
             func = optimize.exe_map(single=False, do_async=True)
@@ -168,16 +170,31 @@ class NeurordSimulation(optimize.Simulation):
         self.output=np.array(output,dtype=object)
 
     @classmethod
-    def make(cls, *, dir, model, measurement, params,map_func=None):
-        return cls(dir=dir, model=model, params=params,map_func=None)
+    def make(cls, *, dir, model, measurement, params,map_func=None, cache=None):
+        return cls(dir=dir, model=model, params=params,map_func=None, cache=cache)
 
 def execute(p):
-    modelfile, outfile, num = p
+    modelfile, outfile, num, cache = p
     home_path = os.path.expanduser("~")
     neurord_path = os.path.join(home_path,
                                 "neurord-3.3.0-all-deps.jar")
 
     cmdline = ['java', '-jar', neurord_path, modelfile, outfile]
+    if cache is not None:
+        # the model file with the parameters filled in determines the output
+        with open(modelfile, 'rb') as f:
+            key = cache.key(f.read())
+        cached = cache.lookup(key, suffix='.h5')
+        try:
+            if cached is not None:
+                shutil.copyfile(cached, outfile)
+                cache.reused(outfile)
+                return subprocess.CompletedProcess(cmdline, 0)
+        except FileNotFoundError:
+            # evicted in the meantime
+            pass
     print('+', ' '.join(shlex.quote(term) for term in cmdline), flush=True)
     check_process = subprocess.run(cmdline, capture_output=True)
+    if cache is not None and check_process.returncode == 0:
+        cache.store(key, outfile, suffix='.h5')
     return check_process